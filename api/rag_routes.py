@@ -6,28 +6,54 @@ from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
 import os
 import sys
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from lib.rag.rag_pipeline import RAGPipeline
 from lib.rag.file_processors import FileProcessor
+from lib.rag.jobs import JobQueue
 from lib.firebase_admin import db, auth
 from firebase_admin import credentials, initialize_app, storage
 
 rag_api = Blueprint('rag', __name__, url_prefix='/api/rag')
 
-# Initialize RAG pipeline
+# Initialize RAG pipeline and indexing job queue
 rag_pipeline = None
+job_queue = None
+_init_lock = threading.Lock()
 
 def get_rag_pipeline():
     """Get or initialize RAG pipeline."""
     global rag_pipeline
-    if rag_pipeline is None:
-        rag_pipeline = RAGPipeline()
+    with _init_lock:
+        if rag_pipeline is None:
+            rag_pipeline = RAGPipeline()
     return rag_pipeline
 
+def get_job_queue():
+    """Get or initialize the indexing job queue and its workers."""
+    global job_queue
+    with _init_lock:
+        if job_queue is None:
+            job_queue = JobQueue(run_upload_job)
+            job_queue.start()
+    return job_queue
+
+def start_job_queue(state):
+    """Start the indexing workers with the app, so jobs queued before a restart resume."""
+    try:
+        get_job_queue()
+    except Exception as e:
+        print(f"Error starting indexing job queue: {str(e)}")
+
+rag_api.record_once(start_job_queue)
+
 def verify_token(token: str) -> dict:
     """Verify Firebase auth token and return user info."""
     try:
@@ -36,9 +62,82 @@ def verify_token(token: str) -> dict:
     except Exception as e:
         raise Exception(f"Invalid token: {str(e)}")
 
+def delete_from_storage(storage_path: str) -> None:
+    """Delete a file from Firebase Storage, logging failures."""
+    try:
+        bucket = storage.bucket()
+        blob = bucket.blob(storage_path)
+        blob.delete()
+    except Exception as e:
+        print(f"Error deleting from storage: {str(e)}")
+
+def run_upload_job(job: dict, file_content: bytes, update) -> dict:
+    """Extract, store and index an uploaded file (runs on a job worker)."""
+    user_id = job['user_id']
+    file_name = job['payload']['file_name']
+    mime_type = job['payload']['mime_type']
+    # Set when the file is a new version of an existing document
+    document_id = job['payload'].get('document_id')
+    
+    # Open file; pages are extracted lazily while they are indexed
+    update(stage='extracting')
+    processor = FileProcessor()
+    result = processor.stream_file(
+        file_content=file_content,
+        file_name=file_name,
+        mime_type=mime_type
+    )
+    
+    if result.get('error'):
+        raise ValueError(result['error'])
+    
+    first_section = next(result['sections'], None)
+    if not first_section:
+        raise ValueError('No text extracted from file')
+    sections = chain([first_section], result['sections'])
+    
+    # Upload to Firebase Storage
+    update(stage='uploading')
+    bucket = storage.bucket(name='lumflare-71d2f.firebasestorage.app')
+    storage_path = f"rag_documents/{user_id}/{datetime.utcnow().isoformat()}_{file_name}"
+    blob = bucket.blob(storage_path)
+    blob.upload_from_string(file_content, content_type=mime_type)
+    
+    # Index document
+    update(stage='indexing')
+    pipeline = get_rag_pipeline()
+    try:
+        doc_id = pipeline.index_document(
+            user_id=user_id,
+            text=FileProcessor.iter_segments(sections),
+            file_name=file_name,
+            file_type=result['metadata'].get('file_type', 'unknown'),
+            storage_path=storage_path,
+            metadata=result['metadata'],
+            progress_callback=lambda chunks_indexed: update(chunks_indexed=chunks_indexed),
+            content_hash=hashlib.sha256(file_content).hexdigest(),
+            document_id=document_id,
+            segmented=True
+        )
+    except Exception:
+        # Nothing points at the new file; an updated document keeps its previous one
+        delete_from_storage(storage_path)
+        raise
+    
+    # The previous version's file is replaced once the new one is indexed
+    previous_storage_path = job['payload'].get('previous_storage_path')
+    if previous_storage_path and previous_storage_path != storage_path:
+        delete_from_storage(previous_storage_path)
+    
+    return {
+        'document_id': doc_id,
+        'file_name': file_name,
+        'metadata': result['metadata']
+    }
+
 @rag_api.route('/upload', methods=['POST'])
 def upload_document():
-    """Upload and index a document."""
+    """Upload a document and queue it for indexing."""
     try:
         # Verify authentication
         auth_header = request.headers.get('Authorization')
@@ -62,42 +161,57 @@ def upload_document():
         file_content = file.read()
         mime_type = file.content_type
         
-        # Process file
-        processor = FileProcessor()
-        result = processor.process_file(
-            file_content=file_content,
-            file_name=file_name,
-            mime_type=mime_type
+        # Extraction, storage and indexing run on a background worker
+        job_id = get_job_queue().submit(
+            user_id,
+            {'file_name': file_name, 'mime_type': mime_type},
+            file_content
         )
         
-        if result.get('error'):
-            return jsonify({'error': result['error']}), 400
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'file_name': file_name
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@rag_api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the stage and progress of an indexing job."""
+    try:
+        # Verify authentication
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({'error': 'Missing or invalid authorization header'}), 401
+        
+        token = auth_header.split('Bearer ')[1]
+        user_info = verify_token(token)
+        user_id = user_info['uid']
         
-        if not result.get('text'):
-            return jsonify({'error': 'No text extracted from file'}), 400
+        job = get_job_queue().get(job_id)
         
-        # Upload to Firebase Storage
-        bucket = storage.bucket(name='lumflare-71d2f.firebasestorage.app')
-        storage_path = f"rag_documents/{user_id}/{datetime.utcnow().isoformat()}_{file_name}"
-        blob = bucket.blob(storage_path)
-        blob.upload_from_string(file_content, content_type=mime_type)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
         
-        # Index document
-        pipeline = get_rag_pipeline()
-        doc_id = pipeline.index_document(
-            user_id=user_id,
-            text=result['text'],
-            file_name=file_name,
-            file_type=result['metadata'].get('file_type', 'unknown'),
-            storage_path=storage_path,
-            metadata=result['metadata']
-        )
+        if job.get('user_id') != user_id:
+            return jsonify({'error': 'Unauthorized'}), 403
         
         return jsonify({
             'success': True,
-            'document_id': doc_id,
-            'file_name': file_name,
-            'metadata': result['metadata']
+            'job': {
+                'id': job['id'],
+                'status': job['status'],
+                'stage': job['stage'],
+                'chunks_indexed': job['chunks_indexed'],
+                'file_name': job['payload'].get('file_name'),
+                'result': job['result'],
+                'error': job['error'],
+                'created_at': datetime.utcfromtimestamp(job['created_at']).isoformat(),
+                'updated_at': datetime.utcfromtimestamp(job['updated_at']).isoformat()
+            }
         }), 200
         
     except Exception as e:
@@ -121,17 +235,27 @@ def query():
         question = data.get('question')
         top_k = data.get('top_k', 5)
         include_platform_docs = data.get('include_platform_docs', True)
+        context_tokens = data.get('context_tokens')
         
         if not question:
             return jsonify({'error': 'Question is required'}), 400
         
+        if context_tokens is not None:
+            try:
+                context_tokens = int(context_tokens) if not isinstance(context_tokens, bool) else 0
+            except (TypeError, ValueError):
+                context_tokens = 0
+            if context_tokens <= 0:
+                return jsonify({'error': 'context_tokens must be a positive integer'}), 400
+        
         # Query pipeline
         pipeline = get_rag_pipeline()
         result = pipeline.query(
             question=question,
             user_id=user_id,
             top_k=top_k,
-            include_platform_docs=include_platform_docs
+            include_platform_docs=include_platform_docs,
+            context_tokens=context_tokens
         )
         
         return jsonify({
@@ -247,6 +371,64 @@ def get_documents():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@rag_api.route('/documents/<document_id>', methods=['PUT'])
+def update_document(document_id):
+    """Upload a new version of a document and queue it for incremental re-indexing."""
+    try:
+        # Verify authentication
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({'error': 'Missing or invalid authorization header'}), 401
+        
+        token = auth_header.split('Bearer ')[1]
+        user_info = verify_token(token)
+        user_id = user_info['uid']
+        
+        # Verify document belongs to user
+        doc = get_rag_pipeline().vector_store.get_document(document_id)
+        
+        if not doc:
+            return jsonify({'error': 'Document not found'}), 404
+        
+        if doc.get('user_id') != user_id:
+            return jsonify({'error': 'Unauthorized'}), 403
+        
+        # Check if file is present
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        # Get file info
+        file_name = secure_filename(file.filename)
+        file_content = file.read()
+        mime_type = file.content_type
+        
+        # Only changed chunks are embedded and written, on a background worker
+        job_id = get_job_queue().submit(
+            user_id,
+            {
+                'file_name': file_name,
+                'mime_type': mime_type,
+                'document_id': document_id,
+                'previous_storage_path': doc.get('storage_path')
+            },
+            file_content
+        )
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'document_id': document_id,
+            'file_name': file_name
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @rag_api.route('/documents/<document_id>', methods=['DELETE'])
 def delete_document(document_id):
     """Delete a document and its chunks."""
@@ -260,9 +442,9 @@ def delete_document(document_id):
         user_info = verify_token(token)
         user_id = user_info['uid']
         
-        # Verify document belongs to user
-        from lib.rag.vector_store import FirestoreVectorStore
-        vector_store = FirestoreVectorStore()
+        # Verify document belongs to user; the pipeline's store holds the
+        # in-memory index that the deleted chunks must be dropped from
+        vector_store = get_rag_pipeline().vector_store
         doc = vector_store.get_document(document_id)
         
         if not doc:
@@ -271,21 +453,56 @@ def delete_document(document_id):
         if doc.get('user_id') != user_id:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        # Delete from storage
-        if doc.get('storage_path'):
-            try:
-                bucket = storage.bucket()
-                blob = bucket.blob(doc['storage_path'])
-                blob.delete()
-            except Exception as e:
-                print(f"Error deleting from storage: {str(e)}")
+        def report_progress(deleted):
+            print(f"Deleted {deleted}/{doc.get('chunk_count', '?')} chunks of document {document_id}")
         
-        # Delete from vector store
-        vector_store.delete_document(document_id)
+        # Delete from storage while the chunks are deleted from the vector store
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if doc.get('storage_path'):
+                executor.submit(delete_from_storage, doc['storage_path'])
+            chunks_deleted = vector_store.delete_document(document_id,
+                                                          progress_callback=report_progress)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Document deleted successfully',
+            'chunks_deleted': chunks_deleted
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@rag_api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Get embedding queue, latency and cache metrics.
+    
+    The metrics are aggregated across all users, so the route is restricted
+    to platform operators: callers whose token carries the 'rag_admin'
+    custom claim (set with auth.set_custom_user_claims). Organization admin
+    roles do not grant access.
+    """
+    try:
+        # Verify authentication
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({'error': 'Missing or invalid authorization header'}), 401
+        
+        token = auth_header.split('Bearer ')[1]
+        user_info = verify_token(token)
+        
+        if user_info.get('rag_admin') is not True:
+            return jsonify({'error': 'Unauthorized'}), 403
+        
+        pipeline = get_rag_pipeline()
+        extraction_cache = FileProcessor._get_cache()
         
         return jsonify({
             'success': True,
-            'message': 'Document deleted successfully'
+            'metrics': {
+                **pipeline.metrics(),
+                'extraction_cache': extraction_cache.stats() if extraction_cache else None
+            }
         }), 200
         
     except Exception as e:
@@ -9,6 +9,14 @@ import DocumentList from './DocumentList';
 import MaterialGenerator from './MaterialGenerator';
 import { Message, Document } from '@/types/ai-assistant';
 
+// Give up waiting for an indexing job after this long
+const JOB_TIMEOUT_MS = 10 * 60 * 1000;
+// Job status polls back off from the first interval up to the last
+const JOB_POLL_INITIAL_MS = 1000;
+const JOB_POLL_MAX_MS = 10000;
+// Consecutive failed status polls tolerated before giving up
+const JOB_MAX_FAILED_POLLS = 5;
+
 export default function TeacherChatbot({ userId }: { userId: string }) {
   const [messages, setMessages] = useState<Message[]>([]);
   const [isLoading, setIsLoading] = useState(false);
@@ -56,6 +64,33 @@ export default function TeacherChatbot({ userId }: { userId: string }) {
     }
   };
 
+  const waitForJob = async (jobId: string, token: string) => {
+    const deadline = Date.now() + JOB_TIMEOUT_MS;
+    let delay = JOB_POLL_INITIAL_MS;
+    let failedPolls = 0;
+    while (true) {
+      try {
+        const response = await fetch(`/api/rag/jobs/${jobId}`, {
+          headers: {
+            'Authorization': `Bearer ${token}`,
+          },
+        });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.error || 'Failed to fetch job status');
+        failedPolls = 0;
+        if (data.job.status === 'done' || data.job.status === 'failed') return data.job;
+      } catch (error) {
+        failedPolls += 1;
+        if (failedPolls >= JOB_MAX_FAILED_POLLS) throw error;
+      }
+      if (Date.now() + delay > deadline) {
+        throw new Error('Indexing is taking longer than expected. Check your documents again later.');
+      }
+      await new Promise(resolve => setTimeout(resolve, delay));
+      delay = Math.min(delay * 2, JOB_POLL_MAX_MS);
+    }
+  };
+
   const handleFileUpload = async (files: File[]) => {
     try {
       setIsLoading(true);
@@ -89,6 +124,18 @@ export default function TeacherChatbot({ userId }: { userId: string }) {
             continue;
           }
 
+          // Indexing runs in the background; wait for the job to finish
+          const job = await waitForJob(data.job_id, token);
+          if (job.status === 'failed') {
+            setMessages(prev => [...prev, {
+              id: `error-${Date.now()}-${file.name}`,
+              role: 'assistant',
+              content: `❌ Error indexing "${file.name}": ${job.error || 'Failed to index'}`,
+              timestamp: new Date(),
+            }]);
+            continue;
+          }
+
           // Add success message
           setMessages(prev => [...prev, {
             id: `upload-${Date.now()}-${file.name}`,
@@ -37,3 +37,48 @@ export async function DELETE(
   }
 }
 
+export async function PUT(
+  request: NextRequest,
+  { params }: { params: Promise<{ documentId: string }> }
+) {
+  try {
+    const { documentId } = await params;
+    const formData = await request.formData();
+    const file = formData.get('file') as File;
+    const token = request.headers.get('Authorization')?.replace('Bearer ', '');
+
+    if (!file) {
+      return NextResponse.json({ error: 'No file provided' }, { status: 400 });
+    }
+
+    if (!token) {
+      return NextResponse.json({ error: 'Unauthorized' }, { status: 401 });
+    }
+
+    // Forward to Flask backend
+    const flaskUrl = process.env.NEXT_PUBLIC_FLASK_URL || 'http://localhost:5328';
+    const uploadFormData = new FormData();
+    uploadFormData.append('file', file);
+
+    const response = await fetch(`${flaskUrl}/api/rag/documents/${documentId}`, {
+      method: 'PUT',
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+      body: uploadFormData,
+    });
+
+    const data = await response.json();
+
+    if (!response.ok) {
+      return NextResponse.json(data, { status: response.status });
+    }
+
+    return NextResponse.json(data);
+  } catch (error: any) {
+    return NextResponse.json(
+      { error: error.message || 'Failed to update document' },
+      { status: 500 }
+    );
+  }
+}
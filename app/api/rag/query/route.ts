@@ -3,7 +3,7 @@ import { NextRequest, NextResponse } from 'next/server';
 export async function POST(request: NextRequest) {
   try {
     const body = await request.json();
-    const { question, top_k, include_platform_docs } = body;
+    const { question, top_k, include_platform_docs, context_tokens } = body;
     const token = request.headers.get('Authorization')?.replace('Bearer ', '');
 
     if (!question) {
@@ -27,6 +27,7 @@ export async function POST(request: NextRequest) {
         question,
         top_k: top_k || 5,
         include_platform_docs: include_platform_docs !== false,
+        context_tokens,
       }),
     });
 
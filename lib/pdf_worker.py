@@ -0,0 +1,64 @@
+"""
+PDF page extraction for worker processes.
+
+Lives outside the lib.rag package and imports only PyPDF2, so spawned
+extraction workers do not run lib.rag's __init__ (which sets up Gemini and
+Firebase) just to extract text.
+"""
+
+import threading
+from io import BytesIO
+from typing import Iterator, List
+
+import PyPDF2
+
+
+# Seconds a worker keeps its parsed PDF after its last task; ranges of the
+# same PDF arrive back to back, so the reader is dropped once its job ends
+READER_IDLE_SECONDS = 2.0
+
+# (path, reader) of the PDF last parsed by this worker process
+_reader = (None, None)
+_reader_lock = threading.Lock()
+_release_timer = None
+
+
+def iter_pdf_pages(pdf_reader, start: int = 0, stop: int = None) -> Iterator[str]:
+    """Yield the text of each non-empty PDF page with its page marker."""
+    stop = len(pdf_reader.pages) if stop is None else stop
+    for page_num in range(start, stop):
+        try:
+            text = pdf_reader.pages[page_num].extract_text()
+            if text:
+                yield f"--- Page {page_num + 1} ---\n{text}"
+        except Exception as e:
+            print(f"Error extracting page {page_num + 1}: {str(e)}")
+
+
+def extract_pdf_range(path: str, start: int, stop: int) -> List[str]:
+    """Extract pages [start, stop) of a PDF file, parsing it once per worker."""
+    global _reader, _release_timer
+    with _reader_lock:
+        if _release_timer is not None:
+            _release_timer.cancel()
+            _release_timer = None
+        if _reader[0] != path:
+            with open(path, 'rb') as f:
+                _reader = (path, PyPDF2.PdfReader(BytesIO(f.read())))
+        reader = _reader[1]
+
+    pages = list(iter_pdf_pages(reader, start, stop))
+
+    with _reader_lock:
+        _release_timer = threading.Timer(READER_IDLE_SECONDS, _release_reader)
+        _release_timer.daemon = True
+        _release_timer.start()
+    return pages
+
+
+def _release_reader() -> None:
+    """Drop the cached PDF once no range of it has been asked for a while."""
+    global _reader, _release_timer
+    with _reader_lock:
+        _reader = (None, None)
+        _release_timer = None
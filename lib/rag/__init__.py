@@ -4,15 +4,17 @@ RAG (Retrieval-Augmented Generation) system for teacher chatbot.
 
 from lib.rag.rag_pipeline import RAGPipeline
 from lib.rag.vector_store import FirestoreVectorStore
-from lib.rag.chunking import TextChunker
-from lib.rag.embeddings import GeminiEmbedder
+from lib.rag.chunking import TextChunker, TokenChunker
+from lib.rag.embeddings import GeminiEmbedder, LocalEmbedder
 from lib.rag.file_processors import FileProcessor
 
 __all__ = [
     'RAGPipeline',
     'FirestoreVectorStore',
     'TextChunker',
+    'TokenChunker',
     'GeminiEmbedder',
+    'LocalEmbedder',
     'FileProcessor',
 ]
 
@@ -0,0 +1,423 @@
+"""
+Caching utilities for the RAG system.
+Implements a bounded LRU/TTL query cache, a content-addressed chunk
+embedding store and a size-bounded cache of extracted document text, all
+optionally backed by SQLite.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Bounded in-memory LRU cache of embeddings with a time-to-live.
+
+    When ``persist_path`` is given, entries are also written to a SQLite
+    file so they survive restarts and are shared by worker processes.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 24 * 3600,
+                 persist_path: str = None):
+        """
+        Initialize cache.
+
+        Args:
+            max_size: Maximum number of in-memory entries
+            ttl_seconds: Seconds an entry stays valid (0 for no expiry)
+            persist_path: Optional SQLite file for on-disk backing
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if persist_path:
+            directory = os.path.dirname(os.path.abspath(persist_path))
+            os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings "
+                    "(key TEXT PRIMARY KEY, embedding BLOB, created_at REAL)"
+                )
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """
+        Look up an embedding.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Embedding vector, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+
+        stored = self._load(key, now)
+
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, *stored)
+        return stored[0]
+
+    def put(self, key: str, embedding: List[float]) -> None:
+        """Store an embedding."""
+        now = time.time()
+        with self._lock:
+            self._store(key, embedding, now)
+        if self.persist_path:
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                        (key, np.asarray(embedding, dtype=np.float32).tobytes(), now),
+                    )
+            except sqlite3.Error as e:
+                print(f"Error persisting cached embedding: {e}")
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+    def clear(self) -> None:
+        """Drop all in-memory entries and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _store(self, key: str, embedding: List[float], created_at: float) -> None:
+        """Insert into the LRU, evicting the oldest entries. Caller holds the lock."""
+        self._entries[key] = (embedding, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str, now: float) -> Optional[tuple]:
+        """Read an unexpired (embedding, created_at) entry from the SQLite backing."""
+        if not self.persist_path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT embedding, created_at FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading cached embedding: {e}")
+            return None
+        if row is None or self._expired(row[1], now):
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist(), row[1]
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - created_at > self.ttl_seconds
+
+    @contextmanager
+    def _connect(self):
+        """Open a short-lived SQLite connection that commits on success."""
+        conn = sqlite3.connect(self.persist_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class ContentEmbeddingStore:
+    """
+    Content-addressed embedding store backed by SQLite.
+
+    Embeddings are keyed by a hash of the model, task type and exact chunk
+    text, so re-uploaded or shared material never pays for the same chunk
+    twice, whoever uploaded it.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize store.
+
+        Args:
+            path: SQLite file
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings "
+                "(hash TEXT PRIMARY KEY, embedding BLOB, created_at REAL)"
+            )
+
+    @staticmethod
+    def content_hash(text: str, namespace: str = "") -> str:
+        """SHA-256 of the chunk text within a model/task namespace."""
+        return hashlib.sha256(f"{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, List[float]]:
+        """
+        Look up embeddings by content hash.
+
+        Args:
+            hashes: Content hashes
+
+        Returns:
+            Mapping of found hashes to embeddings
+        """
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        try:
+            with self._connect() as conn:
+                # Stay well below SQLite's bound-parameter limit
+                for start in range(0, len(unique), 500):
+                    group = unique[start:start + 500]
+                    placeholders = ",".join("?" * len(group))
+                    rows = conn.execute(
+                        f"SELECT hash, embedding FROM chunk_embeddings WHERE hash IN ({placeholders})",
+                        group,
+                    ).fetchall()
+                    for content_hash, blob in rows:
+                        found[content_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        except sqlite3.Error as e:
+            print(f"Error reading chunk embedding cache: {e}")
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(unique) - len(found)
+        return found
+
+    def put_many(self, embeddings: Dict[str, List[float]]) -> None:
+        """Store embeddings by content hash."""
+        if not embeddings:
+            return
+        now = time.time()
+        rows = [
+            (content_hash, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for content_hash, embedding in embeddings.items()
+        ]
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunk_embeddings VALUES (?, ?, ?)", rows
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing chunk embedding cache: {e}")
+
+    def stats(self) -> Dict:
+        """Hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    @contextmanager
+    def _connect(self):
+        """Open a short-lived SQLite connection that commits on success."""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class ExtractionCache:
+    """
+    Size-bounded SQLite cache of extracted document text.
+
+    Entries are keyed by a hash of the uploaded file's bytes, so the same
+    syllabus uploaded by several teachers, or re-uploaded after a failed
+    index, is parsed only once. Sections (pages or slides) are compressed
+    individually and decompressed lazily on a hit. Least recently used
+    entries are evicted once the compressed total exceeds ``max_bytes``.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Initialize cache.
+
+        Args:
+            path: SQLite file
+            max_bytes: Maximum total compressed size of cached text
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extractions "
+                "(key TEXT PRIMARY KEY, metadata TEXT, size INTEGER, last_used REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extraction_sections "
+                "(key TEXT, seq INTEGER, text BLOB, PRIMARY KEY (key, seq))"
+            )
+
+    @staticmethod
+    def content_key(content: bytes, extension: str = "") -> str:
+        """SHA-256 of the file bytes, qualified by the extension that picks the parser."""
+        return f"{extension}:{hashlib.sha256(content).hexdigest()}"
+
+    def get(self, key: str) -> Optional[Tuple[Dict, Iterator[str]]]:
+        """
+        Look up an extraction.
+
+        Args:
+            key: Cache key from content_key
+
+        Returns:
+            (metadata, iterator of text sections), or None on a miss
+        """
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT metadata FROM extractions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE extractions SET last_used = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    blobs = [
+                        blob
+                        for (blob,) in conn.execute(
+                            "SELECT text FROM extraction_sections WHERE key = ? ORDER BY seq",
+                            (key,),
+                        )
+                    ]
+        except sqlite3.Error as e:
+            print(f"Error reading extraction cache: {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0]), (zlib.decompress(blob).decode("utf-8") for blob in blobs)
+
+    def cache_stream(self, key: str, metadata: Dict, sections: Iterable[str]) -> Iterator[str]:
+        """
+        Pass sections through unchanged and store them once all were consumed.
+
+        Only the compressed sections are held until then; a stream that
+        fails or is abandoned part-way is not cached.
+
+        Args:
+            key: Cache key from content_key
+            metadata: Extraction metadata to store with the text
+            sections: Text sections as they are extracted
+
+        Returns:
+            Iterator of the same sections
+        """
+        compressed = []
+        for section in sections:
+            compressed.append(zlib.compress(section.encode("utf-8")))
+            yield section
+        self._put(key, metadata, compressed)
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and stored size."""
+        try:
+            with self._connect() as conn:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions"
+                ).fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _put(self, key: str, metadata: Dict, compressed: List[bytes]) -> None:
+        """Store compressed sections, then evict least recently used entries."""
+        size = sum(len(blob) for blob in compressed)
+        if size > self.max_bytes:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM extraction_sections WHERE key = ?", (key,))
+                conn.executemany(
+                    "INSERT INTO extraction_sections VALUES (?, ?, ?)",
+                    [(key, seq, blob) for seq, blob in enumerate(compressed)],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(metadata, default=str), size, time.time()),
+                )
+
+                total = conn.execute("SELECT SUM(size) FROM extractions").fetchone()[0]
+                if total > self.max_bytes:
+                    evicted = []
+                    for old_key, old_size in conn.execute(
+                        "SELECT key, size FROM extractions WHERE key != ? ORDER BY last_used",
+                        (key,),
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append((old_key,))
+                        total -= old_size
+                    conn.executemany("DELETE FROM extractions WHERE key = ?", evicted)
+                    conn.executemany("DELETE FROM extraction_sections WHERE key = ?", evicted)
+        except sqlite3.Error as e:
+            print(f"Error writing extraction cache: {e}")
+
+    @contextmanager
+    def _connect(self):
+        """Open a short-lived SQLite connection that commits on success."""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
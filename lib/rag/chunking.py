@@ -3,13 +3,28 @@ Text chunking utilities for RAG system.
 Implements semantic and fixed-size chunking strategies.
 """
 
-from typing import List, Dict
+from collections import deque
+from itertools import islice
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
 import re
 
+from lib.rag.tokenizer import Tokenizer
+
+
+# Where a piece of text comes from, e.g. ('page', 3) or ('slide', 2)
+Location = Tuple[str, int]
+
 
 class TextChunker:
     """Chunks text into smaller pieces for embedding and retrieval."""
     
+    # Whitespace after sentence-ending punctuation, where sentences are split
+    SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+    
+    # Identifies settings that move chunk boundaries, so documents chunked
+    # differently never share chunks ('' for the default character scheme)
+    scheme = ''
+    
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
         """
         Initialize chunker.
@@ -32,101 +47,367 @@ class TextChunker:
         Returns:
             List of chunk dictionaries with text and metadata
         """
-        if not text or not text.strip():
-            return []
+        return list(self.chunk_sections([text], metadata))
+    
+    def chunk_sections(self, sections: Iterable[str], metadata: Dict = None) -> Iterator[Dict]:
+        """
+        Split a stream of text sections (e.g. PDF pages) into chunks lazily.
+        
+        Yields the same chunks as chunk_text on the sections joined by blank
+        lines, but only holds the current section and chunk in memory.
+        
+        Args:
+            sections: Text sections, possibly produced lazily
+            metadata: Additional metadata to attach to each chunk
+            
+        Returns:
+            Iterator of chunk dictionaries with text and metadata
+        """
+        return self._chunk_paragraphs(self._paragraphs((None, section) for section in sections), metadata)
+    
+    def chunk_segments(self, segments: Iterable[Tuple[Optional[Location], str]],
+                       metadata: Dict = None, separate: bool = False) -> Iterator[Dict]:
+        """
+        Split located text segments (e.g. PDF pages or PPTX slides) into
+        chunks that record where their text comes from.
+        
+        A chunk built from segments located at ('page', 3) and ('page', 4)
+        gets 'page_start': 3 and 'page_end': 4, counting any overlap text
+        carried over from the previous chunk.
+        
+        Args:
+            segments: (location, text) pairs in document order, where location
+                is a (kind, number) pair such as ('slide', 2), or None
+            metadata: Additional metadata to attach to each chunk
+            separate: Never let a chunk (or its overlap) span two segments,
+                e.g. for slides, which stand on their own
+            
+        Returns:
+            Iterator of chunk dictionaries with text and metadata
+        """
+        if not separate:
+            return self._chunk_paragraphs(self._paragraphs(segments), metadata)
         
-        # Clean text
-        text = text.strip()
+        chunks = (chunk
+                  for segment in segments
+                  for chunk in self._chunk_paragraphs(self._paragraphs([segment]), metadata))
+        return ({**chunk, 'chunk_index': index} for index, chunk in enumerate(chunks))
+    
+    @staticmethod
+    def _paragraphs(segments: Iterable[Tuple[Optional[Location], str]]) -> Iterator[Tuple[Optional[Location], str]]:
+        """Split segments into (location, paragraph) pairs."""
+        # Sections are separated by blank lines, so a paragraph never spans two
+        return ((location, para)
+                for location, text in segments if text and text.strip()
+                for para in re.split(r'\n\s*\n', text))
+    
+    def _chunk_paragraphs(self, paragraphs: Iterable[Tuple[Optional[Location], str]],
+                          metadata: Dict = None) -> Iterator[Dict]:
+        """
+        Merge paragraphs into chunks, splitting oversized ones by sentence.
         
-        # Try to split by paragraphs first (better semantic boundaries)
-        paragraphs = re.split(r'\n\s*\n', text)
-        chunks = []
-        current_chunk = ""
+        A chunk is assembled as a list of parts (paragraphs, sentences and
+        the overlap carried over from the previous chunk) and separators,
+        joined once when the chunk is emitted, so each character is copied
+        a constant number of times however large the document. Alongside,
+        the offsets at which the chunk's text moves to a new location are
+        kept, which is how an overlap is traced back to its page.
+        """
+        pieces = []  # Parts of the current chunk and the separators between them
+        length = 0  # Length of the current chunk
+        locations = []  # (offset, location) where the current chunk enters a location
         chunk_index = 0
+        previous = None  # (text, locations) of the last chunk yielded
         
-        for para in paragraphs:
+        for location, para in paragraphs:
             para = para.strip()
             if not para:
                 continue
             
             # If paragraph fits, add it
-            if len(current_chunk) + len(para) + 1 <= self.chunk_size:
-                if current_chunk:
-                    current_chunk += "\n\n" + para
-                else:
-                    current_chunk = para
-            else:
-                # Save current chunk if it exists
-                if current_chunk:
-                    chunks.append(self._create_chunk(current_chunk, chunk_index, metadata))
-                    chunk_index += 1
+            if length + len(para) + 1 <= self.chunk_size:
+                if pieces:
+                    pieces.append("\n\n")
+                    length += 2
+                if not locations or locations[-1][1] != location:
+                    locations.append((length, location))
+                pieces.append(para)
+                length += len(para)
+                continue
+            
+            # Save current chunk if it exists
+            if pieces:
+                previous = ("".join(pieces), locations)
+                yield self._create_chunk(previous[0], chunk_index, metadata, locations)
+                chunk_index += 1
+            
+            if len(para) <= self.chunk_size:
+                # Start new chunk with overlap from previous
+                pieces, locations = [para], [(0, location)]
+                if previous is not None:
+                    overlap_text, locations = self._overlap(*previous)
+                    if overlap_text:
+                        pieces = [overlap_text, "\n\n", para]
+                        if locations[-1][1] != location:
+                            locations.append((len(overlap_text) + 2, location))
+                    else:
+                        locations = [(0, location)]
+                length = sum(len(piece) for piece in pieces)
+                continue
+            
+            # Paragraph is too large, split it by sentences found in one pass
+            pieces, length, locations = [], 0, [(0, location)]
+            start = 0
+            breaks = [match.span() for match in self.SENTENCE_BREAK.finditer(para)]
+            for break_start, break_end in breaks + [(len(para), len(para))]:
+                sentence = para[start:break_start]
+                start = break_end
                 
-                # If paragraph is too large, split it
-                if len(para) > self.chunk_size:
-                    # Split by sentences
-                    sentences = re.split(r'(?<=[.!?])\s+', para)
-                    current_chunk = ""
-                    
-                    for sentence in sentences:
-                        if len(current_chunk) + len(sentence) + 1 <= self.chunk_size:
-                            if current_chunk:
-                                current_chunk += " " + sentence
-                            else:
-                                current_chunk = sentence
-                        else:
-                            if current_chunk:
-                                chunks.append(self._create_chunk(current_chunk, chunk_index, metadata))
-                                chunk_index += 1
-                                # Add overlap
-                                overlap_text = self._get_overlap_text(current_chunk)
-                                current_chunk = overlap_text + " " + sentence if overlap_text else sentence
-                            else:
-                                current_chunk = sentence
+                if not pieces:
+                    pieces.append(sentence)
+                    length = len(sentence)
+                elif length + len(sentence) + 1 <= self.chunk_size:
+                    pieces.append(" ")
+                    pieces.append(sentence)
+                    length += len(sentence) + 1
                 else:
-                    # Start new chunk with overlap from previous
-                    if chunks:
-                        overlap_text = self._get_overlap_text(chunks[-1]['text'])
-                        current_chunk = overlap_text + "\n\n" + para if overlap_text else para
-                    else:
-                        current_chunk = para
+                    previous = ("".join(pieces), locations)
+                    yield self._create_chunk(previous[0], chunk_index, metadata, locations)
+                    chunk_index += 1
+                    # Add overlap
+                    overlap_text, locations = self._overlap(*previous)
+                    pieces = [overlap_text, " ", sentence] if overlap_text else [sentence]
+                    if not overlap_text:
+                        locations = [(0, location)]
+                    elif locations[-1][1] != location:
+                        locations.append((len(overlap_text) + 1, location))
+                    length = sum(len(piece) for piece in pieces)
         
         # Add final chunk
-        if current_chunk:
-            chunks.append(self._create_chunk(current_chunk, chunk_index, metadata))
-        
-        return chunks
+        if pieces:
+            yield self._create_chunk("".join(pieces), chunk_index, metadata, locations)
     
-    def _create_chunk(self, text: str, index: int, metadata: Dict = None) -> Dict:
-        """Create a chunk dictionary with metadata."""
+    def _create_chunk(self, text: str, index: int, metadata: Dict = None,
+                      locations: List[Tuple[int, Optional[Location]]] = None) -> Dict:
+        """Create a chunk dictionary with metadata and the range of locations it covers."""
         chunk = {
             'text': text.strip(),
             'chunk_index': index,
             'char_count': len(text)
         }
         
+        if locations and locations[0][1] is not None:
+            (kind, first), (_, last) = locations[0][1], locations[-1][1]
+            chunk[f'{kind}_start'] = first
+            chunk[f'{kind}_end'] = last
+        
         if metadata:
             chunk.update(metadata)
         
         return chunk
     
-    def _get_overlap_text(self, text: str) -> str:
-        """Extract overlap text from end of chunk."""
-        if len(text) <= self.chunk_overlap:
-            return text
+    def _overlap(self, text: str, locations: List[Tuple[int, Optional[Location]]]
+                 ) -> Tuple[str, List[Tuple[int, Optional[Location]]]]:
+        """
+        Extract overlap text from end of chunk.
         
-        # Try to get overlap at sentence boundary
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        overlap = ""
+        Takes the longest run of whole trailing sentences that fits in
+        chunk_overlap (joined by single spaces), or else the last
+        chunk_overlap characters. Only the tail of the chunk that could hold
+        those sentences is scanned for sentence breaks, so the cost depends
+        on chunk_overlap rather than on the chunk size.
         
-        for sentence in reversed(sentences):
-            if len(overlap) + len(sentence) <= self.chunk_overlap:
-                overlap = sentence + " " + overlap if overlap else sentence
+        Args:
+            text: Chunk text
+            locations: (offset, location) where the chunk enters each location
+            
+        Returns:
+            Overlap text and the (offset, location) pairs within it
+        """
+        limit = self.chunk_overlap
+        if len(text) <= limit:
+            return text, locations
+        
+        sentences = []  # (start, end) of the trailing sentences, last first
+        overlap_length = 0
+        end = len(text)
+        scanned = end  # Sentence breaks in text[scanned:end] are in breaks
+        breaks = []
+        while True:
+            budget = limit - overlap_length
+            if scanned > 0 and end - scanned <= budget:
+                # The sentence ending at end may start before scanned: scan
+                # back far enough to find its start, never stopping inside
+                # a whitespace run so that no break is cut in two
+                start = max(0, end - budget - 1)
+                while start > 0 and text[start - 1].isspace():
+                    start -= 1
+                breaks[:0] = [match.span() for match in
+                              self.SENTENCE_BREAK.finditer(text, start, scanned)]
+                scanned = start
+            
+            if breaks:
+                break_start, break_end = breaks.pop()
+            elif scanned == 0:
+                break_start = break_end = 0
             else:
+                break  # The sentence starts too far back to fit
+            
+            sentence_length = end - break_end
+            if overlap_length + sentence_length > limit:
                 break
+            overlap_length += sentence_length + 1 if sentences else sentence_length
+            sentences.append((break_end, end))
+            if not break_end:
+                break
+            end = break_start
         
         # If no sentence boundary, just take last N characters
-        if not overlap:
-            overlap = text[-self.chunk_overlap:]
-        
-        return overlap.strip()
+        if not sentences:
+            overlap_text = text[-limit:].strip()
+            spans = [(len(text) - len(overlap_text), len(text))]
+        else:
+            spans = sentences[::-1]
+            overlap_text = " ".join(text[start:end] for start, end in spans)
+        return overlap_text, self._overlap_locations(locations, spans)
+    
+    @staticmethod
+    def _overlap_locations(locations: List[Tuple[int, Optional[Location]]],
+                           spans: List[Tuple[int, int]]) -> List[Tuple[int, Optional[Location]]]:
+        """
+        Map a chunk's (offset, location) pairs onto its overlap text, which
+        joins the given (start, end) spans of the chunk by single spaces.
+        """
+        overlap_locations = []
+        for offset, location in locations:
+            position = 0  # Offset of the current span in the overlap text
+            for start, end in spans:
+                if offset < end:
+                    position += max(0, offset - start)
+                    break
+                position += end - start + 1
+            if overlap_locations and overlap_locations[-1][0] == position:
+                overlap_locations.pop()  # Entered before the overlap starts
+            overlap_locations.append((position, location))
+        return overlap_locations
 
+
+class TokenChunker(TextChunker):
+    """
+    Chunks text to a token budget instead of a character count.
+    
+    Paragraphs, or the sentences of paragraphs too large for one chunk,
+    are counted once with the tokenizer and packed greedily, so chunks come
+    as close to chunk_size tokens as sentence boundaries allow. Sentences
+    longer than a whole chunk are split between words, and words longer
+    than a chunk (e.g. URLs) between tokens. Each chunk records
+    its 'token_count', so prompts can be budgeted without re-tokenizing.
+    """
+    
+    def __init__(self, tokenizer: Tokenizer, chunk_size: int = 512, chunk_overlap: int = 64):
+        """
+        Initialize chunker.
+        
+        Args:
+            tokenizer: Counts tokens the way the embedding model does
+            chunk_size: Maximum tokens per chunk
+            chunk_overlap: Tokens of trailing paragraphs or sentences repeated
+                in the next chunk
+        """
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.tokenizer = tokenizer
+        self.scheme = f'tokens:{tokenizer.name}:{chunk_size}:{chunk_overlap}'
+    
+    def _chunk_paragraphs(self, paragraphs: Iterable[Tuple[Optional[Location], str]],
+                          metadata: Dict = None) -> Iterator[Dict]:
+        """Pack counted units (see _units) into chunks of at most chunk_size tokens."""
+        units = deque()  # (separator, text, tokens, location) of the current chunk
+        tokens = 0
+        chunk_index = 0
+        
+        for unit in self._units(paragraphs):
+            if units and tokens + unit[2] > self.chunk_size:
+                yield self._create_token_chunk(units, tokens, chunk_index, metadata)
+                chunk_index += 1
+                
+                # Carry over trailing units, as far as the next one still fits
+                overlap = deque()
+                overlap_tokens = 0
+                for previous in reversed(units):
+                    if (overlap_tokens + previous[2] > self.chunk_overlap
+                            or overlap_tokens + previous[2] + unit[2] > self.chunk_size):
+                        break
+                    overlap.appendleft(previous)
+                    overlap_tokens += previous[2]
+                units, tokens = overlap, overlap_tokens
+            
+            units.append(unit)
+            tokens += unit[2]
+        
+        # Add final chunk
+        if units:
+            yield self._create_token_chunk(units, tokens, chunk_index, metadata)
+    
+    def _units(self, paragraphs: Iterable[Tuple[Optional[Location], str]]
+               ) -> Iterator[Tuple[str, str, int, Optional[Location]]]:
+        """
+        Split paragraphs into the units chunks are packed from.
+        
+        Yields:
+            (separator from the previous unit, text, token count, location) tuples
+        """
+        count = self.tokenizer.count
+        for location, para in paragraphs:
+            para = para.strip()
+            if not para:
+                continue
+            
+            tokens = count(para)
+            if tokens <= self.chunk_size:
+                yield '\n\n', para, tokens, location
+                continue
+            
+            # Paragraph is too large, split it by sentences
+            separator = '\n\n'
+            for sentence in self.SENTENCE_BREAK.split(para):
+                tokens = count(sentence)
+                if tokens <= self.chunk_size:
+                    yield separator, sentence, tokens, location
+                else:
+                    yield from self._split_words(sentence, separator, location)
+                separator = ' '
+    
+    def _split_words(self, sentence: str, separator: str, location: Optional[Location]
+                     ) -> Iterator[Tuple[str, str, int, Optional[Location]]]:
+        """Split a sentence longer than a chunk into runs of whole words."""
+        count = self.tokenizer.count
+        words, tokens = [], 0
+        for word in sentence.split():
+            word_tokens = count(word)
+            if word_tokens > self.chunk_size:
+                # The word alone is over budget: emit it in pieces that
+                # are joined back without a separator
+                if words:
+                    yield separator, ' '.join(words), tokens, location
+                    separator = ' '
+                    words, tokens = [], 0
+                for piece in self.tokenizer.split(word, self.chunk_size):
+                    yield separator, piece, count(piece), location
+                    separator = ''
+                separator = ' '
+                continue
+            if words and tokens + word_tokens > self.chunk_size:
+                yield separator, ' '.join(words), tokens, location
+                separator = ' '
+                words, tokens = [], 0
+            words.append(word)
+            tokens += word_tokens
+        if words:
+            yield separator, ' '.join(words), tokens, location
+    
+    def _create_token_chunk(self, units: deque, tokens: int, index: int, metadata: Dict = None) -> Dict:
+        """Join units into a chunk dictionary that records its token count."""
+        text = units[0][1] + ''.join(unit[0] + unit[1] for unit in islice(units, 1, None))
+        chunk = self._create_chunk(text, index, metadata, [(0, units[0][3]), (0, units[-1][3])])
+        chunk['token_count'] = tokens
+        return chunk
@@ -0,0 +1,76 @@
+"""
+Compact encodings for embeddings stored in Firestore.
+Packs vectors into a bytes field instead of an array of doubles.
+"""
+
+from typing import List, Dict, Optional
+
+import numpy as np
+
+
+# 'array' keeps the legacy Firestore array-of-doubles format
+ENCODINGS = ('array', 'float32', 'float16', 'int8')
+
+_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float16': np.dtype('<f2'),
+    'int8': np.dtype('i1'),
+}
+
+
+def encode_embedding(embedding: List[float], encoding: str = 'array') -> Dict:
+    """
+    Encode an embedding into chunk document fields.
+
+    Args:
+        embedding: Embedding vector
+        encoding: One of ENCODINGS
+
+    Returns:
+        Fields to merge into the chunk document
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown embedding encoding: {encoding}")
+
+    if encoding == 'array' or embedding is None:
+        return {'embedding': list(embedding) if embedding is not None else None}
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    fields = {'embedding_encoding': encoding, 'embedding_dim': int(vector.shape[0])}
+
+    if encoding == 'int8':
+        # Symmetric per-vector quantization: value = code * scale
+        max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        codes = np.clip(np.rint(vector / scale), -127, 127)
+        fields['embedding_scale'] = scale
+        fields['embedding_bytes'] = codes.astype(_DTYPES['int8']).tobytes()
+    else:
+        fields['embedding_bytes'] = vector.astype(_DTYPES[encoding]).tobytes()
+
+    return fields
+
+
+def decode_embedding(chunk_data: Dict) -> Optional[np.ndarray]:
+    """
+    Decode the embedding of a chunk document, whatever its encoding.
+
+    Args:
+        chunk_data: Chunk document fields
+
+    Returns:
+        float32 vector, or None if the chunk has no embedding
+    """
+    encoding = chunk_data.get('embedding_encoding')
+    if not encoding:
+        embedding = chunk_data.get('embedding')
+        return np.asarray(embedding, dtype=np.float32) if embedding else None
+
+    raw = chunk_data.get('embedding_bytes')
+    if not raw or encoding not in _DTYPES:
+        return None
+
+    vector = np.frombuffer(raw, dtype=_DTYPES[encoding]).astype(np.float32)
+    if encoding == 'int8':
+        vector *= chunk_data.get('embedding_scale', 1.0)
+    return vector
@@ -1,11 +1,20 @@
 """
-Embedding utilities using Google Gemini.
+Embedding utilities using Google Gemini or a local sentence-transformers
+model, plus an offline stand-in embedder.
 """
 
 import os
+import re
 import sys
+import time
+import random
+import itertools
+import threading
+import hashlib
+import tempfile
 import google.generativeai as genai
-from typing import List, Dict
+from concurrent.futures import Future
+from typing import List, Dict, Optional
 import numpy as np
 
 # Add parent directory to path for imports
@@ -13,16 +22,310 @@ sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 )
 
+from lib.rag.vector_index import cosine_scores
+from lib.rag.cache import EmbeddingCache, ContentEmbeddingStore
+from lib.rag.executor import EmbeddingExecutor
+from lib.rag.tokenizer import RegexTokenizer, HuggingFaceTokenizer
 
-class GeminiEmbedder:
+
+# HTTP status codes worth retrying: rate limited or temporarily unavailable
+RETRYABLE_STATUS_CODES = {429, 500, 503, 504}
+
+
+class BaseEmbedder:
+    """
+    Shared batching, caching and retry logic for embedding backends.
+
+    Subclasses set MODEL, TASK_TYPE, DIMENSION and MAX_INPUT_TOKENS and
+    implement ``_embed_many``, which embeds one batch of texts in a single
+    request. ``tokenizer`` counts tokens the way the model does, as far as
+    it is known locally.
+    """
+
+    MODEL = ""
+    TASK_TYPE = "retrieval_document"
+    DIMENSION = 768
+
+    # Longest input the model embeds without truncating it
+    MAX_INPUT_TOKENS = 2048
+
+    # Largest number of texts sent in one batch request
+    MAX_BATCH_SIZE = 100
+
+    # Query similarity a platform docs chunk needs to be used as context.
+    # Score ranges differ between models, so each backend sets its own.
+    PLATFORM_DOCS_MIN_SCORE = 0.6
+
+    def __init__(
+        self,
+        query_cache_size: int = 1024,
+        query_cache_ttl: float = 24 * 3600,
+        query_cache_path: str = None,
+        chunk_cache_path: str = None,
+        max_concurrency: int = None,
+        max_retries: int = 5,
+        requests_per_second: float = None,
+    ):
+        """
+        Initialize embedder.
+
+        Args:
+            query_cache_size: Maximum number of cached query embeddings
+            query_cache_ttl: Seconds a cached query embedding stays valid
+            query_cache_path: Optional SQLite file backing the query cache
+                (or from env RAG_QUERY_CACHE_PATH)
+            chunk_cache_path: SQLite file of content-addressed chunk embeddings
+                (or from env RAG_CHUNK_CACHE_PATH, defaults to the temp dir)
+            max_concurrency: Maximum batch requests in flight at once
+                (or from env RAG_EMBED_MAX_IN_FLIGHT, default 4)
+            max_retries: Retries per batch on rate-limit or transient errors
+            requests_per_second: Token-bucket limit on API requests
+                (or from env RAG_EMBED_RPS, 0 disables limiting)
+        """
+        self.max_retries = max_retries
+        self.tokenizer = RegexTokenizer()
+        self.executor = EmbeddingExecutor(
+            max_in_flight=max_concurrency
+            or int(os.getenv("RAG_EMBED_MAX_IN_FLIGHT", "4")),
+            requests_per_second=requests_per_second
+            if requests_per_second is not None
+            else float(os.getenv("RAG_EMBED_RPS", "0")),
+        )
+
+        self.query_cache = EmbeddingCache(
+            max_size=query_cache_size,
+            ttl_seconds=query_cache_ttl,
+            persist_path=query_cache_path or os.getenv("RAG_QUERY_CACHE_PATH"),
+        )
+
+        chunk_cache_path = (
+            chunk_cache_path
+            or os.getenv("RAG_CHUNK_CACHE_PATH")
+            or os.path.join(tempfile.gettempdir(), "rag_cache", "chunk_embeddings.db")
+        )
+        try:
+            self.chunk_cache = ContentEmbeddingStore(chunk_cache_path)
+        except Exception as e:
+            print(f"Chunk embedding cache disabled: {str(e)}")
+            self.chunk_cache = None
+
+    def _embed_many(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed a batch of texts in one request. Implemented by subclasses."""
+        raise NotImplementedError
+
+    def embed_text(self, text: str, task_type: str = None) -> List[float]:
+        """
+        Generate embedding for a single text.
+
+        Args:
+            text: Text to embed
+            task_type: Task type (defaults to TASK_TYPE)
+
+        Returns:
+            Embedding vector as list of floats
+        """
+        try:
+            return self.executor.call(
+                self._embed_many, [text], task_type or self.TASK_TYPE
+            )[0]
+        except Exception as e:
+            raise Exception(f"Error generating embedding: {str(e)}")
+
+    def embed_query(self, text: str, task_type: str = None) -> List[float]:
+        """
+        Generate embedding for a search query, served from the query cache
+        when the same (normalised) question was embedded recently.
+
+        Args:
+            text: Query text
+            task_type: Task type (defaults to TASK_TYPE)
+
+        Returns:
+            Embedding vector as list of floats
+        """
+        task_type = task_type or self.TASK_TYPE
+        key = self._query_cache_key(text, task_type)
+
+        embedding = self.query_cache.get(key)
+        if embedding is None:
+            embedding = self.embed_text(text, task_type=task_type)
+            self.query_cache.put(key, embedding)
+        return embedding
+
+    def embed_batch(
+        self, texts: List[str], batch_size: Optional[int] = None
+    ) -> List[Optional[List[float]]]:
+        """
+        Generate embeddings for multiple texts.
+
+        Texts already embedded before (by content hash) are served from the
+        chunk cache. The rest are sent as multi-text batch requests through
+        the executor and results are returned in input order.
+
+        Args:
+            texts: List of texts to embed
+            batch_size: Number of texts per request (defaults to and is capped
+                at the backend's MAX_BATCH_SIZE)
+
+        Returns:
+            List of embedding vectors, with None for texts that failed
+        """
+        return self.embed_batch_async(texts, batch_size).result()
+
+    def embed_batch_async(
+        self, texts: List[str], batch_size: Optional[int] = None
+    ) -> Future:
+        """
+        Start embedding multiple texts without waiting for the results.
+
+        Args:
+            texts: List of texts to embed
+            batch_size: Number of texts per request (defaults to and is capped
+                at the backend's MAX_BATCH_SIZE)
+
+        Returns:
+            Future resolving to the list of embedding vectors, in input order,
+            with None for texts that failed
+        """
+        namespace = f"{self.MODEL}:{self.TASK_TYPE}"
+        hashes = [ContentEmbeddingStore.content_hash(text, namespace) for text in texts]
+        cached = self.chunk_cache.get_many(hashes) if self.chunk_cache else {}
+
+        # Embed each unseen text once, even if it repeats within the batch
+        pending = {}
+        for text, content_hash in zip(texts, hashes):
+            if content_hash not in cached:
+                pending.setdefault(content_hash, text)
+        pending_hashes = list(pending.keys())
+
+        if batch_size is None:
+            batch_size = self.MAX_BATCH_SIZE
+        batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        batches = [
+            pending_hashes[i : i + batch_size]
+            for i in range(0, len(pending_hashes), batch_size)
+        ]
+        futures = [
+            self.executor.submit(
+                self._embed_request, [pending[content_hash] for content_hash in batch]
+            )
+            for batch in batches
+        ]
+
+        result = Future()
+
+        def finish():
+            computed = {}
+            for batch, future in zip(batches, futures):
+                try:
+                    computed.update(zip(batch, future.result()))
+                except Exception as e:
+                    print(f"Error embedding batch of {len(batch)} texts: {str(e)}")
+
+            if self.chunk_cache:
+                self.chunk_cache.put_many(computed)
+
+            # Failed texts come back as None rather than a zero vector, so
+            # callers can queue them for retry instead of storing junk
+            return [
+                cached.get(content_hash) or computed.get(content_hash)
+                for content_hash in hashes
+            ]
+
+        def resolve():
+            try:
+                result.set_result(finish())
+            except Exception as e:
+                result.set_exception(e)
+
+        if not futures:
+            resolve()
+            return result
+
+        # Resolve from whichever request completes last, without a waiting thread
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                resolve()
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return result
+
+    def _embed_request(self, texts: List[str]) -> List[List[float]]:
+        """One throttled, timed batch request, retried on transient errors."""
+        return self._with_retries(
+            self.executor.call, self._embed_many, texts, self.TASK_TYPE
+        )
+
+    def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
+        """Calculate cosine similarity between two vectors."""
+        return float(cosine_scores(vec1, [vec2])[0])
+
+    def cosine_similarities(self, query: List[float], vectors) -> np.ndarray:
+        """
+        Calculate cosine similarity of one query against many vectors.
+
+        Args:
+            query: Query embedding vector
+            vectors: Matrix or list of embedding vectors
+
+        Returns:
+            Array of similarity scores, one per vector
+        """
+        return cosine_scores(query, vectors)
+
+    def _with_retries(self, func, *args):
+        """Call func, retrying rate-limit/transient errors with jittered backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = min(30.0, 2**attempt) * (0.5 + random.random())
+                print(f"Embedding request failed ({str(e)}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """Whether an API error is a rate limit or transient server error."""
+        code = getattr(error, "code", None)
+        code = getattr(code, "value", code)
+        if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+            return True
+        message = str(error).lower()
+        return any(
+            marker in message
+            for marker in ("429", "rate limit", "quota", "resource exhausted", "unavailable")
+        )
+
+    def _query_cache_key(self, text: str, task_type: str) -> str:
+        """Cache key from model, task type and case/whitespace-normalised text."""
+        normalized = re.sub(r"\s+", " ", text).strip().casefold()
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{self.MODEL}:{task_type}:{digest}"
+
+
+class GeminiEmbedder(BaseEmbedder):
     """Generate embeddings using Google Gemini."""
 
-    def __init__(self, api_key: str = None):
+    MODEL = "models/embedding-001"
+    TASK_TYPE = "retrieval_document"
+    DIMENSION = 768
+
+    def __init__(self, api_key: str = None, **kwargs):
         """
         Initialize Gemini embedder.
 
         Args:
             api_key: Google Gemini API key (or from env GEMINI_API_KEY / GOOGLE_API_KEY)
+            **kwargs: Cache, concurrency and retry options (see BaseEmbedder)
         """
         api_key = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
         if not api_key:
@@ -31,68 +334,198 @@ class GeminiEmbedder:
             )
 
         genai.configure(api_key=api_key)
+        super().__init__(**kwargs)
 
-    def embed_text(self, text: str) -> List[float]:
+    def embed_text(self, text: str, task_type: str = None) -> List[float]:
         """
         Generate embedding for a single text.
 
         Args:
             text: Text to embed
+            task_type: Gemini task type (defaults to TASK_TYPE)
 
         Returns:
             Embedding vector as list of floats
         """
         try:
-            result = genai.embed_content(
-                model="models/embedding-001",
+            result = self.executor.call(
+                genai.embed_content,
+                model=self.MODEL,
                 content=text,
-                task_type="retrieval_document",
+                task_type=task_type or self.TASK_TYPE,
                 title="Embedding of single text",
             )
             return result["embedding"]
         except Exception as e:
             raise Exception(f"Error generating embedding: {str(e)}")
 
-    def embed_batch(self, texts: List[str], batch_size: int = 10) -> List[List[float]]:
+    def _embed_many(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed texts with one batchEmbedContents request."""
+        # A list of contents makes the client issue a single batch request
+        result = genai.embed_content(
+            model=self.MODEL,
+            content=texts,
+            task_type=task_type,
+            title="Embedding of single text",
+        )
+        embeddings = result["embedding"]
+        if len(embeddings) != len(texts):
+            raise Exception(
+                f"Expected {len(texts)} embeddings, got {len(embeddings)}"
+            )
+        return embeddings
+
+
+class LocalEmbedder(BaseEmbedder):
+    """
+    Generate embeddings locally with a sentence-transformers model.
+
+    Runs batched inference on the CPU (or a GPU when ``device`` says so),
+    so indexing works offline and queries need no network round trip.
+    """
+
+    DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+    TASK_TYPE = "retrieval_document"
+
+    # No request overhead to amortise; larger batches just use more memory
+    MAX_BATCH_SIZE = 256
+
+    # MiniLM-class models score unrelated text near 0 and related text
+    # well below Gemini's range
+    PLATFORM_DOCS_MIN_SCORE = 0.35
+
+    def __init__(
+        self,
+        model_name: str = None,
+        device: str = None,
+        encode_batch_size: int = 64,
+        **kwargs,
+    ):
         """
-        Generate embeddings for multiple texts.
+        Initialize local embedder.
 
         Args:
-            texts: List of texts to embed
-            batch_size: Number of texts to process at once
-
-        Returns:
-            List of embedding vectors
+            model_name: sentence-transformers model name or path
+                (or from env RAG_LOCAL_EMBEDDING_MODEL)
+            device: Torch device such as 'cpu' or 'cuda'
+                (or from env RAG_LOCAL_EMBEDDING_DEVICE, auto-detected if unset)
+            encode_batch_size: Texts per forward pass
+            **kwargs: Cache, concurrency and retry options (see BaseEmbedder)
         """
-        embeddings = []
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(
+                "sentence-transformers is required for the local embedding backend"
+            )
 
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i : i + batch_size]
-            batch_embeddings = []
+        model_name = model_name or os.getenv(
+            "RAG_LOCAL_EMBEDDING_MODEL", self.DEFAULT_MODEL
+        )
+        self.model = SentenceTransformer(
+            model_name, device=device or os.getenv("RAG_LOCAL_EMBEDDING_DEVICE")
+        )
+        self.MODEL = f"local/{model_name}"
+        self.DIMENSION = self.model.get_sentence_embedding_dimension()
+        self.encode_batch_size = encode_batch_size
+
+        # Torch already spreads one batch over all cores, and local
+        # inference has no transient errors worth retrying
+        kwargs.setdefault(
+            "max_concurrency", int(os.getenv("RAG_EMBED_MAX_IN_FLIGHT", "1"))
+        )
+        kwargs.setdefault("max_retries", 0)
+        super().__init__(**kwargs)
+
+        # Count tokens with the model's own vocabulary, leaving room for
+        # the special tokens it adds around every input
+        self.tokenizer = HuggingFaceTokenizer(self.model.tokenizer, name=self.MODEL)
+        self.MAX_INPUT_TOKENS = self.model.max_seq_length - 2
+
+    def _embed_many(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed texts with batched forward passes."""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.encode_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        return embeddings.astype(np.float32).tolist()
 
-            for text in batch:
-                try:
-                    embedding = self.embed_text(text)
-                    batch_embeddings.append(embedding)
-                except Exception as e:
-                    print(f"Error embedding text: {str(e)}")
-                    # Use zero vector as fallback
-                    batch_embeddings.append([0.0] * 768)
 
-            embeddings.extend(batch_embeddings)
+class HashEmbedder(BaseEmbedder):
+    """
+    Offline stand-in embedder for tests and benchmarks.
 
+    Produces deterministic hashed bag-of-words vectors, so texts sharing
+    words are similar. ``latency`` simulates the round trip of one API
+    request and ``rate_limit_every`` makes every Nth request fail with a
+    429-style error to exercise the retry path.
+    """
+
+    MODEL = "local/hash-embedder"
+    TASK_TYPE = "retrieval_document"
+    DIMENSION = 768
+
+    # Bag-of-words vectors only score well above 0 when words are shared
+    PLATFORM_DOCS_MIN_SCORE = 0.2
+
+    def __init__(self, latency: float = 0.0, rate_limit_every: int = 0, **kwargs):
+        """
+        Initialize stand-in embedder.
+
+        Args:
+            latency: Seconds each request sleeps
+            rate_limit_every: Fail every Nth request with a rate-limit error (0 disables)
+            **kwargs: Cache, concurrency and retry options (see BaseEmbedder)
+        """
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self._requests = itertools.count(1)
+
+    def _embed_many(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Hash each word of each text into a fixed-size vector."""
+        request_number = next(self._requests)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_every and request_number % self.rate_limit_every == 0:
+            raise RateLimitError("429 Resource has been exhausted (simulated)")
+
+        embeddings = []
+        for text in texts:
+            vector = np.zeros(self.DIMENSION, dtype=np.float32)
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.DIMENSION
+                vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+            embeddings.append(vector.tolist())
         return embeddings
 
-    def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        """Calculate cosine similarity between two vectors."""
-        vec1 = np.array(vec1)
-        vec2 = np.array(vec2)
 
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
+class RateLimitError(Exception):
+    """Simulated HTTP 429 raised by HashEmbedder."""
+
+    code = 429
+
+
+def create_embedder(backend: str = None, api_key: str = None, **kwargs) -> BaseEmbedder:
+    """
+    Create an embedder by backend name.
 
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
+    Args:
+        backend: 'gemini' or 'local' (or from env RAG_EMBEDDING_BACKEND,
+            default 'gemini')
+        api_key: Gemini API key, used by the 'gemini' backend
+        **kwargs: Backend options (see GeminiEmbedder, LocalEmbedder)
 
-        return float(dot_product / (norm1 * norm2))
+    Returns:
+        Embedder instance
+    """
+    backend = backend or os.getenv("RAG_EMBEDDING_BACKEND", "gemini")
+    if backend == "gemini":
+        return GeminiEmbedder(api_key, **kwargs)
+    if backend == "local":
+        return LocalEmbedder(**kwargs)
+    raise ValueError(f"Unknown embedding backend: {backend}")
@@ -0,0 +1,176 @@
+"""
+Concurrent request execution for embedding backends.
+Provides a token-bucket rate limiter, latency histograms and a bounded
+thread-pool executor that combines them.
+"""
+
+import time
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Callable
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by all threads of an executor."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Initialize rate limiter.
+
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum burst size (defaults to rate, at least 1)
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """
+        Block until tokens are available and take them.
+
+        Returns:
+            Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with approximate percentiles."""
+
+    # Upper bounds in seconds; the last bucket catches everything slower
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BUCKETS) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """Record one observation."""
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self._count += 1
+            self._sum += seconds
+            self._max = max(self._max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket containing the given fraction of observations."""
+        with self._lock:
+            if not self._count:
+                return 0.0
+            target = fraction * self._count
+            seen = 0
+            for bound, count in zip(self.BUCKETS + (self._max,), self._counts):
+                seen += count
+                if seen >= target:
+                    return min(bound, self._max)
+            return self._max
+
+    def snapshot(self) -> Dict:
+        """Counts per bucket plus summary statistics."""
+        p50, p95, p99 = (self.percentile(f) for f in (0.5, 0.95, 0.99))
+        with self._lock:
+            labels = [f"le_{bound}" for bound in self.BUCKETS] + ["le_inf"]
+            return {
+                "count": self._count,
+                "mean": self._sum / self._count if self._count else 0.0,
+                "max": self._max,
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "buckets": dict(zip(labels, self._counts)),
+            }
+
+
+class EmbeddingExecutor:
+    """
+    Runs embedding requests on a bounded thread pool.
+
+    At most ``max_in_flight`` tasks run at once. Every request made through
+    ``call`` first takes a token from the optional rate limiter, which is
+    shared by all threads, and its latency (excluding time spent waiting for
+    a token) is recorded.
+    """
+
+    def __init__(self, max_in_flight: int = 4, requests_per_second: float = 0,
+                 burst: float = None):
+        """
+        Initialize executor.
+
+        Args:
+            max_in_flight: Maximum concurrent requests
+            requests_per_second: Rate limit (0 disables limiting)
+            burst: Token-bucket capacity (defaults to requests_per_second)
+        """
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.latency = LatencyHistogram()
+        self.throttle_wait = LatencyHistogram()
+        self.errors = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight,
+                                        thread_name_prefix="embedding")
+        self._lock = threading.Lock()
+
+    def submit(self, func: Callable, *args) -> Future:
+        """
+        Schedule a task on the pool.
+
+        Args:
+            func: Callable to run; it should make its requests via call()
+            *args: Arguments for func
+
+        Returns:
+            Future resolving to func's result
+        """
+        return self._pool.submit(func, *args)
+
+    def map(self, func: Callable, items: List) -> List:
+        """Run func over items concurrently and return results in order."""
+        return [future.result() for future in [self.submit(func, item) for item in items]]
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Throttle, time and run one request in the current thread."""
+        if self.rate_limiter:
+            self.throttle_wait.record(self.rate_limiter.acquire())
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            self.latency.record(time.perf_counter() - start)
+
+    def stats(self) -> Dict:
+        """Latency, throttling and error metrics."""
+        with self._lock:
+            errors = self.errors
+        return {
+            "max_in_flight": self.max_in_flight,
+            "rate_limit": self.rate_limiter.rate if self.rate_limiter else None,
+            "errors": errors,
+            "latency": self.latency.snapshot(),
+            "throttle_wait": self.throttle_wait.snapshot(),
+        }
+
+    def shutdown(self) -> None:
+        """Stop accepting work and wait for running requests."""
+        self._pool.shutdown(wait=True)
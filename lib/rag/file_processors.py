@@ -4,16 +4,47 @@ Supports PDF, DOCX, PPTX, and TXT files.
 """
 
 import os
-from typing import Dict, Optional
+import re
+import sys
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Dict, Optional, Iterator, Iterable, Tuple
 from io import BytesIO
 import PyPDF2
 from docx import Document
 from pptx import Presentation
 
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from lib.rag.cache import ExtractionCache
+from lib.pdf_worker import extract_pdf_range, iter_pdf_pages
+
+
+# Extraction pool shared by all documents, started on first use
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
 
 class FileProcessor:
     """Process various file formats and extract text."""
     
+    # PDFs with at least this many pages are extracted in parallel processes
+    PARALLEL_PDF_MIN_PAGES = int(os.getenv('RAG_PDF_PARALLEL_MIN_PAGES', '64'))
+    # Worker processes for parallel PDF extraction (defaults to the CPU count)
+    PDF_WORKERS = int(os.getenv('RAG_PDF_WORKERS', '0')) or os.cpu_count() or 1
+    # Pages extracted per worker task
+    PDF_PAGES_PER_TASK = 16
+    
+    # Marker heading each PDF page and PPTX slide section
+    SECTION_MARKER = re.compile(r'--- (Page|Slide) (\d+) ---\n')
+    
+    # Extraction cache shared by all callers (False once found unavailable)
+    _cache: Optional[ExtractionCache] = None
+    
     @staticmethod
     def process_file(file_path: str = None, file_content: bytes = None, 
                     file_name: str = None, mime_type: str = None) -> Dict:
@@ -33,12 +64,7 @@ class FileProcessor:
             return {'text': '', 'metadata': {}, 'error': 'No file provided'}
         
         # Determine file type
-        if file_name:
-            ext = os.path.splitext(file_name)[1].lower()
-        elif file_path:
-            ext = os.path.splitext(file_path)[1].lower()
-        else:
-            ext = FileProcessor._get_extension_from_mime(mime_type)
+        ext = FileProcessor._get_extension(file_name, file_path, mime_type)
         
         # Read file content if path provided
         if file_path and not file_content:
@@ -49,63 +75,261 @@ class FileProcessor:
                 return {'text': '', 'metadata': {'error': str(e)}, 'error': str(e)}
         
         # Process based on extension
+        result = FileProcessor._extract(file_content, file_name, ext)
+        try:
+            text = "\n\n".join(result['sections'])
+        except Exception as e:
+            return {
+                'text': '',
+                'metadata': {'file_name': file_name},
+                'error': f'Error processing file: {str(e)}'
+            }
+        
+        return {'text': text, 'metadata': result['metadata'], 'error': result['error']}
+    
+    @staticmethod
+    def stream_file(file_content: bytes, file_name: str = None,
+                    mime_type: str = None) -> Dict:
+        """
+        Open a file and extract its text lazily, one page or slide at a time.
+        
+        PDF pages and PPTX slides are extracted as the returned iterator is
+        consumed, so only the current page's text is held in memory. Other
+        formats are extracted up front as a single section.
+        
+        Args:
+            file_content: File content as bytes
+            file_name: Name of the file
+            mime_type: MIME type of the file
+            
+        Returns:
+            Dictionary with 'sections' (iterator of text sections which,
+            joined by blank lines, equal process_file's 'text'), 'metadata',
+            and 'error' fields
+        """
+        ext = FileProcessor._get_extension(file_name, None, mime_type)
+        return FileProcessor._extract(file_content, file_name, ext)
+    
+    @staticmethod
+    def iter_segments(sections: Iterable[str]) -> Iterator[Tuple[Optional[Tuple[str, int]], str]]:
+        """
+        Split the page or slide marker off each section.
+        
+        Args:
+            sections: Sections from stream_file
+            
+        Returns:
+            Iterator of (location, text) pairs, where location is e.g.
+            ('page', 3) or ('slide', 2), or None for unmarked sections
+        """
+        for section in sections:
+            match = FileProcessor.SECTION_MARKER.match(section)
+            if match:
+                yield (match.group(1).lower(), int(match.group(2))), section[match.end():]
+            else:
+                yield None, section
+    
+    @staticmethod
+    def _extract(content: bytes, file_name: str, ext: str) -> Dict:
+        """
+        Extract sections, served from the extraction cache when the same
+        file bytes were extracted before.
+        """
+        cache = FileProcessor._get_cache()
+        key = ExtractionCache.content_key(content, ext) if cache else None
+        
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            metadata, sections = cached
+            return {
+                'sections': sections,
+                'metadata': {**metadata, 'file_name': file_name},
+                'error': None
+            }
+        
+        result = FileProcessor._extract_uncached(content, file_name, ext)
+        if cache and not result['error']:
+            result['sections'] = cache.cache_stream(key, result['metadata'], result['sections'])
+        return result
+    
+    @staticmethod
+    def _extract_uncached(content: bytes, file_name: str, ext: str) -> Dict:
+        """Open a file and return its (lazy, for PDF and PPTX) text sections."""
+        if ext == '.pdf':
+            try:
+                pdf_reader = PyPDF2.PdfReader(BytesIO(content))
+                return {
+                    'sections': FileProcessor._iter_pdf_sections(pdf_reader, content),
+                    'metadata': {
+                        'file_name': file_name,
+                        'file_type': 'pdf',
+                        'num_pages': len(pdf_reader.pages)
+                    },
+                    'error': None
+                }
+            except Exception as e:
+                return {
+                    'sections': iter(()),
+                    'metadata': {'file_name': file_name, 'file_type': 'pdf'},
+                    'error': f'PDF processing error: {str(e)}'
+                }
+        
+        if ext in ['.pptx', '.ppt']:
+            try:
+                prs = Presentation(BytesIO(content))
+                return {
+                    'sections': FileProcessor._iter_pptx_slides(prs),
+                    'metadata': {
+                        'file_name': file_name,
+                        'file_type': 'pptx',
+                        'num_slides': len(prs.slides)
+                    },
+                    'error': None
+                }
+            except Exception as e:
+                return {
+                    'sections': iter(()),
+                    'metadata': {'file_name': file_name, 'file_type': 'pptx'},
+                    'error': f'PPTX processing error: {str(e)}'
+                }
+        
         try:
-            if ext == '.pdf':
-                return FileProcessor._process_pdf(file_content, file_name)
-            elif ext in ['.docx', '.doc']:
-                return FileProcessor._process_docx(file_content, file_name)
-            elif ext in ['.pptx', '.ppt']:
-                return FileProcessor._process_pptx(file_content, file_name)
+            if ext in ['.docx', '.doc']:
+                result = FileProcessor._process_docx(content, file_name)
             elif ext == '.txt':
-                return FileProcessor._process_txt(file_content, file_name)
+                result = FileProcessor._process_txt(content, file_name)
             else:
                 return {
-                    'text': '',
+                    'sections': iter(()),
                     'metadata': {'file_name': file_name, 'extension': ext},
                     'error': f'Unsupported file type: {ext}'
                 }
         except Exception as e:
             return {
-                'text': '',
+                'sections': iter(()),
                 'metadata': {'file_name': file_name},
                 'error': f'Error processing file: {str(e)}'
             }
+        
+        return {
+            'sections': iter([result['text']] if result['text'] else []),
+            'metadata': result['metadata'],
+            'error': result['error']
+        }
+    
+    @classmethod
+    def _get_cache(cls) -> Optional[ExtractionCache]:
+        """Get the shared extraction cache, or None if it is disabled or unavailable."""
+        if cls._cache is None:
+            max_mb = float(os.getenv('RAG_EXTRACTION_CACHE_MAX_MB', '512'))
+            path = os.getenv('RAG_EXTRACTION_CACHE_PATH') or \
+                os.path.join(tempfile.gettempdir(), 'rag_cache', 'extractions.db')
+            try:
+                cls._cache = ExtractionCache(path, int(max_mb * 1024 * 1024)) if max_mb > 0 else False
+            except Exception as e:
+                print(f"Extraction cache disabled: {str(e)}")
+                cls._cache = False
+        return cls._cache or None
     
     @staticmethod
-    def _process_pdf(content: bytes, file_name: str = None) -> Dict:
-        """Extract text from PDF file."""
-        try:
-            pdf_file = BytesIO(content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+    def _iter_pptx_slides(prs) -> Iterator[str]:
+        """Yield the text of each non-empty slide with its slide marker."""
+        for slide_num, slide in enumerate(prs.slides):
+            slide_text = []
+            slide_text.append(f"--- Slide {slide_num + 1} ---")
             
-            text_parts = []
-            num_pages = len(pdf_reader.pages)
+            # Extract text from shapes
+            for shape in slide.shapes:
+                if hasattr(shape, "text") and shape.text.strip():
+                    slide_text.append(shape.text)
             
-            for page_num, page in enumerate(pdf_reader.pages):
+            if len(slide_text) > 1:  # More than just the header
+                yield "\n".join(slide_text)
+    
+    @staticmethod
+    def _iter_pdf_sections(pdf_reader, content: bytes) -> Iterator[str]:
+        """Extract PDF pages in parallel processes if the PDF is large, else in-process."""
+        num_pages = len(pdf_reader.pages)
+        if FileProcessor.PDF_WORKERS > 1 and num_pages >= FileProcessor.PARALLEL_PDF_MIN_PAGES:
+            return FileProcessor._iter_pdf_pages_parallel(content, num_pages)
+        return FileProcessor._iter_pdf_pages(pdf_reader)
+    
+    @staticmethod
+    def _iter_pdf_pages(pdf_reader, start: int = 0, stop: int = None) -> Iterator[str]:
+        """Yield the text of each non-empty PDF page with its page marker."""
+        return iter_pdf_pages(pdf_reader, start, stop)
+    
+    @staticmethod
+    def _iter_pdf_pages_parallel(content: bytes, num_pages: int) -> Iterator[str]:
+        """
+        Extract page ranges in the process pool and yield pages in order.
+        
+        Only a few ranges per worker are in flight at a time, so memory
+        stays bounded when the consumer is slower than extraction. Ranges
+        whose worker fails are extracted in-process instead.
+        """
+        step = FileProcessor.PDF_PAGES_PER_TASK
+        ranges = [(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+        fallback_reader = None
+        
+        def collect(page_range, future):
+            nonlocal fallback_reader
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Error extracting pages {page_range[0] + 1}-{page_range[1]} "
+                      f"in worker, retrying in-process: {str(e)}")
+                if fallback_reader is None:
+                    fallback_reader = PyPDF2.PdfReader(BytesIO(content))
+                return list(FileProcessor._iter_pdf_pages(fallback_reader, *page_range))
+        
+        # Workers read the PDF from a file rather than receiving it with every task
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+            pdf_file.write(content)
+        
+        pending = deque()
+        try:
+            for page_range in ranges:
                 try:
-                    text = page.extract_text()
-                    if text:
-                        text_parts.append(f"--- Page {page_num + 1} ---\n{text}")
+                    future = FileProcessor._get_pdf_pool().submit(
+                        extract_pdf_range, pdf_file.name, *page_range)
                 except Exception as e:
-                    print(f"Error extracting page {page_num + 1}: {str(e)}")
-            
-            full_text = "\n\n".join(text_parts)
-            
-            return {
-                'text': full_text,
-                'metadata': {
-                    'file_name': file_name,
-                    'file_type': 'pdf',
-                    'num_pages': num_pages
-                },
-                'error': None
-            }
-        except Exception as e:
-            return {
-                'text': '',
-                'metadata': {'file_name': file_name, 'file_type': 'pdf'},
-                'error': f'PDF processing error: {str(e)}'
-            }
+                    # e.g. the pool broke after a worker died
+                    FileProcessor._reset_pdf_pool()
+                    future = Future()
+                    future.set_exception(e)
+                pending.append((page_range, future))
+                if len(pending) >= 2 * FileProcessor.PDF_WORKERS:
+                    yield from collect(*pending.popleft())
+            while pending:
+                yield from collect(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+            try:
+                os.remove(pdf_file.name)
+            except OSError:
+                pass
+    
+    @staticmethod
+    def _get_pdf_pool() -> ProcessPoolExecutor:
+        """Get the shared extraction pool, starting it if needed."""
+        global _pdf_pool
+        with _pdf_pool_lock:
+            if _pdf_pool is None:
+                # Spawn rather than fork: forking a threaded server (Flask, gRPC) is unsafe
+                _pdf_pool = ProcessPoolExecutor(max_workers=FileProcessor.PDF_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            return _pdf_pool
+    
+    @staticmethod
+    def _reset_pdf_pool() -> None:
+        """Discard a broken extraction pool so the next PDF starts a new one."""
+        global _pdf_pool
+        with _pdf_pool_lock:
+            if _pdf_pool is not None:
+                _pdf_pool.shutdown(wait=False, cancel_futures=True)
+                _pdf_pool = None
     
     @staticmethod
     def _process_docx(content: bytes, file_name: str = None) -> Dict:
@@ -148,45 +372,6 @@ class FileProcessor:
                 'error': f'DOCX processing error: {str(e)}'
             }
     
-    @staticmethod
-    def _process_pptx(content: bytes, file_name: str = None) -> Dict:
-        """Extract text from PPTX file."""
-        try:
-            pptx_file = BytesIO(content)
-            prs = Presentation(pptx_file)
-            
-            text_parts = []
-            
-            for slide_num, slide in enumerate(prs.slides):
-                slide_text = []
-                slide_text.append(f"--- Slide {slide_num + 1} ---")
-                
-                # Extract text from shapes
-                for shape in slide.shapes:
-                    if hasattr(shape, "text") and shape.text.strip():
-                        slide_text.append(shape.text)
-                
-                if len(slide_text) > 1:  # More than just the header
-                    text_parts.append("\n".join(slide_text))
-            
-            full_text = "\n\n".join(text_parts)
-            
-            return {
-                'text': full_text,
-                'metadata': {
-                    'file_name': file_name,
-                    'file_type': 'pptx',
-                    'num_slides': len(prs.slides)
-                },
-                'error': None
-            }
-        except Exception as e:
-            return {
-                'text': '',
-                'metadata': {'file_name': file_name, 'file_type': 'pptx'},
-                'error': f'PPTX processing error: {str(e)}'
-            }
-    
     @staticmethod
     def _process_txt(content: bytes, file_name: str = None) -> Dict:
         """Extract text from TXT file."""
@@ -212,6 +397,16 @@ class FileProcessor:
                 'error': f'TXT processing error: {str(e)}'
             }
     
+    @staticmethod
+    def _get_extension(file_name: str = None, file_path: str = None,
+                       mime_type: str = None) -> str:
+        """Get the lower-case file extension from the name, path or MIME type."""
+        if file_name:
+            return os.path.splitext(file_name)[1].lower()
+        if file_path:
+            return os.path.splitext(file_path)[1].lower()
+        return FileProcessor._get_extension_from_mime(mime_type)
+    
     @staticmethod
     def _get_extension_from_mime(mime_type: str) -> str:
         """Get file extension from MIME type."""
@@ -0,0 +1,211 @@
+"""
+Durable background jobs for document indexing.
+Jobs are kept in a SQLite file, so they run without external services,
+survive restarts and can be polled from any worker process.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Callable
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue served by a local pool of worker threads.
+
+    ``handler(job, data, update)`` does the work of one job: ``data`` is the
+    input bytes given to ``submit`` and ``update(stage=..., chunks_indexed=...)``
+    records progress. Its return value is stored as the job result; an
+    exception marks the job failed.
+
+    Workers claim queued jobs atomically, so several processes can share
+    one queue file.
+    """
+
+    # Seconds without a progress update after which a running job is
+    # assumed to belong to a dead worker and is queued again
+    STALE_SECONDS = 600
+    # Seconds finished jobs are kept for status polling
+    RETENTION_SECONDS = 7 * 24 * 3600
+
+    # Columns that update() may set
+    PROGRESS_FIELDS = ('stage', 'chunks_indexed')
+
+    def __init__(self, handler: Callable, path: str = None, workers: int = None,
+                 poll_interval: float = 1.0):
+        """
+        Initialize job queue.
+
+        Args:
+            handler: Function running one job (see class docstring)
+            path: SQLite file (or from env RAG_JOB_DB_PATH, defaults to the temp dir)
+            workers: Worker threads (or from env RAG_JOB_WORKERS, default 2)
+            poll_interval: Seconds idle workers wait before checking for jobs
+        """
+        self.handler = handler
+        self.path = path or os.getenv('RAG_JOB_DB_PATH') or \
+            os.path.join(tempfile.gettempdir(), 'rag_jobs', 'jobs.db')
+        self.workers = workers or int(os.getenv('RAG_JOB_WORKERS', '2'))
+        self.poll_interval = poll_interval
+
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs '
+                '(id TEXT PRIMARY KEY, user_id TEXT, status TEXT, stage TEXT, '
+                'chunks_indexed INTEGER, payload TEXT, result TEXT, error TEXT, '
+                'data BLOB, created_at REAL, updated_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+
+    def start(self) -> None:
+        """Requeue abandoned jobs, drop expired ones and start the workers."""
+        with self._lock:
+            if self._threads:
+                return
+            now = time.time()
+            with self._connect() as conn:
+                self._requeue_stale(conn, now)
+                conn.execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                    (now - self.RETENTION_SECONDS,)
+                )
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'rag-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, user_id: str, payload: Dict, data: bytes = None) -> str:
+        """
+        Queue a job.
+
+        Args:
+            user_id: Owner of the job
+            payload: JSON-serialisable job parameters
+            data: Input bytes, kept until the job finishes
+
+        Returns:
+            Job ID
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, user_id, status, stage, chunks_indexed, payload, '
+                'data, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, user_id, 'queued', 'queued', 0, json.dumps(payload),
+                 sqlite3.Binary(data) if data is not None else None, now, now)
+            )
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """
+        Get a job's status.
+
+        Returns:
+            Job dictionary without its input bytes, or None if not found
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT id, user_id, status, stage, chunks_indexed, payload, result, error, '
+                'created_at, updated_at FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'] or '{}')
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def update(self, job_id: str, **fields) -> None:
+        """Record progress of a running job (also serves as its heartbeat)."""
+        unknown = set(fields) - set(self.PROGRESS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        self._set(job_id, **fields)
+
+    def _work(self) -> None:
+        """Worker loop: claim and run jobs until the process exits."""
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _claim(self) -> Optional[Dict]:
+        """
+        Atomically mark the oldest queued job running and return it with its data.
+
+        Running jobs whose worker stopped sending progress are queued again
+        first, so they are picked up without waiting for a restart.
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._requeue_stale(conn, time.time())
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                (time.time(), row['id'])
+            )
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'] or '{}')
+        return job
+
+    def _requeue_stale(self, conn, now: float) -> None:
+        """Queue again the running jobs without progress for STALE_SECONDS."""
+        conn.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND updated_at < ?",
+            (now - self.STALE_SECONDS,)
+        )
+
+    def _run(self, job: Dict) -> None:
+        """Run one claimed job and record its outcome."""
+        job_id = job['id']
+        data = job.pop('data')
+        try:
+            result = self.handler(job, data, lambda **fields: self.update(job_id, **fields))
+            self._set(job_id, status='done', stage='done',
+                      result=json.dumps(result, default=str), data=None)
+        except Exception as e:
+            print(f"Error running job {job_id}: {str(e)}")
+            self._set(job_id, status='failed', error=str(e), data=None)
+
+    def _set(self, job_id: str, **fields) -> None:
+        """Update columns of a job and its updated_at timestamp."""
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?',
+                         (*fields.values(), job_id))
+
+    @contextmanager
+    def _connect(self):
+        """Open a short-lived SQLite connection that commits on success."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
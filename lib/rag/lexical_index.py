@@ -0,0 +1,134 @@
+"""
+In-memory lexical index for RAG retrieval.
+Implements Okapi BM25 over an inverted index of chunk terms, to find exact
+terms (standard codes, vocabulary words, names) that embeddings blur.
+"""
+
+import math
+import re
+import heapq
+import threading
+from collections import Counter
+from typing import List, Dict, Iterable, Tuple
+
+
+# Words and codes such as "hs-ls1-5" or "3.2", lower-cased
+TOKEN = re.compile(r'[a-z0-9]+(?:[-.][a-z0-9]+)*')
+# Codes only, whose parts are indexed as well
+COMPOUND = re.compile(r'(?<![a-z0-9])[a-z0-9]+(?:[-.][a-z0-9]+)+')
+
+# Words too common to tell chunks apart; skipping them keeps postings short
+STOPWORDS = frozenset('''
+    a an and are as at be but by can do does for from has have how i if in
+    into is it its me my of on or our so than that the their them then there
+    these they this to was we were what when where which who why will with
+    you your
+'''.split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into index terms.
+
+    Codes joined by hyphens or dots are kept whole and also split into
+    their parts, so "HS-LS1-5" matches both the exact code and "LS1".
+    """
+    text = text.lower()
+    terms = [token for token in TOKEN.findall(text) if token not in STOPWORDS]
+    for code in COMPOUND.findall(text):
+        terms.extend(part for part in re.split(r'[-.]', code) if part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """
+    Inverted index of chunk terms scored with Okapi BM25.
+
+    Postings map each term to the chunks containing it and how often, so a
+    query only touches the chunks that share at least one of its terms.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        """
+        Initialize index.
+
+        Args:
+            k1: Term frequency saturation
+            b: Strength of document length normalisation
+        """
+        self.k1 = k1
+        self.b = b
+
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._lengths: Dict[str, int] = {}
+        self._terms: Dict[str, List[str]] = {}  # Distinct terms of each chunk
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add_many(self, chunks: Iterable[Tuple[str, str]]) -> None:
+        """
+        Add or replace chunks.
+
+        Args:
+            chunks: (chunk ID, text) pairs
+        """
+        with self._lock:
+            for chunk_id, text in chunks:
+                if chunk_id in self._lengths:
+                    self._remove(chunk_id)
+                terms = tokenize(text or '')
+                frequencies = Counter(terms)
+                for term, frequency in frequencies.items():
+                    self._postings.setdefault(term, {})[chunk_id] = frequency
+                self._terms[chunk_id] = list(frequencies)
+                self._lengths[chunk_id] = len(terms)
+                self._total_length += len(terms)
+
+    def remove(self, chunk_id: str) -> None:
+        """Remove a chunk if it is indexed."""
+        with self._lock:
+            if chunk_id in self._lengths:
+                self._remove(chunk_id)
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[str, float]]:
+        """
+        Find the chunks that best match the query terms.
+
+        Args:
+            query: Query text
+            top_k: Number of results to return
+
+        Returns:
+            (chunk ID, BM25 score) pairs, best first
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            if not self._lengths or not terms:
+                return []
+            count = len(self._lengths)
+            average_length = self._total_length / count or 1.0
+
+            scores: Dict[str, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + \
+                        idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def _remove(self, chunk_id: str) -> None:
+        """Drop a chunk's postings. Callers hold the lock."""
+        self._total_length -= self._lengths.pop(chunk_id)
+        for term in self._terms.pop(chunk_id):
+            postings = self._postings[term]
+            del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
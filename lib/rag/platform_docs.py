@@ -0,0 +1,149 @@
+"""
+In-memory embedding index of the platform documentation.
+The docs file is chunked and embedded once, searched by similarity with the
+query embedding, and reloaded when the file changes on disk.
+"""
+
+import os
+import re
+import time
+import threading
+from typing import List, Dict, Optional
+
+from lib.rag.chunking import TextChunker
+from lib.rag.vector_index import IVFIndex
+
+
+DEFAULT_DOCS_PATH = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "docs", "platform_docs.txt"
+    )
+)
+
+
+class PlatformDocsIndex:
+    """
+    Similarity search over the platform documentation.
+
+    The file is split on its '---' separator lines into sections, which
+    are chunked without spanning two sections, embedded in one batch and
+    held in an IVFIndex. Searches never touch the disk: the file's mtime
+    is checked at most every ``check_interval`` seconds, and a changed
+    file is re-indexed in a background thread while searches keep using
+    the previous index.
+    """
+
+    # Lines separating the sections of the docs file
+    SECTION_SEPARATOR = re.compile(r"^---$", re.MULTILINE)
+
+    def __init__(
+        self,
+        embedder,
+        path: str = None,
+        chunker: TextChunker = None,
+        check_interval: float = None,
+    ):
+        """
+        Initialize and load the index.
+
+        Args:
+            embedder: Embedder the queries are embedded with
+            path: Docs file (or from env RAG_PLATFORM_DOCS_PATH, defaults to
+                docs/platform_docs.txt)
+            chunker: Chunker for long sections
+            check_interval: Seconds between mtime checks (or from env
+                RAG_PLATFORM_DOCS_CHECK_SECONDS, default 5; 0 checks on
+                every search)
+        """
+        self.embedder = embedder
+        self.path = path or os.getenv("RAG_PLATFORM_DOCS_PATH") or DEFAULT_DOCS_PATH
+        self.chunker = chunker or TextChunker(chunk_size=1000, chunk_overlap=200)
+        self.check_interval = (
+            check_interval
+            if check_interval is not None
+            else float(os.getenv("RAG_PLATFORM_DOCS_CHECK_SECONDS", "5"))
+        )
+
+        self._index = IVFIndex()
+        self._mtime: Optional[float] = None
+        self._checked_at = time.time()
+        self._lock = threading.Lock()
+        self._loading = False
+        self._reload_safely()
+
+    def search(
+        self, query_embedding: List[float], top_k: int = 3, min_score: float = 0.0
+    ) -> List[Dict]:
+        """
+        Find the docs chunks most similar to a query.
+
+        Args:
+            query_embedding: Query embedding vector
+            top_k: Number of chunks to return
+            min_score: Minimum similarity score
+
+        Returns:
+            List of chunks with 'text' and 'score' fields, best first
+        """
+        self._maybe_reload()
+        return self._index.search(query_embedding, top_k=top_k, min_score=min_score)
+
+    def reload(self) -> bool:
+        """
+        Re-index the docs file if it changed since it was last indexed.
+
+        Returns:
+            True if the index was rebuilt
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+
+        index = IVFIndex()
+        if mtime is not None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                sections = self.SECTION_SEPARATOR.split(f.read())
+            chunks = list(
+                self.chunker.chunk_segments(
+                    ((None, section) for section in sections), separate=True
+                )
+            )
+            embeddings = self.embedder.embed_batch([chunk["text"] for chunk in chunks])
+            if any(embedding is None for embedding in embeddings):
+                raise Exception("Could not embed all platform docs chunks")
+            index.add_many(
+                [str(i) for i in range(len(chunks))],
+                embeddings,
+                [{"text": chunk["text"]} for chunk in chunks],
+            )
+
+        self._index = index
+        self._mtime = mtime
+        print(f"Indexed platform docs: {len(index)} chunks from {self.path}")
+        return True
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _maybe_reload(self) -> None:
+        """Start a background reload if the check interval has passed."""
+        now = time.time()
+        with self._lock:
+            if self._loading or now - self._checked_at < self.check_interval:
+                return
+            self._loading = True
+            self._checked_at = now
+        threading.Thread(target=self._reload_safely, daemon=True).start()
+
+    def _reload_safely(self) -> None:
+        """Reload, keeping the previous index on failure until the next check."""
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"Error loading platform docs: {str(e)}")
+        finally:
+            with self._lock:
+                self._loading = False
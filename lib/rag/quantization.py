@@ -0,0 +1,192 @@
+"""
+Vector quantizers for compact in-memory retrieval indexes.
+Implements int8 scalar quantization (SQ8) and product quantization (PQ).
+"""
+
+from typing import List, Dict
+
+import numpy as np
+
+
+# Rows converted per step when scoring, to bound temporary memory
+SCORE_BLOCK_SIZE = 16384
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension 8-bit scalar quantizer.
+
+    Each dimension is mapped linearly from its trained [min, max] range onto
+    256 levels, so a 768-dim float32 vector shrinks from 3072 to 768 bytes.
+    """
+
+    def __init__(self):
+        self.minimum = None
+        self.step = None
+
+    @property
+    def code_size(self) -> int:
+        """Bytes per encoded vector."""
+        return len(self.minimum)
+
+    def train(self, data: np.ndarray) -> None:
+        """Learn the value range of each dimension."""
+        self.minimum = data.min(axis=0).astype(np.float32)
+        span = data.max(axis=0) - self.minimum
+        self.step = np.where(span > 0, span / 255.0, 1.0).astype(np.float32)
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        """Encode vectors to uint8 codes."""
+        codes = np.rint((data - self.minimum) / self.step)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Reconstruct approximate vectors from codes."""
+        return codes.astype(np.float32) * self.step + self.minimum
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Approximate inner products of the query with encoded vectors."""
+        # q . (min + code * step) = q . min + code . (q * step)
+        weights = query * self.step
+        offset = float(query @ self.minimum)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_SIZE):
+            block = codes[start:start + SCORE_BLOCK_SIZE]
+            scores[start:start + len(block)] = block.astype(np.float32) @ weights + offset
+        return scores
+
+
+class ProductQuantizer:
+    """
+    Product quantizer with 8-bit codes per subspace.
+
+    Vectors are split into ``n_subspaces`` slices and each slice is replaced
+    by the index of its nearest of 256 trained centroids. Scoring uses a
+    per-query lookup table (asymmetric distance computation).
+    """
+
+    def __init__(self, n_subspaces: int, n_centroids: int = 256,
+                 iterations: int = 8):
+        """
+        Initialize quantizer.
+
+        Args:
+            n_subspaces: Number of slices; must divide the dimension
+            n_centroids: Centroids per slice (at most 256)
+            iterations: k-means iterations per slice
+        """
+        if not 1 <= n_centroids <= 256:
+            raise ValueError("n_centroids must be between 1 and 256")
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.iterations = iterations
+        self.codebooks = None
+
+    @property
+    def code_size(self) -> int:
+        """Bytes per encoded vector."""
+        return self.n_subspaces
+
+    def train(self, data: np.ndarray) -> None:
+        """Learn a codebook for each subspace with k-means."""
+        dim = data.shape[1]
+        if dim % self.n_subspaces:
+            raise ValueError(
+                f"Dimension {dim} is not divisible by {self.n_subspaces} subspaces"
+            )
+        sub_dim = dim // self.n_subspaces
+        rng = np.random.default_rng(0)
+        # A couple of dozen points per centroid is enough to train on
+        if len(data) > 24 * self.n_centroids:
+            data = data[rng.choice(len(data), 24 * self.n_centroids, replace=False)]
+        n_centroids = min(self.n_centroids, len(data))
+
+        codebooks = np.empty((self.n_subspaces, n_centroids, sub_dim), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            sub = np.ascontiguousarray(data[:, j * sub_dim:(j + 1) * sub_dim], dtype=np.float32)
+            centroids = sub[rng.choice(len(sub), n_centroids, replace=False)].copy()
+            for _ in range(self.iterations):
+                labels = self._nearest(sub, centroids)
+                order = np.argsort(labels, kind='stable')
+                present, starts, counts = np.unique(labels[order], return_index=True,
+                                                    return_counts=True)
+                sums = np.add.reduceat(sub[order], starts, axis=0)
+                centroids[present] = sums / counts[:, None]
+            codebooks[j] = centroids
+        self.codebooks = codebooks
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        """Encode vectors to (n x n_subspaces) uint8 codes."""
+        sub_dim = self.codebooks.shape[2]
+        codes = np.empty((len(data), self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            sub = data[:, j * sub_dim:(j + 1) * sub_dim]
+            codes[:, j] = self._nearest(sub, self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Reconstruct approximate vectors from codes."""
+        parts = [self.codebooks[j][codes[:, j]] for j in range(self.n_subspaces)]
+        return np.concatenate(parts, axis=1)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Approximate inner products of the query with encoded vectors."""
+        sub_dim = self.codebooks.shape[2]
+        # lut[j, k] = query slice j . centroid k of subspace j
+        lut = np.einsum('jkd,jd->jk', self.codebooks,
+                        query.reshape(self.n_subspaces, sub_dim))
+        subspaces = np.arange(self.n_subspaces)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_SIZE):
+            block = codes[start:start + SCORE_BLOCK_SIZE]
+            scores[start:start + len(block)] = lut[subspaces, block].sum(axis=1)
+        return scores
+
+    @staticmethod
+    def _nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Index of the nearest centroid (L2) for each row."""
+        # argmin ||x - c||^2 == argmax (2 x.c - ||c||^2)
+        return np.argmax(2 * data @ centroids.T - (centroids ** 2).sum(axis=1), axis=1)
+
+
+def create_quantizer(kind: str, dimension: int):
+    """
+    Create a quantizer by name.
+
+    Args:
+        kind: 'none', 'sq8' or 'pq'
+        dimension: Embedding dimension
+
+    Returns:
+        Quantizer instance, or None for 'none'
+    """
+    if kind in (None, '', 'none'):
+        return None
+    if kind == 'sq8':
+        return ScalarQuantizer()
+    if kind == 'pq':
+        # 4 dims per byte: 16x smaller than float32
+        n_subspaces = dimension // 4 if dimension % 4 == 0 else dimension
+        return ProductQuantizer(n_subspaces)
+    raise ValueError(f"Unknown quantization: {kind}")
+
+
+def recall_at_k(exact_results: List[List[Dict]], approx_results: List[List[Dict]]) -> float:
+    """
+    Fraction of exact top-k results that the approximate search also returned.
+
+    Args:
+        exact_results: Exhaustive search results per query
+        approx_results: Approximate search results per query
+
+    Returns:
+        Mean recall@k over the queries
+    """
+    recalls = []
+    for exact, approx in zip(exact_results, approx_results):
+        if not exact:
+            continue
+        expected = {result['id'] for result in exact}
+        found = {result['id'] for result in approx}
+        recalls.append(len(expected & found) / len(expected))
+    return float(np.mean(recalls)) if recalls else 1.0
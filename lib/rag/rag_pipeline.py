@@ -4,16 +4,22 @@ Main RAG pipeline for processing queries and generating responses.
 
 import os
 import sys
-from typing import List, Dict, Optional
+import hashlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from typing import List, Dict, Iterable, Optional, Callable, Union
 
 # Add parent directory to path for imports
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 )
 
-from lib.rag.chunking import TextChunker
-from lib.rag.embeddings import GeminiEmbedder
+from lib.rag.chunking import TextChunker, TokenChunker
+from lib.rag.embeddings import create_embedder
 from lib.rag.vector_store import FirestoreVectorStore
+from lib.rag.retry_queue import EmbeddingRetryQueue
+from lib.rag.platform_docs import PlatformDocsIndex
 from lib.rag.prompts import (
     format_qa_prompt,
     format_material_prompt,
@@ -25,17 +31,54 @@ import google.generativeai as genai
 class RAGPipeline:
     """Main RAG pipeline for teacher chatbot."""
 
-    def __init__(self, gemini_api_key: str = None):
+    # Chunks per embedding request / Firestore write during indexing
+    EMBED_GROUP_SIZE = 100
+    # Groups whose embeddings may be pending before indexing waits for one
+    MAX_GROUPS_IN_FLIGHT = 8
+    # Candidates ranked per requested chunk when filling a token budget
+    CONTEXT_CANDIDATE_FACTOR = 4
+    # Separates retrieved chunks in the prompt context
+    CONTEXT_SEPARATOR = "\n\n---\n\n"
+    # Merge BM25 matches on the question's terms into vector search results
+    HYBRID_SEARCH = os.getenv("RAG_HYBRID_SEARCH", "1") == "1"
+    # Only score BM25 candidates against the query embedding when there are
+    # enough of them (faster, but misses chunks sharing no query term)
+    LEXICAL_PREFILTER = os.getenv("RAG_LEXICAL_PREFILTER", "0") == "1"
+    # Results taken from each retriever per chunk requested, before fusion
+    HYBRID_CANDIDATE_FACTOR = 4
+    # Rank constant of reciprocal rank fusion; larger values flatten the
+    # advantage of top ranks
+    RRF_K = 60
+    # Chunk metadata locating a chunk in its file (see TextChunker.chunk_segments)
+    LOCATION_FIELDS = ("page_start", "page_end", "slide_start", "slide_end")
+
+    def __init__(self, gemini_api_key: str = None, embedding_backend: str = None):
         """
         Initialize RAG pipeline.
 
         Args:
             gemini_api_key: Google Gemini API key
+            embedding_backend: 'gemini' or 'local' (or from env
+                RAG_EMBEDDING_BACKEND, default 'gemini')
         """
         env_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-        self.embedder = GeminiEmbedder(gemini_api_key or env_key)
-        self.vector_store = FirestoreVectorStore()
-        self.chunker = TextChunker(chunk_size=1000, chunk_overlap=200)
+        self.embedder = create_embedder(embedding_backend, gemini_api_key or env_key)
+        self.vector_store = FirestoreVectorStore(embedding_model=self.embedder.MODEL)
+        self.chunker = self._create_chunker()
+
+        # Re-embed chunks whose embedding failed during indexing
+        self.retry_queue = EmbeddingRetryQueue(self.vector_store, self.embedder)
+        self.retry_queue.start()
+
+        # Platform documentation, embedded once and searched per query. A
+        # chunk is only added to a prompt above a similarity calibrated for
+        # the embedding model, so questions about course material don't pull
+        # in unrelated docs
+        self.platform_docs = PlatformDocsIndex(self.embedder)
+        self.platform_docs_min_score = float(
+            os.getenv("RAG_PLATFORM_DOCS_MIN_SCORE")
+            or self.embedder.PLATFORM_DOCS_MIN_SCORE
+        )
 
         # Initialize Gemini for generation
         api_key = gemini_api_key or env_key
@@ -45,65 +88,355 @@ class RAGPipeline:
         else:
             self.model = None
 
+    def _create_chunker(self) -> TextChunker:
+        """
+        Create the document chunker.
+
+        Chunks are 1000 characters by default. With env RAG_CHUNK_TOKENS
+        they are packed to that many tokens of the embedding model instead
+        ('max' for its whole input limit), overlapping by
+        RAG_CHUNK_OVERLAP_TOKENS (default an eighth of a chunk).
+        """
+        chunk_tokens = os.getenv("RAG_CHUNK_TOKENS")
+        if not chunk_tokens:
+            return TextChunker(chunk_size=1000, chunk_overlap=200)
+
+        limit = self.embedder.MAX_INPUT_TOKENS
+        chunk_size = limit if chunk_tokens == "max" else min(int(chunk_tokens), limit)
+        chunk_overlap = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", str(chunk_size // 8)))
+        return TokenChunker(self.embedder.tokenizer, chunk_size, chunk_overlap)
+
     def index_document(
         self,
         user_id: str,
-        text: str,
+        text: Union[str, Iterable[str]],
         file_name: str,
         file_type: str,
         storage_path: str,
         metadata: Dict = None,
+        progress_callback: Callable[[int], None] = None,
+        content_hash: str = None,
+        document_id: str = None,
+        segmented: bool = False,
     ) -> str:
         """
         Index a document into the vector store.
 
+        With a content_hash, a file that was indexed before (by any user) is
+        not chunked or embedded again: the new document references the
+        existing chunks.
+
+        With a document_id, the text is a new version of that document and
+        only the chunks that changed are embedded and written (see
+        _reindex_document).
+
         Args:
             user_id: User ID
-            text: Extracted text from document
+            text: Extracted text from document, or an iterator of sections
+                (e.g. FileProcessor.stream_file pages) consumed incrementally,
+                or with segmented an iterator of (location, text) segments
             file_name: Name of the file
             file_type: Type of file
             storage_path: Path in Firebase Storage
             metadata: Additional metadata
+            progress_callback: Called with the number of chunks stored so far
+                after each group is written
+            content_hash: SHA-256 of the file bytes, to share chunks between
+                identical files
+            document_id: Existing document to update instead of adding one
+            segmented: Text is (location, text) segments, such as pages and
+                slides from FileProcessor.iter_segments; chunks then record
+                their page or slide range and never span two slides
 
         Returns:
             Document ID
         """
-        # Chunk the text
-        chunks = self.chunker.chunk_text(
-            text,
-            metadata={
-                "file_name": file_name,
-                "file_type": file_type,
-                **(metadata or {}),
-            },
-        )
+        if content_hash:
+            # Only files chunked the same way can share chunks
+            schemes = [self.chunker.scheme, "segments" if segmented else ""]
+            content_hash = ":".join([content_hash] + [scheme for scheme in schemes if scheme])
+
+        # Chunk the text lazily, as the pipeline below asks for chunks
+        chunk_metadata = {
+            "file_name": file_name,
+            "file_type": file_type,
+            **(metadata or {}),
+        }
+        if segmented:
+            chunks = self.chunker.chunk_segments(
+                text, metadata=chunk_metadata, separate=file_type == "pptx"
+            )
+        else:
+            chunks = self.chunker.chunk_sections(
+                [text] if isinstance(text, str) else text, metadata=chunk_metadata
+            )
 
-        if not chunks:
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
             raise ValueError("No chunks created from document")
+        chunks = chain([first_chunk], chunks)
 
-        # Generate embeddings
-        chunk_texts = [chunk["text"] for chunk in chunks]
-        embeddings = self.embedder.embed_batch(chunk_texts)
+        if document_id:
+            self._reindex_document(
+                document_id,
+                user_id,
+                chunks,
+                {
+                    "file_name": file_name,
+                    "file_type": file_type,
+                    "storage_path": storage_path,
+                    "metadata": metadata or {},
+                },
+                progress_callback,
+                content_hash,
+            )
+            return document_id
 
-        # Store in vector store
-        doc_id = self.vector_store.add_document(
-            user_id=user_id,
-            file_name=file_name,
-            file_type=file_type,
-            storage_path=storage_path,
-            metadata=metadata,
+        content = (
+            self.vector_store.acquire_content(content_hash) if content_hash else None
         )
+        if content and content["status"] == "busy":
+            # Being indexed by another upload right now: keep a private copy
+            content = None
 
-        self.vector_store.add_chunks(doc_id, chunks, embeddings)
+        # Store in vector store
+        try:
+            doc_id = self.vector_store.add_document(
+                user_id=user_id,
+                file_name=file_name,
+                file_type=file_type,
+                storage_path=storage_path,
+                metadata=metadata,
+                content_id=content["content_id"] if content else None,
+                chunk_count=content["chunk_count"] if content else 0,
+            )
+        except Exception:
+            # Give back the reference (or claim) taken above
+            if content:
+                self.vector_store.release_content(content["content_id"])
+            raise
+
+        if content and content["status"] == "ready":
+            if progress_callback:
+                progress_callback(content["chunk_count"])
+            return doc_id
+
+        try:
+            content_id = content["content_id"] if content else None
+            chunk_count = self._embed_and_store(
+                doc_id, user_id, chunks, progress_callback, content_id
+            )
+            if content_id:
+                self.vector_store.mark_content_ready(content_id, chunk_count)
+        except Exception:
+            # Don't leave a half-indexed document behind
+            self.vector_store.delete_document(doc_id)
+            raise
 
         return doc_id
 
+    def _reindex_document(
+        self,
+        doc_id: str,
+        user_id: str,
+        chunks: Iterable[Dict],
+        document_fields: Dict,
+        progress_callback: Callable[[int], None] = None,
+        content_hash: str = None,
+    ) -> None:
+        """
+        Replace a document's chunks with those of its new version.
+
+        A privately indexed document is diffed against its stored chunks by
+        a hash of their text and location (so text that moved to another page
+        gets its new page range): unchanged chunks are left as they are, new or edited
+        chunks are embedded and written, and chunks that disappeared are
+        deleted. Shared chunks are never edited
+        in place, so a document referencing shared content moves to the new
+        version's content instead (unchanged chunks are then served by the
+        embedder's chunk cache rather than re-embedded).
+
+        Args:
+            doc_id: Document to update
+            user_id: Owner of the document
+            chunks: Chunk dictionaries of the new version
+            document_fields: Document fields to update, e.g. file_name
+            progress_callback: Called with the number of chunks stored
+            content_hash: SHA-256 of the new file bytes
+        """
+        doc = self.vector_store.get_document(doc_id)
+        if doc is None:
+            raise ValueError("Document not found")
+
+        if doc.get("content_id"):
+            self._move_document(
+                doc_id, user_id, chunks, document_fields, progress_callback, content_hash
+            )
+            return
+
+        stored = defaultdict(deque)
+        for chunk in sorted(
+            self.vector_store.get_document_chunks(doc_id),
+            key=lambda chunk: chunk.get("chunk_index", 0),
+        ):
+            text = chunk.pop("text", "")
+            stored[self._chunk_hash(text, chunk.pop("metadata", {}))].append(chunk)
+
+        added = []
+        chunk_count = 0
+        for chunk in chunks:
+            chunk_count += 1
+            matches = stored.get(self._chunk_hash(chunk["text"], chunk))
+            if matches:
+                matches.popleft()
+            else:
+                added.append(chunk)
+        removed = [chunk["id"] for matches in stored.values() for chunk in matches]
+
+        embeddings = (
+            self.embedder.embed_batch_async([chunk["text"] for chunk in added]).result()
+            if added
+            else []
+        )
+        writes = self.vector_store.update_chunks(
+            doc_id, user_id, added, embeddings, removed, chunk_count, document_fields
+        )
+        print(
+            f"Re-indexed document {doc_id}: {len(added)} added, "
+            f"{chunk_count - len(added)} unchanged, {len(removed)} removed, "
+            f"{writes} chunk writes"
+        )
+        if progress_callback:
+            progress_callback(chunk_count)
+
+    def _move_document(
+        self,
+        doc_id: str,
+        user_id: str,
+        chunks: Iterable[Dict],
+        document_fields: Dict,
+        progress_callback: Callable[[int], None] = None,
+        content_hash: str = None,
+    ) -> None:
+        """Point a document referencing shared content at its new version's chunks."""
+        content = (
+            self.vector_store.acquire_content(content_hash) if content_hash else None
+        )
+        if content and content["status"] == "busy":
+            content = None
+        content_id = content["content_id"] if content else None
+        chunk_count = content["chunk_count"] if content else 0
+
+        if not content or content["status"] == "claimed":
+            try:
+                chunk_count = self._embed_and_store(
+                    doc_id, user_id, chunks, progress_callback, content_id
+                )
+                if content_id:
+                    self.vector_store.mark_content_ready(content_id, chunk_count)
+            except Exception:
+                # The document keeps its previous version
+                if content_id:
+                    self.vector_store.release_content(content_id)
+                else:
+                    self.vector_store.delete_chunks(document_id=doc_id)
+                raise
+        elif progress_callback:
+            progress_callback(chunk_count)
+
+        self.vector_store.move_document(doc_id, content_id, chunk_count, document_fields)
+
+    @classmethod
+    def _chunk_hash(cls, text: str, fields: Dict) -> str:
+        """Hash identifying a chunk's text and location when diffing document versions."""
+        location = [fields.get(field) for field in cls.LOCATION_FIELDS]
+        return hashlib.sha256(f"{location}\n{text.strip()}".encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _chunk_location(cls, chunk: Dict) -> Dict:
+        """Page or slide range of a retrieved chunk, for citing it."""
+        metadata = chunk.get("metadata", {})
+        return {field: metadata[field] for field in cls.LOCATION_FIELDS if field in metadata}
+
+    def _embed_and_store(
+        self,
+        doc_id: str,
+        user_id: str,
+        chunks: Iterable[Dict],
+        progress_callback: Callable[[int], None] = None,
+        content_id: str = None,
+    ) -> int:
+        """
+        Embed chunks and write them to the vector store as a pipeline.
+
+        Chunks are consumed in groups; each group's embedding request is
+        started as soon as the group is formed, and a single writer thread
+        stores groups in order as their embeddings arrive. Chunking,
+        embedding and Firestore writes therefore overlap.
+
+        Args:
+            doc_id: Parent document ID
+            user_id: Owner of the document
+            chunks: Chunk dictionaries, possibly produced lazily
+            progress_callback: Called with the number of chunks stored so far
+            content_id: Shared content the chunks are stored under
+
+        Returns:
+            Number of chunks stored
+        """
+        chunks = iter(chunks)
+        in_flight = deque()
+        writes = []
+        written = 0
+
+        def write(group, embeddings, chunk_count):
+            self.vector_store.add_chunks(
+                doc_id,
+                group,
+                embeddings,
+                user_id=user_id,
+                chunk_count=chunk_count,
+                content_id=content_id,
+            )
+            if progress_callback:
+                progress_callback(chunk_count)
+
+        with ThreadPoolExecutor(max_workers=1) as writer:
+
+            def store_oldest():
+                nonlocal written
+                group, future = in_flight.popleft()
+                embeddings = future.result()
+                written += len(group)
+                writes.append(writer.submit(write, group, embeddings, written))
+
+            while True:
+                group = list(islice(chunks, self.EMBED_GROUP_SIZE))
+                if not group:
+                    break
+                future = self.embedder.embed_batch_async(
+                    [chunk["text"] for chunk in group]
+                )
+                in_flight.append((group, future))
+                # Bound memory held by embeddings waiting to be written
+                if len(in_flight) > self.MAX_GROUPS_IN_FLIGHT:
+                    store_oldest()
+
+            while in_flight:
+                store_oldest()
+
+            for write in writes:
+                write.result()
+
+        return written
+
     def query(
         self,
         question: str,
         user_id: str = None,
         top_k: int = 5,
         include_platform_docs: bool = True,
+        context_tokens: int = None,
     ) -> Dict:
         """
         Query the RAG system and generate a response.
@@ -113,17 +446,28 @@ class RAGPipeline:
             user_id: User ID (to filter user's documents)
             top_k: Number of context chunks to retrieve
             include_platform_docs: Whether to include platform documentation
+            context_tokens: Token budget for the document context (or from
+                env RAG_CONTEXT_TOKENS). When set, chunks are taken in rank
+                order from the best CONTEXT_CANDIDATE_FACTOR * top_k for as
+                long as they fit, instead of exactly top_k
 
         Returns:
             Dictionary with 'answer', 'sources', and 'context' fields
         """
+        context_tokens = context_tokens or int(os.getenv("RAG_CONTEXT_TOKENS", "0"))
+
         # Generate query embedding
-        query_embedding = self.embedder.embed_text(question)
+        query_embedding = self.embedder.embed_query(question)
 
         # Retrieve similar chunks
-        retrieved_chunks = self.vector_store.search_similar(
-            query_embedding=query_embedding, user_id=user_id, top_k=top_k
+        retrieved_chunks = self._retrieve(
+            question,
+            query_embedding,
+            user_id,
+            top_k * self.CONTEXT_CANDIDATE_FACTOR if context_tokens else top_k,
         )
+        if context_tokens:
+            retrieved_chunks = self._fit_context(retrieved_chunks, context_tokens)
 
         # Build context from retrieved chunks
         context_parts = []
@@ -137,15 +481,16 @@ class RAGPipeline:
                     "file_name": chunk.get("metadata", {}).get("file_name", "Unknown"),
                     "score": chunk.get("score", 0),
                     "chunk_index": chunk.get("chunk_index", 0),
+                    **self._chunk_location(chunk),
                 }
             )
 
-        context = "\n\n---\n\n".join(context_parts)
+        context = self.CONTEXT_SEPARATOR.join(context_parts)
 
         # Add platform documentation if requested
         platform_context = ""
         if include_platform_docs:
-            platform_context = self._get_platform_docs_context(question)
+            platform_context = self._get_platform_docs_context(query_embedding)
 
         # Format prompt
         if platform_context and not context:
@@ -193,6 +538,104 @@ class RAGPipeline:
 
         return {"answer": answer, "sources": sources, "context": context}
 
+    def _retrieve(
+        self, question: str, query_embedding: List[float], user_id: str, top_k: int
+    ) -> List[Dict]:
+        """
+        Retrieve the chunks most relevant to a question.
+
+        With hybrid search, BM25 matches on the question's terms and vector
+        matches on its embedding are merged by reciprocal rank fusion, so a
+        chunk containing an exact standard code or name ranks high even when
+        its embedding is not among the nearest. Every result keeps its
+        cosine similarity as 'score'.
+
+        Args:
+            question: Question text, for lexical search
+            query_embedding: Question embedding, for vector search
+            user_id: User whose documents are searched
+            top_k: Number of chunks to return
+
+        Returns:
+            Chunks, most relevant first
+        """
+        if not self.HYBRID_SEARCH:
+            return self.vector_store.search_similar(
+                query_embedding=query_embedding, user_id=user_id, top_k=top_k
+            )
+
+        candidates = top_k * self.HYBRID_CANDIDATE_FACTOR
+        lexical = self.vector_store.search_lexical(
+            question, user_id=user_id, top_k=candidates
+        )
+        lexical_ids = [chunk["id"] for chunk in lexical]
+
+        if self.LEXICAL_PREFILTER and len(lexical) >= candidates:
+            # Cheap first stage: score only the lexical candidates
+            vector = self.vector_store.search_similar(
+                query_embedding=query_embedding,
+                user_id=user_id,
+                top_k=candidates,
+                min_score=-1.0,
+                chunk_ids=lexical_ids,
+            )
+        else:
+            vector = self.vector_store.search_similar(
+                query_embedding=query_embedding, user_id=user_id, top_k=candidates
+            )
+
+        # Lexical-only matches still need their cosine score for display
+        scored = {chunk["id"]: chunk for chunk in vector}
+        missing = [chunk_id for chunk_id in lexical_ids if chunk_id not in scored]
+        if missing:
+            for chunk in self.vector_store.search_similar(
+                query_embedding=query_embedding,
+                user_id=user_id,
+                top_k=len(missing),
+                min_score=-1.0,
+                chunk_ids=missing,
+            ):
+                scored[chunk["id"]] = chunk
+
+        fused = defaultdict(float)
+        for ranking in (vector, lexical):
+            for rank, chunk in enumerate(ranking):
+                fused[chunk["id"]] += 1.0 / (self.RRF_K + rank + 1)
+        best = sorted(fused, key=fused.get, reverse=True)[:top_k]
+        return [scored[chunk_id] for chunk_id in best if chunk_id in scored]
+
+    def _fit_context(self, chunks: List[Dict], budget: int) -> List[Dict]:
+        """
+        Select chunks, in rank order, whose joined text fits a token budget.
+
+        Token counts recorded at chunking time are used when present, so
+        only chunks from the character chunker are tokenized here. A chunk
+        too large for the space left is skipped in favour of smaller ones
+        ranked below it.
+
+        Args:
+            chunks: Retrieved chunks, best first
+            budget: Maximum tokens of the context built from them
+
+        Returns:
+            Chunks to build the context from
+        """
+        count = self.embedder.tokenizer.count
+        separator_tokens = count(self.CONTEXT_SEPARATOR)
+
+        selected = []
+        used = 0
+        for chunk in chunks:
+            tokens = chunk.get("metadata", {}).get("token_count")
+            if tokens is None:
+                tokens = count(chunk["text"])
+            if selected:
+                tokens += separator_tokens
+            if used + tokens <= budget:
+                selected.append(chunk)
+                used += tokens
+        return selected
+
     def generate_material(
         self,
         request: str,
@@ -215,22 +658,21 @@ class RAGPipeline:
             Dictionary with 'content', 'sources', and 'metadata' fields
         """
         # Generate query embedding from request
-        query_embedding = self.embedder.embed_text(request)
+        query_embedding = self.embedder.embed_query(request)
 
         # Retrieve relevant context
-        retrieved_chunks = self.vector_store.search_similar(
-            query_embedding=query_embedding, user_id=user_id, top_k=top_k
-        )
+        retrieved_chunks = self._retrieve(request, query_embedding, user_id, top_k)
 
         # Build context
         context_parts = [chunk["text"] for chunk in retrieved_chunks]
-        context = "\n\n---\n\n".join(context_parts)
+        context = self.CONTEXT_SEPARATOR.join(context_parts)
 
         sources = [
             {
                 "document_id": chunk.get("document_id"),
                 "file_name": chunk.get("metadata", {}).get("file_name", "Unknown"),
                 "score": chunk.get("score", 0),
+                **self._chunk_location(chunk),
             }
             for chunk in retrieved_chunks
         ]
@@ -283,32 +725,30 @@ class RAGPipeline:
             },
         }
 
-    def _get_platform_docs_context(self, question: str) -> str:
-        """Get relevant platform documentation context."""
-        # Load platform documentation
+    def metrics(self) -> Dict:
+        """
+        Operational metrics for embedding and indexing.
+
+        Returns:
+            Dictionary with retry queue depth, embedding request latency and
+            errors, and cache hit rates
+        """
+        chunk_cache = self.embedder.chunk_cache
+        return {
+            "embedding_queue": self.retry_queue.stats(),
+            "embedding_requests": self.embedder.executor.stats(),
+            "query_cache": self.embedder.query_cache.stats(),
+            "chunk_cache": chunk_cache.stats() if chunk_cache else None,
+            "platform_docs": {"chunks": len(self.platform_docs)},
+        }
+
+    def _get_platform_docs_context(self, query_embedding: List[float]) -> str:
+        """Get the platform documentation chunks similar enough to the query, or ""."""
         try:
-            docs_path = os.path.join(
-                os.path.dirname(__file__), "..", "..", "docs", "platform_docs.txt"
+            results = self.platform_docs.search(
+                query_embedding, top_k=3, min_score=self.platform_docs_min_score
             )
-            if os.path.exists(docs_path):
-                with open(docs_path, "r", encoding="utf-8") as f:
-                    platform_docs = f.read()
-
-                # Simple keyword matching - in production, use embedding search
-                question_lower = question.lower()
-                relevant_sections = []
-
-                sections = platform_docs.split("\n\n---\n\n")
-                for section in sections:
-                    if any(
-                        keyword in section.lower() for keyword in question_lower.split()
-                    ):
-                        relevant_sections.append(section)
-
-                return "\n\n---\n\n".join(
-                    relevant_sections[:3]
-                )  # Top 3 relevant sections
+            return self.CONTEXT_SEPARATOR.join(result["text"] for result in results)
         except Exception as e:
-            print(f"Error loading platform docs: {str(e)}")
-
-        return ""
+            print(f"Error searching platform docs: {str(e)}")
+            return ""
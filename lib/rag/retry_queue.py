@@ -0,0 +1,108 @@
+"""
+Background re-embedding of chunks whose embedding failed at index time.
+The queue itself is durable: it is the 'embedding_status' field on rag_chunks.
+"""
+
+import os
+import threading
+from typing import Dict
+
+from lib.rag.vector_store import FirestoreVectorStore
+
+
+class EmbeddingRetryQueue:
+    """
+    Periodically re-embeds pending chunks with exponential backoff.
+
+    Chunks stored without an embedding are marked 'pending' by
+    ``FirestoreVectorStore.add_chunks`` and are invisible to search until
+    this worker gives them a real vector. After ``max_attempts`` failures
+    they are marked 'failed' and left for inspection.
+
+    Every process runs its own queue; chunks are claimed before they are
+    retried, so processes share the work instead of repeating it.
+    """
+
+    # Seconds claimed chunks are held; chunks claimed by a process that
+    # dies are retried by another once their claim runs out
+    CLAIM_SECONDS = 300
+
+    def __init__(self, vector_store: FirestoreVectorStore, embedder,
+                 interval_seconds: float = None, batch_size: int = 100,
+                 max_attempts: int = 8):
+        """
+        Initialize retry queue.
+
+        Args:
+            vector_store: Store holding the pending chunks
+            embedder: Embedder used for retries
+            interval_seconds: Seconds between passes (or from env
+                RAG_EMBED_RETRY_INTERVAL, default 60; 0 disables the thread)
+            batch_size: Chunks re-embedded per pass
+            max_attempts: Attempts before a chunk is marked failed
+        """
+        self.vector_store = vector_store
+        self.embedder = embedder
+        self.interval_seconds = interval_seconds if interval_seconds is not None \
+            else float(os.getenv('RAG_EMBED_RETRY_INTERVAL', '60'))
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        self.retried = 0
+        self.recovered = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start the background thread (no-op if disabled or already running)."""
+        if self.interval_seconds <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='embedding-retry', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread."""
+        self._stop.set()
+
+    def process_once(self) -> int:
+        """
+        Re-embed one batch of due chunks.
+
+        Returns:
+            Number of chunks that now have an embedding
+        """
+        chunks = self.vector_store.claim_pending_chunks(limit=self.batch_size,
+                                                        lease_seconds=self.CLAIM_SECONDS)
+        if not chunks:
+            return 0
+
+        embeddings = self.embedder.embed_batch([chunk.get('text', '') for chunk in chunks])
+        succeeded = [(chunk, embedding) for chunk, embedding in zip(chunks, embeddings)
+                     if embedding is not None]
+        failed = [chunk for chunk, embedding in zip(chunks, embeddings) if embedding is None]
+
+        self.vector_store.set_chunk_embeddings([chunk for chunk, _ in succeeded],
+                                               [embedding for _, embedding in succeeded])
+        self.vector_store.record_embedding_failures(failed, self.max_attempts)
+
+        self.retried += len(chunks)
+        self.recovered += len(succeeded)
+        return len(succeeded)
+
+    def stats(self) -> Dict:
+        """Queue depth from Firestore plus this process's retry counters."""
+        return {
+            **self.vector_store.embedding_status_counts(),
+            'retried': self.retried,
+            'recovered': self.recovered,
+        }
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                # Keep going while full batches are coming back
+                while self.process_once() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"Error retrying embeddings: {str(e)}")
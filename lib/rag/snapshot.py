@@ -0,0 +1,184 @@
+"""
+On-disk snapshots of vector indexes.
+Embeddings are stored as a memory-mapped .npy matrix with a JSON sidecar.
+"""
+
+import os
+import re
+import json
+import glob
+import hashlib
+import time
+import uuid
+import tempfile
+from typing import List, Dict, Optional
+
+import numpy as np
+
+
+# The matrix file field at the head of a sidecar
+MATRIX_FILE_FIELD = re.compile(r'"matrix_file": "([^"]+)"')
+
+
+class VectorSnapshot:
+    """
+    Local snapshot of one index scope (a user, or '*' for everything).
+
+    The embedding matrix is written as a ``.npy`` file and opened with
+    ``mmap_mode='c'``, so every worker process on the host maps the same
+    page-cache pages instead of holding its own copy; a process that edits
+    the index in place only copies the pages it writes to. Chunk IDs, payloads
+    and the document versions the snapshot was built from are kept in a
+    ``<key>.json`` sidecar.
+    """
+
+    # Seconds a superseded matrix file is kept, since another process may
+    # have read the old sidecar and be about to load it
+    GRACE_SECONDS = 300
+
+    def __init__(self, directory: str = None, dtype: str = None):
+        """
+        Initialize snapshot storage.
+
+        Args:
+            directory: Snapshot directory (or from env RAG_SNAPSHOT_DIR)
+            dtype: On-disk dtype, 'float32' or 'float16' (or from env RAG_SNAPSHOT_DTYPE).
+                float32 is scored straight from the mapped pages; float16
+                halves disk and page-cache use but is upcast on load.
+        """
+        self.directory = directory or os.getenv('RAG_SNAPSHOT_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'rag_snapshots')
+        self.dtype = np.dtype(dtype or os.getenv('RAG_SNAPSHOT_DTYPE', 'float32'))
+        if self.dtype not in (np.float32, np.float16):
+            raise ValueError(f"Unsupported snapshot dtype: {self.dtype}")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def load(self, scope: str) -> Optional[Dict]:
+        """
+        Load a snapshot.
+
+        Args:
+            scope: Index scope
+
+        Returns:
+            Dictionary with 'ids', 'payloads', 'documents' and 'matrix'
+            fields, or None if there is no usable snapshot
+        """
+        meta_path = self._meta_path(scope)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            matrix = np.load(os.path.join(self.directory, meta['matrix_file']), mmap_mode='c')
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(meta_path):
+                print(f"Ignoring unreadable snapshot for {scope}: {e}")
+            return None
+
+        if matrix.shape[0] != len(meta['ids']):
+            print(f"Ignoring inconsistent snapshot for {scope}")
+            return None
+        if matrix.dtype != np.float32:
+            matrix = np.asarray(matrix, dtype=np.float32)
+
+        return {
+            'ids': meta['ids'],
+            'payloads': meta['payloads'],
+            'documents': meta['documents'],
+            'matrix': matrix,
+        }
+
+    def save(self, scope: str, ids: List[str], payloads: List[Dict],
+             matrix: np.ndarray, documents: Dict[str, float]) -> Optional[np.ndarray]:
+        """
+        Atomically write a snapshot.
+
+        Args:
+            scope: Index scope
+            ids: Chunk IDs, one per matrix row
+            payloads: Chunk payloads, one per matrix row
+            matrix: Normalised embedding matrix
+            documents: Document ID -> version the chunks were read at
+
+        Returns:
+            Copy-on-write memory map of the written matrix when it is stored
+            as float32, or None
+        """
+        meta_path = self._meta_path(scope)
+        key = os.path.basename(meta_path)[:-len('.json')]
+        matrix_file = f"{key}.{uuid.uuid4().hex}.npy"
+        meta = {
+            'scope': scope,
+            'matrix_file': matrix_file,
+            'ids': ids,
+            'payloads': payloads,
+            'documents': documents,
+        }
+
+        # Each save writes a new matrix file and then atomically swaps the
+        # sidecar to point at it, so readers never pair a matrix with the
+        # wrong metadata. Processes still mapping the old file keep it alive.
+        matrix_path = os.path.join(self.directory, matrix_file)
+        tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+        previous = self._matrix_file(meta_path)
+        try:
+            with open(matrix_path, 'wb') as f:
+                np.save(f, np.asarray(matrix, dtype=self.dtype))
+            with open(tmp_meta, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, default=str)
+            os.replace(tmp_meta, meta_path)
+        except OSError as e:
+            print(f"Error writing snapshot for {scope}: {e}")
+            for path in (matrix_path, tmp_meta):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+
+        if previous:
+            # Start the superseded file's grace period now
+            try:
+                os.utime(os.path.join(self.directory, previous))
+            except OSError:
+                pass
+        self._remove_superseded(key, meta_path)
+
+        if self.dtype != np.float32:
+            return None
+        return np.load(matrix_path, mmap_mode='c')
+
+    def _remove_superseded(self, key: str, meta_path: str) -> None:
+        """
+        Delete the scope's matrix files that the current sidecar (possibly
+        written by another process since) no longer references, once their
+        grace period has passed.
+        """
+        current = self._matrix_file(meta_path)
+        cutoff = time.time() - self.GRACE_SECONDS
+        for path in glob.glob(os.path.join(self.directory, f"{key}.*.npy")):
+            if os.path.basename(path) == current:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _matrix_file(meta_path: str) -> Optional[str]:
+        """
+        Matrix file a sidecar references, or None.
+
+        The field is written right after the scope, so only the head of the
+        sidecar is read rather than parsing every payload.
+        """
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                head = f.read(4096)
+        except OSError:
+            return None
+        match = MATRIX_FILE_FIELD.search(head)
+        return match.group(1) if match else None
+
+    def _meta_path(self, scope: str) -> str:
+        """Sidecar path for a scope."""
+        key = hashlib.sha256(scope.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, f"{key}.json")
@@ -0,0 +1,502 @@
+"""
+In-memory approximate nearest neighbour (ANN) index for RAG retrieval.
+Implements an IVF (inverted file) index on top of NumPy.
+"""
+
+import threading
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from lib.rag.quantization import SCORE_BLOCK_SIZE, create_quantizer
+from lib.rag.lexical_index import BM25Index
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale each row to unit length as float32.
+
+    Zero rows are left as zeros so they score 0 against every query.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def cosine_scores(query: List[float], vectors) -> np.ndarray:
+    """
+    Cosine similarity of one query against many vectors.
+
+    Args:
+        query: Query vector
+        vectors: Matrix (n x dim) or list of vectors
+
+    Returns:
+        Array of n similarity scores
+    """
+    return normalize_rows(vectors) @ normalize_rows(query)[0]
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first, via argpartition."""
+    if top_k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class IVFIndex:
+    """
+    Inverted-file index over chunk embeddings.
+
+    Vectors are kept pre-normalised in one contiguous float32 matrix, so
+    scoring is a single matrix-vector product. Once the corpus is large
+    enough, vectors are clustered with k-means into partitions and a query
+    only scores the ``n_probe`` partitions whose centroids are closest to it.
+    Small corpora are searched exhaustively, which is exact.
+
+    With quantization enabled, candidates are first scored on compact SQ8 or
+    PQ codes and only the best ``top_k * rerank_factor`` are re-scored with
+    the full vectors. The full matrix can then be a memory map that is only
+    paged in for those rows. The mapping is kept as the index changes: rows
+    appended past its end go to a small in-memory tail, and a copy-on-write
+    mapping only makes private copies of the pages rows are removed from.
+
+    A BM25 index over the chunk texts is built on the first lexical search
+    and from then on kept in step with every chunk added or removed.
+    """
+
+    def __init__(self, n_probe: int = 8, min_train_size: int = 1024,
+                 kmeans_iterations: int = 10, quantization: str = 'none',
+                 rerank_factor: int = 8):
+        """
+        Initialize index.
+
+        Args:
+            n_probe: Number of partitions scanned per query
+            min_train_size: Corpus size below which search is exhaustive
+            kmeans_iterations: Lloyd iterations used when training centroids
+            quantization: 'none', 'sq8' or 'pq' codes for coarse scoring
+            rerank_factor: Candidates re-scored exactly, as a multiple of top_k
+        """
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+
+        # Row i of _matrix holds the vector for _ids[i]; rows >= _size are free
+        self._matrix: Optional[np.ndarray] = None
+        # Rows past the end of a memory-mapped _matrix (row len(_matrix) + i
+        # is _tail[i]), or None while every row fits in _matrix
+        self._tail: Optional[np.ndarray] = None
+        self._size = 0
+        self._ids: List[str] = []
+        self._payloads: List[Dict] = []
+        self._rows: Dict[str, int] = {}
+
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[set] = []
+        self._assignments: Dict[str, int] = {}
+        self._trained_size = 0
+
+        # Quantized codes, row-aligned with _matrix once the quantizer is trained
+        self._quantizer = None
+        self._codes: Optional[np.ndarray] = None
+
+        # Lexical index of the payload texts, built on first use
+        self._lexical: Optional[BM25Index] = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @classmethod
+    def from_arrays(cls, chunk_ids: List[str], matrix: np.ndarray,
+                    payloads: List[Dict], **kwargs) -> 'IVFIndex':
+        """
+        Build an index around an existing normalised matrix without copying it.
+
+        The matrix may be a memory map. Rows added later go to an in-memory
+        tail; removing rows writes to the map, so a read-only map is copied
+        into a private buffer on the first removal (map copy-on-write to
+        avoid that).
+
+        Args:
+            chunk_ids: Chunk IDs, one per matrix row
+            matrix: Normalised float32 embedding matrix
+            payloads: Chunk payloads, one per matrix row
+            **kwargs: Index parameters passed to __init__
+        """
+        index = cls(**kwargs)
+        if len(chunk_ids) == 0:
+            return index
+        index._matrix = matrix
+        index._size = len(chunk_ids)
+        index._ids = list(chunk_ids)
+        index._payloads = list(payloads)
+        index._rows = {chunk_id: row for row, chunk_id in enumerate(index._ids)}
+        index._maybe_train()
+        return index
+
+    def export(self):
+        """
+        Snapshot the index contents.
+
+        Returns:
+            Tuple of (chunk IDs, normalised matrix, payloads)
+        """
+        with self._lock:
+            if self._matrix is None:
+                return [], np.empty((0, 0), dtype=np.float32), []
+            return list(self._ids), np.array(self._block(0, self._size)), list(self._payloads)
+
+    def document_ids(self) -> set:
+        """IDs of the documents that have chunks in the index."""
+        with self._lock:
+            return {payload.get('document_id') for payload in self._payloads}
+
+    @property
+    def dimension(self) -> Optional[int]:
+        """Embedding dimension, or None before the first vector is added."""
+        return self._matrix.shape[1] if self._matrix is not None else None
+
+    def add(self, chunk_id: str, embedding: List[float], payload: Dict) -> None:
+        """
+        Add or replace a single chunk.
+
+        Args:
+            chunk_id: Firestore chunk ID
+            embedding: Embedding vector
+            payload: Chunk fields returned with search results
+        """
+        self.add_many([chunk_id], [embedding], [payload])
+
+    def add_many(self, chunk_ids: List[str], embeddings: List[List[float]],
+                 payloads: List[Dict]) -> None:
+        """
+        Add or replace chunks in one pass.
+
+        Args:
+            chunk_ids: Firestore chunk IDs
+            embeddings: Embedding vectors
+            payloads: Chunk fields returned with search results
+        """
+        keep = [i for i, embedding in enumerate(embeddings)
+                if embedding is not None and len(embedding) > 0]
+        if not keep:
+            return
+        vectors = normalize_rows([embeddings[i] for i in keep])
+        # Drop zero vectors, they never match anything
+        nonzero = np.any(vectors != 0, axis=1)
+
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.empty((max(64, len(keep)), vectors.shape[1]),
+                                        dtype=np.float32)
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match index "
+                    f"dimension {self.dimension}"
+                )
+
+            # Later duplicates win; replaced chunks are removed before appending
+            latest = {chunk_ids[i]: (vector, payloads[i])
+                      for vector, i in zip(vectors[nonzero], np.asarray(keep)[nonzero])}
+            for chunk_id in latest:
+                if chunk_id in self._rows:
+                    self._remove(chunk_id)
+
+            start = self._size
+            for chunk_id, (vector, payload) in latest.items():
+                self._append(chunk_id, vector, payload)
+            if self._quantizer is not None:
+                self._encode_rows(start, self._size)
+            self._maybe_train()
+
+    def remove_document(self, document_id: str) -> int:
+        """
+        Remove all chunks belonging to a document.
+
+        Returns:
+            Number of chunks removed
+        """
+        with self._lock:
+            chunk_ids = [chunk_id for chunk_id, payload in zip(self._ids, self._payloads)
+                         if payload.get('document_id') == document_id]
+            for chunk_id in chunk_ids:
+                self._remove(chunk_id)
+            return len(chunk_ids)
+
+    def search(self, query_embedding: List[float], top_k: int = 5,
+               min_score: float = 0.0, chunk_ids: List[str] = None) -> List[Dict]:
+        """
+        Search for the chunks most similar to the query.
+
+        Args:
+            query_embedding: Query embedding vector
+            top_k: Number of results to return
+            min_score: Minimum similarity score
+            chunk_ids: Only score these chunks (exactly), e.g. candidates
+                from a lexical search
+
+        Returns:
+            List of chunk payloads with 'id' and 'score' fields
+        """
+        if query_embedding is None or len(query_embedding) == 0:
+            return []
+        query = normalize_rows(query_embedding)[0]
+
+        with self._lock:
+            if self._size == 0 or len(query) != self.dimension:
+                return []
+
+            if chunk_ids is not None:
+                rows = np.asarray([self._rows[chunk_id] for chunk_id in chunk_ids
+                                   if chunk_id in self._rows], dtype=np.int64)
+            else:
+                rows = self._candidate_rows(query)
+                if self._quantizer is not None:
+                    rows = self._rerank_rows(query, rows, top_k)
+            if rows is None:
+                scores = self._score_all(query)
+            else:
+                scores = self._take(rows) @ query
+
+            results = []
+            for i in top_k_indices(scores, top_k):
+                score = float(scores[i])
+                if score < min_score:
+                    break
+                row = int(i) if rows is None else int(rows[i])
+                results.append({'id': self._ids[row], **self._payloads[row], 'score': score})
+            return results
+
+    def search_lexical(self, query: str, top_k: int = 5) -> List[Dict]:
+        """
+        Search the chunk texts for the query terms with BM25.
+
+        Args:
+            query: Query text
+            top_k: Number of results to return
+
+        Returns:
+            List of chunk payloads with 'id' and 'score' (BM25) fields
+        """
+        with self._lock:
+            if self._lexical is None:
+                self._lexical = BM25Index()
+                self._lexical.add_many((chunk_id, payload.get('text', ''))
+                                       for chunk_id, payload in zip(self._ids, self._payloads))
+            results = []
+            for chunk_id, score in self._lexical.search(query, top_k):
+                row = self._rows[chunk_id]
+                results.append({'id': chunk_id, **self._payloads[row], 'score': score})
+            return results
+
+    def _candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Rows in the partitions nearest to the query, or None to scan everything."""
+        if self._centroids is None:
+            return None
+
+        n_probe = min(self.n_probe, len(self._lists))
+        nearest = top_k_indices(self._centroids @ query, n_probe)
+        rows = [self._rows[chunk_id] for list_no in nearest for chunk_id in self._lists[list_no]]
+        return np.asarray(rows, dtype=np.int64)
+
+    def _rerank_rows(self, query: np.ndarray, rows: Optional[np.ndarray],
+                     top_k: int) -> np.ndarray:
+        """Narrow candidate rows by scoring their quantized codes."""
+        codes = self._codes[:self._size] if rows is None else self._codes[rows]
+        coarse = self._quantizer.score(codes, query)
+        best = top_k_indices(coarse, top_k * self.rerank_factor)
+        return best if rows is None else rows[best]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Bytes held in process memory by vectors and codes.
+
+        A memory-mapped matrix is reported as 0, since its pages belong
+        to the shared page cache and are only touched for re-ranking; only
+        its in-memory tail counts.
+        """
+        with self._lock:
+            vectors = 0
+            if isinstance(self._matrix, np.memmap):
+                if self._tail is not None:
+                    vectors = self._tail[:max(0, self._size - len(self._matrix))].nbytes
+            elif self._matrix is not None:
+                vectors = self._matrix[:self._size].nbytes
+            codes = self._codes[:self._size].nbytes if self._codes is not None else 0
+            return {'vectors': vectors, 'codes': codes}
+
+    def attach_matrix(self, chunk_ids: List[str], matrix: np.ndarray) -> bool:
+        """
+        Replace the vector matrix with an identical copy, e.g. a memory map
+        of the snapshot just written from this index.
+
+        Returns:
+            False if the index has changed since chunk_ids were exported
+        """
+        with self._lock:
+            if chunk_ids != self._ids:
+                return False
+            self._matrix = matrix
+            self._tail = None
+            return True
+
+    def _encode_rows(self, start: int, end: int) -> None:
+        """Quantize rows [start, end) of the matrix."""
+        if self._codes is None or len(self._codes) < end:
+            capacity = max(end, 2 * (len(self._codes) if self._codes is not None else 0))
+            grown = np.empty((capacity, self._quantizer.code_size), dtype=np.uint8)
+            if self._codes is not None:
+                grown[:start] = self._codes[:start]
+            self._codes = grown
+        for block in range(start, end, SCORE_BLOCK_SIZE):
+            block_end = min(end, block + SCORE_BLOCK_SIZE)
+            self._codes[block:block_end] = self._quantizer.encode(self._block(block, block_end))
+
+    def _block(self, start: int, end: int) -> np.ndarray:
+        """Rows [start, end); a view unless they straddle the matrix and its tail."""
+        if self._tail is None or end <= len(self._matrix):
+            return self._matrix[start:end]
+        split = len(self._matrix)
+        if start >= split:
+            return self._tail[start - split:end - split]
+        return np.concatenate([self._matrix[start:split], self._tail[:end - split]])
+
+    def _take(self, rows: np.ndarray) -> np.ndarray:
+        """Copy of the given rows."""
+        if self._tail is None:
+            return self._matrix[rows]
+        split = len(self._matrix)
+        in_tail = rows >= split
+        taken = np.empty((len(rows), self.dimension), dtype=np.float32)
+        taken[~in_tail] = self._matrix[rows[~in_tail]]
+        taken[in_tail] = self._tail[rows[in_tail] - split]
+        return taken
+
+    def _score_all(self, query: np.ndarray) -> np.ndarray:
+        """Scores of every row, without copying a mapped matrix."""
+        if self._tail is None or self._size <= len(self._matrix):
+            return self._matrix[:self._size] @ query
+        split = len(self._matrix)
+        return np.concatenate([self._matrix @ query, self._tail[:self._size - split] @ query])
+
+    def _set_row(self, row: int, vector: np.ndarray) -> None:
+        """Write a row, in the matrix or its tail."""
+        if self._tail is not None and row >= len(self._matrix):
+            self._tail[row - len(self._matrix)] = vector
+        else:
+            self._matrix[row] = vector
+
+    def _append(self, chunk_id: str, vector: np.ndarray, payload: Dict) -> None:
+        """Write a vector into the next free row, growing the matrix (or its tail) if full."""
+        if self._tail is None and isinstance(self._matrix, np.memmap) \
+                and self._size == len(self._matrix):
+            # Keep the mapping; new rows go to an in-memory tail
+            self._tail = np.empty((64, self._matrix.shape[1]), dtype=np.float32)
+        if self._tail is not None:
+            used = self._size - len(self._matrix)
+            if used == len(self._tail):
+                grown = np.empty((2 * len(self._tail), self._tail.shape[1]), dtype=np.float32)
+                grown[:used] = self._tail[:used]
+                self._tail = grown
+        elif self._size == len(self._matrix) or not self._matrix.flags.writeable:
+            grown = np.empty((2 * len(self._matrix), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+
+        row = self._size
+        self._set_row(row, vector)
+        self._ids.append(chunk_id)
+        self._payloads.append(payload)
+        self._rows[chunk_id] = row
+        self._size += 1
+        if self._centroids is not None:
+            self._assign(chunk_id, vector)
+        if self._lexical is not None:
+            self._lexical.add_many([(chunk_id, payload.get('text', ''))])
+
+    def _remove(self, chunk_id: str) -> None:
+        """Delete a row by moving the last row into its place."""
+        row = self._rows.pop(chunk_id)
+        self._unassign(chunk_id)
+        if self._lexical is not None:
+            self._lexical.remove(chunk_id)
+        last = self._size - 1
+        if row != last:
+            if not self._matrix.flags.writeable:
+                self._matrix = np.array(self._block(0, self._size))
+                self._tail = None
+            self._set_row(row, self._block(last, last + 1)[0])
+            if self._quantizer is not None:
+                self._codes[row] = self._codes[last]
+            self._ids[row] = self._ids[last]
+            self._payloads[row] = self._payloads[last]
+            self._rows[self._ids[row]] = row
+        self._ids.pop()
+        self._payloads.pop()
+        self._size -= 1
+
+    def _maybe_train(self) -> None:
+        """(Re)train centroids once the corpus is large enough or has grown."""
+        if self._size < self.min_train_size:
+            return
+        if self._centroids is not None and self._size < 2 * self._trained_size:
+            return
+        self._train()
+
+    def _train(self) -> None:
+        """Cluster all vectors with spherical k-means."""
+        data = self._block(0, self._size)
+        n_lists = max(1, int(np.sqrt(self._size)))
+
+        # Train on a sample; a few dozen points per centroid is plenty
+        rng = np.random.default_rng(0)
+        sample_size = min(self._size, 64 * n_lists)
+        sample = data[rng.choice(self._size, sample_size, replace=False)]
+        centroids = sample[:n_lists].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            present, starts = np.unique(labels[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids[present] = normalize_rows(sums)
+
+        labels = np.argmax(data @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._train_quantizer(sample)
+        self._lists = [set() for _ in range(n_lists)]
+        self._assignments = {}
+        for chunk_id, list_no in zip(self._ids, labels):
+            self._lists[list_no].add(chunk_id)
+            self._assignments[chunk_id] = int(list_no)
+        self._trained_size = self._size
+
+    def _train_quantizer(self, sample: np.ndarray) -> None:
+        """Train the quantizer on a sample and re-encode every row."""
+        quantizer = create_quantizer(self.quantization, self.dimension)
+        if quantizer is None:
+            return
+        quantizer.train(sample)
+        self._quantizer = quantizer
+        self._codes = None
+        self._encode_rows(0, self._size)
+
+    def _assign(self, chunk_id: str, vector: np.ndarray) -> None:
+        """Assign a vector to its nearest partition."""
+        list_no = int(np.argmax(self._centroids @ vector))
+        self._lists[list_no].add(chunk_id)
+        self._assignments[chunk_id] = list_no
+
+    def _unassign(self, chunk_id: str) -> None:
+        """Remove a chunk from its partition."""
+        list_no = self._assignments.pop(chunk_id, None)
+        if list_no is not None:
+            self._lists[list_no].discard(chunk_id)
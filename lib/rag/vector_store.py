@@ -5,14 +5,23 @@ Stores embeddings and metadata for RAG retrieval.
 
 import os
 import sys
-from typing import List, Dict, Optional
+import random
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable, Tuple
 from datetime import datetime
 import json
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
+from firebase_admin import firestore
 from lib.firebase_admin import db
+from lib.rag.vector_index import IVFIndex, cosine_scores
+from lib.rag.snapshot import VectorSnapshot
+from lib.rag.embedding_codec import encode_embedding, decode_embedding
 
 
 class FirestoreVectorStore:
@@ -20,13 +29,77 @@ class FirestoreVectorStore:
     
     COLLECTION_NAME = 'rag_documents'
     CHUNKS_COLLECTION = 'rag_chunks'
+    # Shared chunk sets of identical files, referenced by rag_documents entries
+    CONTENTS_COLLECTION = 'rag_contents'
     
-    def __init__(self):
-        """Initialize vector store."""
+    # Maximum number of values Firestore accepts in an 'in' filter
+    IN_QUERY_LIMIT = 10
+    
+    # Maximum number of writes Firestore accepts in one batch
+    MAX_BATCH_WRITES = 500
+    # Batches committed concurrently by _commit_writes
+    MAX_CONCURRENT_COMMITS = 8
+    # Retries per batch on contention or transient errors
+    COMMIT_RETRIES = 5
+    # Status codes of errors worth retrying: aborted (contention), resource
+    # exhausted, internal, unavailable and deadline exceeded
+    TRANSIENT_ERROR_CODES = {409, 429, 500, 503, 504}
+    
+    # How add_chunks stores embeddings: 'array' (Firestore array of doubles)
+    # or a packed bytes field, 'float32', 'float16' or 'int8'
+    EMBEDDING_ENCODING = os.getenv('RAG_EMBEDDING_ENCODING', 'array')
+    
+    # Coarse-scoring codes for large indexes: 'none', 'sq8' or 'pq'. Codes
+    # only save memory when the full vectors are served from a float32
+    # snapshot mapping, so without one indexes are not quantized.
+    INDEX_QUANTIZATION = os.getenv('RAG_INDEX_QUANTIZATION', 'none')
+    
+    # Seconds before an in-memory index is re-synced with Firestore, so that
+    # writes made by other worker processes become visible.
+    INDEX_TTL_SECONDS = int(os.getenv('RAG_INDEX_TTL_SECONDS', '300'))
+    
+    # ANN indexes shared by all store instances, keyed by user ID
+    # ('*' for searches that are not scoped to a user) and embedding model
+    # (see _scope), together with the document versions each index was
+    # last synced against and the document each index key is reported as
+    # (see _document_versions).
+    _indexes: Dict[str, IVFIndex] = {}
+    _index_synced_at: Dict[str, float] = {}
+    _index_documents: Dict[str, Dict[str, float]] = {}
+    _index_references: Dict[str, Dict[str, Dict]] = {}
+    _indexes_lock = threading.Lock()
+    _snapshots: Optional[VectorSnapshot] = None
+    # Snapshots are written by one background thread, off the query path;
+    # scopes with a write queued are not queued again
+    _snapshot_writer: Optional[ThreadPoolExecutor] = None
+    _snapshot_pending: set = set()
+    # Set once the retry queue's composite index turns out to be missing, so
+    # later claims use the fallback query without logging the error again
+    _claim_index_missing = False
+    
+    # Seconds an 'indexing' claim on shared content lasts without progress
+    # before another upload may take it over (the claimant is presumed to
+    # have crashed). Every chunk group written renews the claim.
+    CONTENT_CLAIM_TTL_SECONDS = int(os.getenv('RAG_CONTENT_CLAIM_TTL_SECONDS', '900'))
+    
+    # Model of chunks written before embedding_model was recorded on them
+    DEFAULT_EMBEDDING_MODEL = 'models/embedding-001'
+    
+    def __init__(self, embedding_model: str = None):
+        """
+        Initialize vector store.
+        
+        Args:
+            embedding_model: Model that produces this store's embeddings.
+                Chunks embedded by a different model (and so possibly of a
+                different dimension) are left out of search.
+        """
         self.db = db
+        self.embedding_model = embedding_model or self.DEFAULT_EMBEDDING_MODEL
     
     def add_document(self, user_id: str, file_name: str, file_type: str,
-                    storage_path: str, metadata: Dict = None) -> str:
+                    storage_path: str, metadata: Dict = None,
+                    content_id: str = None, chunk_count: int = 0) -> str:
         """
         Add a document to the vector store.
         
@@ -36,6 +109,9 @@ class FirestoreVectorStore:
             file_type: Type of file (pdf, docx, etc.)
             storage_path: Path in Firebase Storage
             metadata: Additional metadata
+            content_id: Shared content (from acquire_content) holding the
+                document's chunks, if it is not indexed privately
+            chunk_count: Chunks already stored for the document
             
         Returns:
             Document ID
@@ -50,55 +126,388 @@ class FirestoreVectorStore:
             'metadata': metadata or {},
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow(),
-            'chunk_count': 0
+            'chunk_count': chunk_count
         }
+        if content_id:
+            doc_data['content_id'] = content_id
         
         doc_ref.set(doc_data)
+        
+        if content_id:
+            # Shared chunks are found through the document on the next sync
+            self._invalidate_index(user_id)
         return doc_ref.id
     
+    def content_id(self, content_hash: str) -> str:
+        """ID of the shared content for a file hash under this store's embedding model."""
+        return hashlib.sha256(f'{self.embedding_model}:{content_hash}'.encode('utf-8')).hexdigest()
+    
+    def acquire_content(self, content_hash: str) -> Dict:
+        """
+        Take a reference to the shared chunks of a file, claiming them for
+        indexing if the file has not been indexed before.
+        
+        Args:
+            content_hash: SHA-256 of the file bytes
+            
+        Returns:
+            Dictionary with 'content_id', 'chunk_count' and 'status': 'ready'
+            if the chunks exist, 'claimed' if the caller must index them and
+            then call mark_content_ready, or 'busy' if the content is being
+            indexed or deleted elsewhere (no reference is taken; the caller
+            should index a private copy)
+        """
+        content_id = self.content_id(content_hash)
+        content_ref = self.db.collection(self.CONTENTS_COLLECTION).document(content_id)
+        
+        @firestore.transactional
+        def acquire(transaction):
+            snapshot = content_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                transaction.set(content_ref, {
+                    'content_hash': content_hash,
+                    'embedding_model': self.embedding_model,
+                    'status': 'indexing',
+                    'claimed_at': time.time(),
+                    'ref_count': 1,
+                    'chunk_count': 0,
+                    'created_at': datetime.utcnow(),
+                    'updated_at': datetime.utcnow()
+                })
+                return 'claimed', 0
+            content = snapshot.to_dict()
+            if content.get('status') == 'indexing' and \
+                    time.time() - content.get('claimed_at', 0) > self.CONTENT_CLAIM_TTL_SECONDS:
+                # The claimant stopped renewing its claim: take it over. Its
+                # document (if any) keeps its reference.
+                transaction.update(content_ref, {
+                    'claimed_at': time.time(),
+                    'ref_count': content.get('ref_count', 0) + 1,
+                    'chunk_count': 0,
+                    'updated_at': datetime.utcnow()
+                })
+                return 'reclaimed', 0
+            if content.get('status') != 'ready':
+                return 'busy', 0
+            transaction.update(content_ref, {'ref_count': content.get('ref_count', 0) + 1})
+            return 'ready', content.get('chunk_count', 0)
+        
+        status, chunk_count = acquire(self.db.transaction())
+        if status == 'reclaimed':
+            # Start over from the chunks the previous claimant left behind
+            self.delete_chunks(content_id=content_id)
+            self._remove_from_indexes(content_id)
+            status = 'claimed'
+        return {'content_id': content_id, 'status': status, 'chunk_count': chunk_count}
+    
+    def mark_content_ready(self, content_id: str, chunk_count: int) -> None:
+        """Open claimed content to other references once all its chunks are stored."""
+        self.db.collection(self.CONTENTS_COLLECTION).document(content_id).update({
+            'status': 'ready',
+            'claimed_at': firestore.DELETE_FIELD,
+            'chunk_count': chunk_count,
+            'updated_at': datetime.utcnow()
+        })
+    
     def add_chunks(self, document_id: str, chunks: List[Dict], 
-                   embeddings: List[List[float]]) -> None:
+                   embeddings: List[List[float]], user_id: str = None,
+                   chunk_count: int = None, content_id: str = None) -> None:
         """
         Add chunks with embeddings to the vector store.
         
         Args:
             document_id: ID of the parent document
             chunks: List of chunk dictionaries with text and metadata
-            embeddings: List of embedding vectors
+            embeddings: List of embedding vectors; None marks a chunk whose
+                embedding failed, stored as pending for the retry queue
+            user_id: Owner of the parent document (looked up if omitted)
+            chunk_count: Total chunks of the document so far, when chunks are
+                added in several calls (defaults to len(chunks))
+            content_id: Shared content the chunks belong to instead of the
+                document (and its owner)
         """
         if len(chunks) != len(embeddings):
             raise ValueError("Chunks and embeddings must have same length")
         
-        batch = self.db.batch()
-        chunk_refs = []
+        if user_id is None:
+            doc = self.get_document(document_id)
+            user_id = doc.get('user_id') if doc else None
+        
+        writes = []
+        indexed = []
         
         for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
             chunk_ref = self.db.collection(self.CHUNKS_COLLECTION).document()
-            chunk_refs.append(chunk_ref)
-            
-            chunk_data = {
-                'document_id': document_id,
-                'chunk_index': chunk.get('chunk_index', i),
-                'text': chunk['text'],
-                'embedding': embedding,  # Firestore supports arrays
-                'metadata': {k: v for k, v in chunk.items() 
-                           if k not in ['text', 'chunk_index']},
-                'created_at': datetime.utcnow()
-            }
+            chunk_data = self._chunk_data(chunk, embedding, i, document_id, user_id, content_id)
+            writes.append(('set', chunk_ref, chunk_data))
+            indexed.append((chunk_ref.id, embedding, chunk_data))
+        
+        # Update document chunk count in the last batch, once every chunk is stored
+        doc_ref = self.db.collection(self.COLLECTION_NAME).document(document_id)
+        final_writes = [('update', doc_ref, {
+            'chunk_count': chunk_count if chunk_count is not None else len(chunks),
+            'chunks_have_user_id': user_id is not None,
+            'updated_at': datetime.utcnow()
+        })]
+        if content_id:
+            # Renew the indexing claim on the content (see acquire_content)
+            content_ref = self.db.collection(self.CONTENTS_COLLECTION).document(content_id)
+            final_writes.append(('update', content_ref, {'claimed_at': time.time()}))
+        self._commit_writes(writes, final_writes=final_writes)
+        
+        # Keep already-built in-memory indexes in sync
+        for index in self._loaded_indexes(user_id):
+            index.add_many([chunk_id for chunk_id, _, _ in indexed],
+                           [embedding for _, embedding, _ in indexed],
+                           [self._chunk_payload(chunk_data) for _, _, chunk_data in indexed])
+    
+    def get_document_chunks(self, document_id: str) -> List[Dict]:
+        """
+        Get the text, index and metadata of a document's chunks, without
+        their embeddings.
+        
+        Returns:
+            List of chunk dictionaries including their 'id'
+        """
+        chunks = self.db.collection(self.CHUNKS_COLLECTION)\
+            .where('document_id', '==', document_id)\
+            .select(['text', 'chunk_index', 'metadata'])\
+            .stream()
+        return [{'id': chunk.id, **chunk.to_dict()} for chunk in chunks]
+    
+    def update_chunks(self, document_id: str, user_id: str, added: List[Dict],
+                      embeddings: List[List[float]], removed: List[str],
+                      chunk_count: int, document_fields: Dict = None) -> int:
+        """
+        Apply a chunk-level diff to a privately indexed document.
+        
+        Added chunks overwrite removed ones where possible, so an edited
+        chunk costs a single write. Unchanged chunks are not written at all:
+        they keep the chunk_index they were stored with, and search reports
+        the document's current file name. The document itself is updated
+        last; a diff that fails part-way leaves it at its previous version
+        and is completed by re-running the update.
+        
+        Args:
+            document_id: Document to update
+            user_id: Owner of the document
+            added: New chunk dictionaries to store
+            embeddings: Embedding vector (or None) for each added chunk
+            removed: IDs of stored chunks that no longer exist
+            chunk_count: Chunks of the new version
+            document_fields: Document fields to update, e.g. file_name
             
-            batch.set(chunk_ref, chunk_data)
+        Returns:
+            Number of chunk writes
+        """
+        if len(added) != len(embeddings):
+            raise ValueError("Chunks and embeddings must have same length")
+        
+        chunks_ref = self.db.collection(self.CHUNKS_COLLECTION)
+        reusable = list(removed)
+        writes = []
+        
+        for i, (chunk, embedding) in enumerate(zip(added, embeddings)):
+            chunk_ref = chunks_ref.document(reusable.pop()) if reusable else chunks_ref.document()
+            writes.append(('set', chunk_ref,
+                           self._chunk_data(chunk, embedding, i, document_id, user_id)))
         
-        batch.commit()
+        for chunk_id in reusable:
+            writes.append(('delete', chunks_ref.document(chunk_id), None))
         
-        # Update document chunk count
         doc_ref = self.db.collection(self.COLLECTION_NAME).document(document_id)
-        doc_ref.update({
-            'chunk_count': len(chunks),
+        self._commit_writes(writes, final_writes=[('update', doc_ref, {
+            **(document_fields or {}),
+            'chunk_count': chunk_count,
+            'updated_at': datetime.utcnow()
+        })])
+        
+        # Loaded indexes pick up the new version on their next search
+        self._invalidate_index(user_id)
+        self._invalidate_index()
+        return len(writes)
+    
+    def move_document(self, document_id: str, content_id: Optional[str],
+                      chunk_count: int, document_fields: Dict = None) -> None:
+        """
+        Point a document at the chunks of its new version, releasing the
+        shared content it referenced before.
+        
+        Args:
+            document_id: Document to update
+            content_id: Shared content of the new version, or None if the
+                new version was indexed privately under the document
+            chunk_count: Chunks of the new version
+            document_fields: Document fields to update, e.g. file_name
+        """
+        doc = self.get_document(document_id) or {}
+        self.db.collection(self.COLLECTION_NAME).document(document_id).update({
+            **(document_fields or {}),
+            'content_id': content_id or firestore.DELETE_FIELD,
+            'chunk_count': chunk_count,
             'updated_at': datetime.utcnow()
         })
+        
+        self._invalidate_index(doc.get('user_id'))
+        self._invalidate_index()
+        if doc.get('content_id'):
+            self.release_content(doc['content_id'])
+    
+    def claim_pending_chunks(self, limit: int = 100, lease_seconds: float = 300) -> List[Dict]:
+        """
+        Claim the chunks whose embedding has been due for another attempt
+        the longest.
+        
+        A transaction pushes each claimed chunk's next attempt back by
+        lease_seconds, so the retry threads of other processes skip it. The
+        claim ends with set_chunk_embeddings or record_embedding_failures,
+        or when the lease runs out if the claiming process dies.
+        
+        Args:
+            limit: Maximum number of chunks to claim
+            lease_seconds: How long the chunks are held by this caller
+            
+        Returns:
+            List of chunk dictionaries including their 'id'
+        """
+        now = time.time()
+        chunks_ref = self.db.collection(self.CHUNKS_COLLECTION)
+        due = None
+        if not FirestoreVectorStore._claim_index_missing:
+            try:
+                due = list(chunks_ref
+                           .where('embedding_status', '==', 'pending')
+                           .where('embedding_next_attempt_at', '<=', now)
+                           .order_by('embedding_next_attempt_at')
+                           .limit(limit)
+                           .select([])
+                           .stream())
+            except Exception as e:
+                print(f"Index error in claim_pending_chunks, falling back to simple query "
+                      f"until restart: {e}")
+                FirestoreVectorStore._claim_index_missing = True
+        if due is None:
+            # Only pending chunks keep a next attempt time
+            due = [chunk for chunk in chunks_ref
+                   .where('embedding_next_attempt_at', '<=', now)
+                   .order_by('embedding_next_attempt_at')
+                   .limit(limit)
+                   .stream()
+                   if chunk.to_dict().get('embedding_status') == 'pending']
+        if not due:
+            return []
+        
+        refs = [chunk.reference for chunk in due]
+        
+        @firestore.transactional
+        def claim(transaction):
+            claimed = []
+            for snapshot in self.db.get_all(refs, transaction=transaction):
+                chunk = snapshot.to_dict() if snapshot.exists else None
+                # Skip chunks another process claimed or finished meanwhile
+                if not chunk or chunk.get('embedding_status') != 'pending' or \
+                        chunk.get('embedding_next_attempt_at', 0) > now:
+                    continue
+                transaction.update(snapshot.reference,
+                                   {'embedding_next_attempt_at': now + lease_seconds})
+                claimed.append({'id': snapshot.id, **chunk})
+            return claimed
+        
+        return claim(self.db.transaction())
+    
+    def set_chunk_embeddings(self, chunks: List[Dict],
+                             embeddings: List[List[float]]) -> None:
+        """
+        Store embeddings for previously pending chunks.
+        
+        Args:
+            chunks: Chunk dictionaries from claim_pending_chunks
+            embeddings: Embedding vector for each chunk
+        """
+        if not chunks:
+            return
+        
+        writes = []
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk_ref = self.db.collection(self.CHUNKS_COLLECTION).document(chunk['id'])
+            fields = encode_embedding(embedding, self.EMBEDDING_ENCODING)
+            fields['embedding_model'] = self.embedding_model
+            for field in ('embedding_status', 'embedding_attempts', 'embedding_next_attempt_at'):
+                fields[field] = firestore.DELETE_FIELD
+            writes.append(('update', chunk_ref, fields))
+        
+        # Touch parent documents so other processes re-sync their indexes
+        document_ids = {chunk['document_id'] for chunk in chunks if chunk.get('document_id')}
+        owners = {}  # Users referencing each shared content
+        for content_id in {chunk['content_id'] for chunk in chunks if chunk.get('content_id')}:
+            references = self.db.collection(self.COLLECTION_NAME)\
+                .where('content_id', '==', content_id).select(['user_id']).stream()
+            for doc in references:
+                document_ids.add(doc.id)
+                owners.setdefault(content_id, set()).add(doc.to_dict().get('user_id'))
+        touched = []
+        for document_id in document_ids:
+            doc_ref = self.db.collection(self.COLLECTION_NAME).document(document_id)
+            touched.append(('update', doc_ref, {'updated_at': datetime.utcnow()}))
+        self._commit_writes(writes, final_writes=touched)
+        
+        for chunk, embedding in zip(chunks, embeddings):
+            users = owners.get(chunk.get('content_id')) or [chunk.get('user_id')]
+            indexes = {id(index): index for user_id in users
+                       for index in self._loaded_indexes(user_id)}
+            for index in indexes.values():
+                index.add(chunk['id'], embedding, self._chunk_payload(chunk))
+    
+    def record_embedding_failures(self, chunks: List[Dict], max_attempts: int) -> None:
+        """
+        Schedule pending chunks for a later attempt with exponential backoff,
+        or mark them failed once max_attempts is reached.
+        
+        Args:
+            chunks: Chunk dictionaries from claim_pending_chunks
+            max_attempts: Attempts after which a chunk is given up on
+        """
+        if not chunks:
+            return
+        
+        writes = []
+        for chunk in chunks:
+            attempts = chunk.get('embedding_attempts', 0) + 1
+            chunk_ref = self.db.collection(self.CHUNKS_COLLECTION).document(chunk['id'])
+            if attempts >= max_attempts:
+                writes.append(('update', chunk_ref, {
+                    'embedding_status': 'failed',
+                    'embedding_attempts': attempts,
+                    'embedding_next_attempt_at': firestore.DELETE_FIELD
+                }))
+            else:
+                writes.append(('update', chunk_ref, self._pending_fields(attempts)))
+        self._commit_writes(writes)
+    
+    def embedding_status_counts(self) -> Dict[str, int]:
+        """Number of chunks waiting for ('pending') or given up on ('failed') an embedding."""
+        counts = {}
+        for status in ('pending', 'failed'):
+            query = self.db.collection(self.CHUNKS_COLLECTION)\
+                .where('embedding_status', '==', status)
+            try:
+                counts[status] = int(query.count().get()[0][0].value)
+            except Exception:
+                counts[status] = sum(1 for _ in query.select([]).stream())
+        return counts
+    
+    @staticmethod
+    def _pending_fields(attempts: int) -> Dict:
+        """Retry-queue fields for a chunk that has failed to embed attempts times."""
+        return {
+            'embedding_status': 'pending',
+            'embedding_attempts': attempts,
+            'embedding_next_attempt_at': time.time() + min(3600, 30 * 2 ** (attempts - 1))
+        }
     
     def search_similar(self, query_embedding: List[float], user_id: str = None,
-                      top_k: int = 5, min_score: float = 0.0) -> List[Dict]:
+                      top_k: int = 5, min_score: float = 0.0,
+                      chunk_ids: List[str] = None) -> List[Dict]:
         """
         Search for similar chunks using cosine similarity.
         
@@ -107,57 +516,48 @@ class FirestoreVectorStore:
             user_id: Filter by user ID (optional)
             top_k: Number of results to return
             min_score: Minimum similarity score
+            chunk_ids: Only score these chunks, e.g. lexical search results
             
         Returns:
             List of similar chunks with scores
         """
-        # Get all chunks (or filter by user_id)
-        query = self.db.collection(self.CHUNKS_COLLECTION)
-        
-        if user_id:
-            # Filter by user through document_id
-            user_docs = self.db.collection(self.COLLECTION_NAME)\
-                .where('user_id', '==', user_id).stream()
-            doc_ids = [doc.id for doc in user_docs]
-            
-            if not doc_ids:
-                return []
-            
-            # Note: Firestore doesn't support 'in' queries with more than 10 items
-            # For production, consider a different approach
-            if len(doc_ids) <= 10:
-                query = query.where('document_id', 'in', doc_ids)
-            else:
-                # Fallback: get all and filter in memory
-                pass
+        index = self._get_index(user_id)
+        results = index.search(query_embedding, top_k=top_k, min_score=min_score,
+                               chunk_ids=chunk_ids)
+        return self._resolve_references(results, user_id)
+    
+    def search_lexical(self, query: str, user_id: str = None, top_k: int = 5) -> List[Dict]:
+        """
+        Search chunk texts for the query's terms with BM25.
         
-        chunks = query.stream()
+        Uses the inverted index kept alongside the user's vector index, so
+        it covers the same (embedded) chunks and is updated with them.
         
-        # Calculate similarities
-        results = []
-        for chunk_doc in chunks:
-            chunk_data = chunk_doc.to_dict()
-            embedding = chunk_data.get('embedding')
-            
-            if not embedding:
-                continue
-            
-            # Calculate cosine similarity
-            similarity = self._cosine_similarity(query_embedding, embedding)
+        Args:
+            query: Query text
+            user_id: Filter by user ID (optional)
+            top_k: Number of results to return
             
-            if similarity >= min_score:
-                results.append({
-                    'id': chunk_doc.id,
-                    'text': chunk_data.get('text', ''),
-                    'document_id': chunk_data.get('document_id'),
-                    'chunk_index': chunk_data.get('chunk_index', 0),
-                    'metadata': chunk_data.get('metadata', {}),
-                    'score': similarity
-                })
-        
-        # Sort by score and return top_k
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+        Returns:
+            List of matching chunks with BM25 scores
+        """
+        index = self._get_index(user_id)
+        return self._resolve_references(index.search_lexical(query, top_k=top_k), user_id)
+    
+    def _resolve_references(self, results: List[Dict], user_id: str = None) -> List[Dict]:
+        """
+        Report chunks under the current name of their document, and shared
+        chunks as part of the searching user's own document.
+        """
+        with self._indexes_lock:
+            references = self._index_references.get(self._scope(user_id), {})
+        for result in results:
+            reference = references.get(result.pop('content_id', None) or result.get('document_id'))
+            if reference:
+                result['document_id'] = reference['document_id']
+                result['metadata'] = {**result.get('metadata', {}),
+                                      'file_name': reference['file_name']}
+        return results
     
     def get_document(self, document_id: str) -> Optional[Dict]:
         """Get document by ID."""
@@ -188,35 +588,479 @@ class FirestoreVectorStore:
             result.sort(key=lambda x: x.get('created_at', ''), reverse=True)
             return result
     
-    def delete_document(self, document_id: str) -> None:
-        """Delete document and all its chunks."""
-        # Delete chunks
-        chunks = self.db.collection(self.CHUNKS_COLLECTION)\
-            .where('document_id', '==', document_id)\
-            .stream()
+    def delete_document(self, document_id: str,
+                        progress_callback: Callable[[int], None] = None) -> int:
+        """
+        Delete document and all its chunks.
         
-        batch = self.db.batch()
-        for chunk in chunks:
-            batch.delete(chunk.reference)
-        batch.commit()
+        A document referencing shared content only drops its reference; the
+        content's chunks are deleted with its last reference.
+        
+        Args:
+            document_id: Document to delete
+            progress_callback: Called with the number of chunks deleted so
+                far each time a page has been deleted
+            
+        Returns:
+            Number of chunks deleted
+        """
+        doc = self.get_document(document_id) or {}
+        content_id = doc.get('content_id')
+        
+        if content_id:
+            deleted = self.release_content(content_id, progress_callback)
+        else:
+            deleted = self.delete_chunks(document_id=document_id,
+                                         progress_callback=progress_callback)
         
         # Delete document
         self.db.collection(self.COLLECTION_NAME).document(document_id).delete()
+        
+        if content_id:
+            # Any other references keep the content; the owner's index re-syncs
+            self._invalidate_index(doc.get('user_id'))
+            self._invalidate_index()
+            return deleted
+        
+        # Drop its chunks from every in-memory index
+        self._remove_from_indexes(document_id)
+        return deleted
     
-    @staticmethod
-    def _cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-        """Calculate cosine similarity."""
-        import numpy as np
+    def release_content(self, content_id: str,
+                        progress_callback: Callable[[int], None] = None) -> int:
+        """
+        Drop one reference to shared content, deleting its chunks with the
+        last reference.
         
-        vec1 = np.array(vec1)
-        vec2 = np.array(vec2)
+        Args:
+            content_id: Shared content from acquire_content
+            progress_callback: Called with the number of chunks deleted so far
+            
+        Returns:
+            Number of chunks deleted
+        """
+        if not self._release_content(content_id):
+            return 0
+        deleted = self.delete_chunks(content_id=content_id, progress_callback=progress_callback)
+        self.db.collection(self.CONTENTS_COLLECTION).document(content_id).delete()
+        self._remove_from_indexes(content_id)
+        return deleted
+    
+    def _release_content(self, content_id: str) -> bool:
+        """
+        Drop one reference to shared content.
         
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
+        Returns:
+            True if it was the last reference; the content is then marked
+            'deleting' so that it is not handed out while its chunks go
+        """
+        content_ref = self.db.collection(self.CONTENTS_COLLECTION).document(content_id)
         
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
+        @firestore.transactional
+        def release(transaction):
+            snapshot = content_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            ref_count = snapshot.to_dict().get('ref_count', 1) - 1
+            if ref_count > 0:
+                transaction.update(content_ref, {'ref_count': ref_count})
+                return False
+            transaction.update(content_ref, {'ref_count': 0, 'status': 'deleting'})
+            return True
         
-        return float(dot_product / (norm1 * norm2))
-
+        return release(self.db.transaction())
+    
+    def delete_chunks(self, document_id: str = None, content_id: str = None,
+                      progress_callback: Callable[[int], None] = None) -> int:
+        """
+        Delete the chunks of a document, or of shared content.
+        
+        Chunk references are read a page at a time, without their fields,
+        and each page is deleted as its own batch while the next page is
+        being read.
+        
+        Args:
+            document_id: Document whose private chunks to delete
+            content_id: Shared content whose chunks to delete
+            progress_callback: Called with the number of chunks deleted so
+                far each time a page has been deleted
+            
+        Returns:
+            Number of chunks deleted
+        """
+        field, value = ('content_id', content_id) if content_id else ('document_id', document_id)
+        query = self.db.collection(self.CHUNKS_COLLECTION)\
+            .where(field, '==', value)\
+            .select([])\
+            .limit(self.MAX_BATCH_WRITES)
+        
+        deleted = 0
+        lock = threading.Lock()
+        
+        def delete_page(refs):
+            nonlocal deleted
+            self._commit_batch([('delete', ref, None) for ref in refs])
+            with lock:
+                deleted += len(refs)
+                if progress_callback:
+                    progress_callback(deleted)
+        
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_COMMITS) as executor:
+            pages = []
+            page = list(query.stream())
+            while page:
+                pages.append(executor.submit(delete_page, [chunk.reference for chunk in page]))
+                if len(page) < self.MAX_BATCH_WRITES:
+                    break
+                page = list(query.start_after(page[-1]).stream())
+            for future in pages:
+                future.result()
+        return deleted
+    
+    def _commit_writes(self, writes: List[tuple], final_writes: List[tuple] = ()) -> None:
+        """
+        Commit writes in batches of at most MAX_BATCH_WRITES.
+        
+        Batches are committed in parallel, each retried on transient errors.
+        final_writes share the last batch, which is committed only after all
+        the others succeeded, so e.g. a parent document's new version never
+        becomes visible before its chunks.
+        
+        Args:
+            writes: (method, reference, data) tuples, method being 'set',
+                'update' or 'delete' (data is ignored for deletes)
+            final_writes: Writes to commit last
+        """
+        writes, final_writes = list(writes), list(final_writes)
+        size = self.MAX_BATCH_WRITES
+        batches = [writes[i:i + size] for i in range(0, len(writes), size)]
+        if final_writes:
+            if not batches or len(batches[-1]) + len(final_writes) > size:
+                batches.append([])
+            batches[-1] = batches[-1] + final_writes
+        
+        parallel = batches[:-1] if final_writes else batches
+        if parallel:
+            workers = min(self.MAX_CONCURRENT_COMMITS, len(parallel))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self._commit_batch, parallel))
+        if final_writes:
+            self._commit_batch(batches[-1])
+    
+    def _commit_batch(self, writes: List[tuple]) -> None:
+        """Commit one batch of writes, retrying transient errors with jittered backoff."""
+        for attempt in range(self.COMMIT_RETRIES + 1):
+            # A fresh batch per attempt; the writes are idempotent
+            batch = self.db.batch()
+            for method, ref, data in writes:
+                if method == 'delete':
+                    batch.delete(ref)
+                else:
+                    getattr(batch, method)(ref, data)
+            try:
+                batch.commit()
+                return
+            except Exception as e:
+                code = getattr(e, 'code', None)
+                code = getattr(code, 'value', code)
+                if attempt == self.COMMIT_RETRIES or code not in self.TRANSIENT_ERROR_CODES:
+                    raise
+                delay = min(10.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                print(f"Firestore commit failed ({str(e)}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    
+    def _get_index(self, user_id: str = None) -> IVFIndex:
+        """
+        Get the ANN index for a user, loading or syncing it if needed.
+        
+        A cold process starts from the local snapshot when one exists and
+        only fetches the chunks of documents added or updated since it was
+        written. Without a snapshot the index is built from Firestore.
+        Changes are written back to the snapshot in the background.
+        """
+        scope = self._scope(user_id)
+        with self._indexes_lock:
+            index = self._indexes.get(scope)
+            known = self._index_documents.get(scope, {})
+            synced_at = self._index_synced_at.get(scope, 0)
+        
+        if index is not None and time.time() - synced_at < self.INDEX_TTL_SECONDS:
+            return index
+        
+        snapshots = self._get_snapshots()
+        documents, references = self._document_versions(user_id)
+        changed = True
+        
+        if index is None and snapshots is not None:
+            snapshot = snapshots.load(scope)
+            if snapshot is not None:
+                index = IVFIndex.from_arrays(snapshot['ids'], snapshot['matrix'],
+                                             snapshot['payloads'],
+                                             quantization=self._index_quantization())
+                known = snapshot['documents']
+        
+        if index is None:
+            index = IVFIndex(quantization=self._index_quantization())
+            content_ids = [key for key, reference in references.items()
+                           if reference['content_id']]
+            self._add_to_index(index, self._stream_chunks(user_id, content_ids))
+        else:
+            changed = self._sync_index(index, known, documents, references)
+        
+        with self._indexes_lock:
+            self._indexes[scope] = index
+            self._index_documents[scope] = documents
+            self._index_references[scope] = references
+            self._index_synced_at[scope] = time.time()
+        
+        if changed and snapshots is not None:
+            self._schedule_snapshot(scope)
+        return index
+    
+    def _schedule_snapshot(self, scope: str) -> None:
+        """Queue a snapshot of a scope's index on the background writer."""
+        cls = FirestoreVectorStore
+        with self._indexes_lock:
+            if scope in cls._snapshot_pending:
+                return
+            cls._snapshot_pending.add(scope)
+            if cls._snapshot_writer is None:
+                cls._snapshot_writer = ThreadPoolExecutor(max_workers=1,
+                                                          thread_name_prefix='rag-snapshot')
+            writer = cls._snapshot_writer
+        writer.submit(self._save_snapshot, scope)
+    
+    def _save_snapshot(self, scope: str) -> None:
+        """Write a scope's index as it is now to its snapshot (on the writer thread)."""
+        with self._indexes_lock:
+            # Changes made from here on queue another write
+            self._snapshot_pending.discard(scope)
+            index = self._indexes.get(scope)
+            documents = self._index_documents.get(scope, {})
+        if index is None:
+            return
+        
+        try:
+            chunk_ids, matrix, payloads = index.export()
+            mapped = self._get_snapshots().save(scope, chunk_ids, payloads, matrix, documents)
+            if mapped is not None and self._index_quantization() != 'none':
+                # Serve full vectors from the shared mapping; only codes stay resident
+                index.attach_matrix(chunk_ids, mapped)
+        except Exception as e:
+            print(f"Error saving snapshot for {scope}: {str(e)}")
+    
+    def _sync_index(self, index: IVFIndex, known: Dict[str, float],
+                    documents: Dict[str, float], references: Dict[str, Dict] = None) -> bool:
+        """
+        Bring an index up to date with the current document versions.
+        
+        Args:
+            index: Index to update in place
+            known: Document versions the index was built from
+            documents: Current document versions
+            references: Documents by index key, from _document_versions
+            
+        Returns:
+            True if the index changed
+        """
+        stale = {doc_id for doc_id, version in documents.items()
+                 if known.get(doc_id) != version}
+        removed = (set(known) | index.document_ids()) - set(documents)
+        
+        for doc_id in stale | removed:
+            index.remove_document(doc_id)
+        if stale:
+            shared = {doc_id for doc_id in stale
+                      if (references or {}).get(doc_id, {}).get('content_id')}
+            self._add_to_index(index, self._fetch_document_chunks(
+                [doc_id for doc_id in stale if doc_id not in shared]
+            ) + self._fetch_document_chunks(list(shared), field='content_id'))
+        return bool(stale or removed)
+    
+    def _add_to_index(self, index: IVFIndex, chunk_docs) -> None:
+        """Add Firestore chunk documents to an index."""
+        chunk_ids, embeddings, payloads = [], [], []
+        for chunk_doc in chunk_docs:
+            chunk_data = chunk_doc.to_dict()
+            model = chunk_data.get('embedding_model', self.DEFAULT_EMBEDDING_MODEL)
+            if model != self.embedding_model:
+                continue
+            chunk_ids.append(chunk_doc.id)
+            embeddings.append(decode_embedding(chunk_data))
+            payloads.append(self._chunk_payload(chunk_data))
+        index.add_many(chunk_ids, embeddings, payloads)
+    
+    def _document_versions(self, user_id: str = None) -> Tuple[Dict[str, float], Dict[str, Dict]]:
+        """
+        Map documents (optionally for one user) to their last update time.
+        
+        Documents referencing shared content are keyed by the content ID,
+        so content referenced several times is indexed once; its version is
+        that of its most recently updated reference.
+        
+        Returns:
+            (versions, references): versions by document or content ID, and
+            the document ID, file name and content ID each of these keys is
+            reported as in search results
+        """
+        query = self.db.collection(self.COLLECTION_NAME)
+        if user_id:
+            query = query.where('user_id', '==', user_id)
+        
+        versions = {}
+        references = {}
+        for doc in query.stream():
+            doc_data = doc.to_dict()
+            updated_at = doc_data.get('updated_at')
+            version = updated_at.timestamp() \
+                if hasattr(updated_at, 'timestamp') else str(updated_at)
+            content_id = doc_data.get('content_id')
+            references.setdefault(content_id or doc.id, {
+                'document_id': doc.id,
+                'file_name': doc_data.get('file_name'),
+                'content_id': content_id
+            })
+            if content_id:
+                versions[content_id] = max(versions.get(content_id, version), version)
+            else:
+                versions[doc.id] = version
+        return versions, references
+    
+    @classmethod
+    def _get_snapshots(cls) -> Optional[VectorSnapshot]:
+        """Get the shared snapshot store, or None if it is unavailable."""
+        if cls._snapshots is None:
+            try:
+                cls._snapshots = VectorSnapshot()
+            except (OSError, ValueError) as e:
+                print(f"Vector snapshots disabled: {e}")
+                cls._snapshots = False
+        return cls._snapshots or None
+    
+    @classmethod
+    def _index_quantization(cls) -> str:
+        """Quantization of new indexes: INDEX_QUANTIZATION if snapshots map float32 vectors."""
+        snapshots = cls._get_snapshots()
+        if snapshots is None or snapshots.dtype != 'float32':
+            return 'none'
+        return cls.INDEX_QUANTIZATION
+    
+    def _scope(self, user_id: str = None) -> str:
+        """Index key for a user ('*' for all users) under this store's model."""
+        scope = user_id or '*'
+        if self.embedding_model != self.DEFAULT_EMBEDDING_MODEL:
+            scope = f"{self.embedding_model}:{scope}"
+        return scope
+    
+    def _remove_from_indexes(self, document_id: str) -> None:
+        """Drop a document's (or shared content's) chunks from every in-memory index."""
+        with self._indexes_lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            index.remove_document(document_id)
+    
+    def _invalidate_index(self, user_id: str = None) -> None:
+        """Make the next search of a user re-sync their index with Firestore."""
+        with self._indexes_lock:
+            self._index_synced_at.pop(self._scope(user_id), None)
+    
+    def _loaded_indexes(self, user_id: str = None) -> List[IVFIndex]:
+        """Get the already-built indexes that should contain a user's chunks."""
+        with self._indexes_lock:
+            scopes = [self._scope()] + ([self._scope(user_id)] if user_id else [])
+            return [self._indexes[scope] for scope in scopes if scope in self._indexes]
+    
+    def _stream_chunks(self, user_id: str = None, content_ids: List[str] = ()) -> List:
+        """
+        Fetch chunk documents, optionally restricted to a user.
+        
+        Chunks written since user_id was denormalised onto them are read
+        with a single equality query. Older chunks are read through their
+        parent document IDs, and shared chunks through the content IDs the
+        user's documents reference, in parallel 'in' queries of at most 10 IDs.
+        """
+        chunks_ref = self.db.collection(self.CHUNKS_COLLECTION)
+        if not user_id:
+            return list(chunks_ref.stream())
+        
+        chunks = list(chunks_ref.where('user_id', '==', user_id).stream())
+        chunks.extend(self._fetch_document_chunks(list(content_ids), field='content_id'))
+        
+        user_docs = self.db.collection(self.COLLECTION_NAME)\
+            .where('user_id', '==', user_id).stream()
+        legacy_ids = [doc.id for doc in user_docs
+                      if not doc.to_dict().get('chunks_have_user_id')
+                      and not doc.to_dict().get('content_id')]
+        if not legacy_ids:
+            return chunks
+        
+        seen = {chunk.id for chunk in chunks}
+        chunks.extend(chunk for chunk in self._fetch_document_chunks(legacy_ids)
+                      if chunk.id not in seen)
+        return chunks
+    
+    def _fetch_document_chunks(self, doc_ids: List[str], field: str = 'document_id') -> List:
+        """Fetch the chunks of several documents (or shared contents) with parallel 'in' queries."""
+        if not doc_ids:
+            return []
+        
+        chunks_ref = self.db.collection(self.CHUNKS_COLLECTION)
+        id_groups = [doc_ids[i:i + self.IN_QUERY_LIMIT]
+                     for i in range(0, len(doc_ids), self.IN_QUERY_LIMIT)]
+        
+        def fetch(group):
+            return list(chunks_ref.where(field, 'in', group).stream())
+        
+        chunks = []
+        with ThreadPoolExecutor(max_workers=min(8, len(id_groups))) as executor:
+            for group_chunks in executor.map(fetch, id_groups):
+                chunks.extend(group_chunks)
+        return chunks
+    
+    def _chunk_data(self, chunk: Dict, embedding: Optional[List[float]], position: int,
+                    document_id: str, user_id: str = None, content_id: str = None) -> Dict:
+        """Build the Firestore fields of a chunk."""
+        if content_id:
+            owner = {'content_id': content_id}
+        else:
+            owner = {
+                'document_id': document_id,
+                'user_id': user_id  # Denormalised for user-scoped queries
+            }
+        
+        chunk_data = {
+            **owner,
+            'chunk_index': chunk.get('chunk_index', position),
+            'text': chunk['text'],
+            **encode_embedding(embedding, self.EMBEDDING_ENCODING),
+            'embedding_model': self.embedding_model,
+            'metadata': self._chunk_metadata(chunk),
+            'created_at': datetime.utcnow()
+        }
+        if embedding is None:
+            chunk_data.update(self._pending_fields(attempts=1))
+        return chunk_data
+    
+    @staticmethod
+    def _chunk_metadata(chunk: Dict) -> Dict:
+        """Chunk fields stored under 'metadata'."""
+        return {k: v for k, v in chunk.items() if k not in ['text', 'chunk_index']}
+    
+    @staticmethod
+    def _chunk_payload(chunk_data: Dict) -> Dict:
+        """Extract the fields returned with search results."""
+        payload = {
+            'text': chunk_data.get('text', ''),
+            'document_id': chunk_data.get('document_id'),
+            'chunk_index': chunk_data.get('chunk_index', 0),
+            'metadata': chunk_data.get('metadata', {})
+        }
+        if chunk_data.get('content_id'):
+            # Shared chunks are grouped in indexes by their content
+            payload['document_id'] = payload['content_id'] = chunk_data['content_id']
+        return payload
+    
+    @staticmethod
+    def _cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+        """Calculate cosine similarity."""
+        return float(cosine_scores(vec1, [vec2])[0])
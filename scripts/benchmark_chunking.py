@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark Text Chunking
+Measures TextChunker throughput on multi-megabyte synthetic documents of
+different shapes. Given another chunking.py (e.g. an older revision), also
+times it on the same inputs and checks that both produce identical chunks.
+
+Usage:
+    python scripts/benchmark_chunking.py [size_mb] [reference_chunking.py]
+
+    git show HEAD~1:lib/rag/chunking.py > /tmp/chunking_old.py
+    python scripts/benchmark_chunking.py 8 /tmp/chunking_old.py
+"""
+
+import sys
+import os
+import time
+import random
+import importlib.util
+
+# Add parent directory to path to import lib modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.rag.chunking import TextChunker
+
+WORDS = ("photosynthesis converts light energy into chemical energy stored in glucose "
+         "chlorophyll absorbs red and blue light while the stomata exchange gases "
+         "students should compare aerobic and anaerobic respiration").split()
+
+
+def sentence(rng: random.Random, min_words: int = 6, max_words: int = 30) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + rng.choice(".!?")
+
+
+def make_documents(size: int) -> dict:
+    """Documents of about size characters each, keyed by shape."""
+    rng = random.Random(42)
+
+    def build(make_part, separator):
+        parts, length = [], 0
+        while length < size:
+            part = make_part()
+            parts.append(part)
+            length += len(part) + len(separator)
+        return separator.join(parts)
+
+    return {
+        # Textbook prose: paragraphs of a few sentences
+        "prose": build(lambda: " ".join(sentence(rng) for _ in range(rng.randint(2, 8))), "\n\n"),
+        # Extracted PDFs often lose blank lines: one huge paragraph
+        "one paragraph": build(lambda: sentence(rng), " "),
+        # Slides and lists: many short paragraphs without punctuation
+        "short lines": build(lambda: " ".join(rng.choice(WORDS) for _ in range(3)), "\n\n"),
+        # Sentences longer than a chunk
+        "long sentences": build(lambda: sentence(rng, 200, 400), " "),
+    }
+
+
+def load_reference(path: str):
+    """Load TextChunker from another chunking.py."""
+    spec = importlib.util.spec_from_file_location("reference_chunking", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.TextChunker
+
+
+def run(chunker_class, text: str) -> tuple:
+    """Chunk text and return (chunks, seconds)."""
+    chunker = chunker_class(chunk_size=1000, chunk_overlap=200)
+    start = time.perf_counter()
+    chunks = chunker.chunk_text(text, metadata={"file_name": "benchmark.txt"})
+    return chunks, time.perf_counter() - start
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    reference = load_reference(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    print("=" * 72)
+    print(f"CHUNKING BENCHMARK: {size_mb:g} MB per document")
+    print("=" * 72)
+    header = f"{'document':<16} {'chunks':>8} {'seconds':>9} {'MB/s':>8}"
+    if reference:
+        header += f" {'ref s':>9} {'speedup':>8}  identical"
+    print(header)
+
+    identical = True
+    for name, text in make_documents(int(size_mb * 1e6)).items():
+        chunks, seconds = run(TextChunker, text)
+        row = f"{name:<16} {len(chunks):>8} {seconds:>9.3f} {len(text) / 1e6 / seconds:>8.1f}"
+        if reference:
+            reference_chunks, reference_seconds = run(reference, text)
+            same = reference_chunks == chunks
+            identical = identical and same
+            row += f" {reference_seconds:>9.3f} {reference_seconds / seconds:>8.2f}  {'yes' if same else 'NO'}"
+        print(row)
+
+    if not identical:
+        print("\n❌ Output differs from the reference chunker")
+        sys.exit(1)
+    if reference:
+        print("\n✅ Output identical to the reference chunker")
+
+
+if __name__ == "__main__":
+    main()
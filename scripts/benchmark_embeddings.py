@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark Batched Embedding
+Measures embed_batch throughput offline with the HashEmbedder stand-in,
+comparing one-request-per-text against batched and concurrent requests.
+
+Usage:
+    python scripts/benchmark_embeddings.py [num_chunks] [latency_seconds]
+"""
+
+import sys
+import os
+import time
+import tempfile
+
+# Add parent directory to path to import lib modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.rag.embeddings import HashEmbedder
+
+
+def run(name, num_chunks, latency, batch_size, max_concurrency, rate_limit_every=0):
+    """Embed num_chunks distinct texts and print the elapsed time."""
+    texts = [f"Chunk {i} about photosynthesis, cells and energy." for i in range(num_chunks)]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        embedder = HashEmbedder(
+            latency=latency,
+            rate_limit_every=rate_limit_every,
+            max_concurrency=max_concurrency,
+            chunk_cache_path=os.path.join(cache_dir, "chunks.db"),
+        )
+        start = time.perf_counter()
+        embeddings = embedder.embed_batch(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+
+    assert len(embeddings) == num_chunks
+    print(f"{name:<32} {elapsed:>8.2f}s  {num_chunks / elapsed:>8.0f} chunks/s")
+
+
+def main():
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    print("=" * 60)
+    print(f"EMBEDDING BENCHMARK: {num_chunks} chunks, {latency * 1000:.0f}ms per request")
+    print("=" * 60)
+
+    run("sequential (1 text/request)", num_chunks, latency, 1, 1)
+    run("batched (100 texts/request)", num_chunks, latency, 100, 1)
+    run("batched + 4 concurrent", num_chunks, latency, 100, 4)
+    run("batched, every 3rd req 429", num_chunks, latency, 25, 4, rate_limit_every=3)
+
+
+if __name__ == "__main__":
+    main()
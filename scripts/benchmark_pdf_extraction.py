@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark PDF Text Extraction
+Compares single-process and multi-process PDF page extraction and checks
+that both produce identical text with page markers in order.
+
+Usage:
+    python scripts/benchmark_pdf_extraction.py [pdf_path | num_lessons] [workers]
+
+Without a PDF path a synthetic textbook (default 300 lessons, about three
+quarters of a page each) is generated.
+"""
+
+import sys
+import os
+import time
+
+# Add parent directory to path to import lib modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.rag.file_processors import FileProcessor
+
+
+def make_pdf(num_lessons: int) -> bytes:
+    """Text-heavy PDF with num_lessons short lessons."""
+    from lib.pdf_generator import markdown_to_pdf
+
+    paragraph = ("Photosynthesis converts light energy into chemical energy stored in glucose. "
+                 "Chlorophyll in the chloroplasts absorbs mostly red and blue light. ") * 4
+    sections = []
+    for lesson in range(num_lessons):
+        sections.append(f"## Lesson {lesson + 1}\n\n" + "\n\n".join([paragraph] * 5))
+    return markdown_to_pdf("\n\n".join(sections), title="Benchmark Textbook")
+
+
+def extract(content: bytes, workers: int, min_pages: int) -> tuple:
+    """Extract all text with the given parallelism and return (text, seconds)."""
+    FileProcessor.PDF_WORKERS = workers
+    FileProcessor.PARALLEL_PDF_MIN_PAGES = min_pages
+    start = time.perf_counter()
+    result = FileProcessor.process_file(file_content=content, file_name='benchmark.pdf')
+    return result['text'], result['metadata'].get('num_pages'), time.perf_counter() - start
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else '300'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+
+    # Every run extracts the same bytes; measure extraction, not cache hits
+    FileProcessor._cache = False
+
+    print("=" * 60)
+    print("PDF EXTRACTION BENCHMARK")
+    print("=" * 60)
+
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            content = f.read()
+        print(f"File: {source} ({len(content) / 1e6:.1f} MB)")
+    else:
+        content = make_pdf(int(source))
+        print(f"Synthetic PDF: {len(content) / 1e6:.1f} MB")
+
+    serial_text, num_pages, serial_s = extract(content, 1, sys.maxsize)
+    print(f"Pages: {num_pages}, CPU cores: {os.cpu_count()}")
+    print(f"\n{'mode':<20} {'seconds':>10} {'pages/s':>10} {'speedup':>10}")
+    print(f"{'single process':<20} {serial_s:>10.2f} {num_pages / serial_s:>10.1f} {1.0:>10.2f}")
+
+    # The pool is started by the first document and reused afterwards
+    for label in ('cold pool', 'warm pool'):
+        parallel_text, _, parallel_s = extract(content, workers, 1)
+        print(f"{f'{workers} procs, {label}':<20} {parallel_s:>10.2f} {num_pages / parallel_s:>10.1f}"
+              f" {serial_s / parallel_s:>10.2f}")
+
+    print()
+    if parallel_text == serial_text:
+        print("✅ Parallel output identical to single-process output")
+    else:
+        print("❌ Parallel output differs from single-process output")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
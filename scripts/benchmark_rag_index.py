@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark RAG Retrieval Index
+Compares exhaustive, IVF, SQ8 and PQ search on synthetic embeddings:
+memory per vector, query latency and recall@k against exact search.
+
+Usage:
+    python scripts/benchmark_rag_index.py [num_vectors] [dimension]
+"""
+
+import sys
+import os
+import time
+
+# Add parent directory to path to import lib modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from lib.rag.vector_index import IVFIndex
+from lib.rag.quantization import recall_at_k
+
+TOP_K = 10
+NUM_QUERIES = 100
+
+
+def make_corpus(num_vectors: int, dimension: int, num_topics: int = 200):
+    """Clustered vectors, roughly like chunk embeddings of many documents."""
+    rng = np.random.default_rng(42)
+    topics = rng.normal(size=(num_topics, dimension))
+    labels = rng.integers(0, num_topics, num_vectors)
+    vectors = topics[labels] + 0.6 * rng.normal(size=(num_vectors, dimension))
+    queries = topics[rng.integers(0, num_topics, NUM_QUERIES)] + \
+        0.6 * rng.normal(size=(NUM_QUERIES, dimension))
+    return vectors.astype(np.float32), queries.astype(np.float32)
+
+
+def run(name, index, queries, exact_results=None):
+    """Time queries against an index and print a result row."""
+    start = time.perf_counter()
+    results = [index.search(query, top_k=TOP_K, min_score=-1.0) for query in queries]
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    usage = index.memory_usage()
+    recall = recall_at_k(exact_results, results) if exact_results else 1.0
+    print(f"{name:<12} {usage['vectors'] / len(index):>10.0f} {usage['codes'] / len(index):>10.0f}"
+          f" {latency_ms:>10.2f} {recall:>10.3f}")
+    return results
+
+
+def main():
+    num_vectors = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+
+    print("=" * 60)
+    print(f"RAG INDEX BENCHMARK: {num_vectors} x {dimension}, recall@{TOP_K}")
+    print("=" * 60)
+
+    vectors, queries = make_corpus(num_vectors, dimension)
+    chunk_ids = [str(i) for i in range(num_vectors)]
+    payloads = [{'document_id': str(i // 100)} for i in range(num_vectors)]
+
+    print(f"{'index':<12} {'vec B/row':>10} {'code B/row':>10} {'ms/query':>10} {'recall':>10}")
+
+    exact = IVFIndex(min_train_size=num_vectors + 1)
+    exact.add_many(chunk_ids, vectors, payloads)
+    exact_results = run('exact', exact, queries)
+
+    for quantization in ('none', 'sq8', 'pq'):
+        start = time.perf_counter()
+        index = IVFIndex(quantization=quantization)
+        index.add_many(chunk_ids, vectors, payloads)
+        build_s = time.perf_counter() - start
+
+        if quantization != 'none':
+            # Full vectors live in the memory-mapped snapshot in production
+            _, matrix, _ = index.export()
+            path = os.path.join(os.getcwd(), f".benchmark_{quantization}.npy")
+            np.save(path, matrix)
+            index.attach_matrix(chunk_ids, np.load(path, mmap_mode='r'))
+
+        run(f"ivf+{quantization}", index, queries, exact_results)
+        print(f"{'':<12} built in {build_s:.1f}s")
+
+        if quantization != 'none':
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Migrate RAG Chunk Embeddings
+Rewrites the embeddings in 'rag_chunks' into a compact encoding
+(packed float32/float16 bytes or int8 with a scale factor), or back to arrays.
+
+Usage:
+    python scripts/migrate_chunk_embeddings.py float16 [--dry-run]
+"""
+
+import sys
+import os
+
+# Add parent directory to path to import lib modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import firestore
+from lib.firebase_admin import db
+from lib.rag.embedding_codec import ENCODINGS, encode_embedding, decode_embedding
+
+# Firestore allows at most 500 writes per batch
+BATCH_SIZE = 400
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ENCODINGS:
+        print(f"Usage: python {sys.argv[0]} <{'|'.join(ENCODINGS)}> [--dry-run]")
+        sys.exit(1)
+
+    encoding = sys.argv[1]
+    dry_run = '--dry-run' in sys.argv[2:]
+
+    print("=" * 60)
+    print(f"MIGRATE RAG CHUNK EMBEDDINGS TO '{encoding}'")
+    print("=" * 60)
+
+    if not db:
+        print("❌ Database not connected. Please check your Firebase configuration.")
+        sys.exit(1)
+
+    migrated = 0
+    skipped = 0
+    errors = 0
+    batch = db.batch()
+    pending = 0
+
+    for chunk_doc in db.collection('rag_chunks').stream():
+        chunk_data = chunk_doc.to_dict()
+        current = chunk_data.get('embedding_encoding') or 'array'
+
+        if current == encoding:
+            skipped += 1
+            continue
+
+        try:
+            vector = decode_embedding(chunk_data)
+            if vector is None:
+                skipped += 1
+                continue
+
+            fields = encode_embedding(vector.tolist(), encoding)
+            # Clear the fields of the old encoding
+            for field in ('embedding', 'embedding_bytes', 'embedding_encoding',
+                          'embedding_dim', 'embedding_scale'):
+                fields.setdefault(field, firestore.DELETE_FIELD)
+
+            if not dry_run:
+                batch.update(chunk_doc.reference, fields)
+                pending += 1
+                if pending >= BATCH_SIZE:
+                    batch.commit()
+                    batch = db.batch()
+                    pending = 0
+            migrated += 1
+        except Exception as e:
+            print(f"❌ Error migrating chunk {chunk_doc.id}: {e}")
+            errors += 1
+
+    if pending:
+        batch.commit()
+
+    print("\n" + "=" * 60)
+    print("MIGRATION COMPLETE!" + (" (dry run)" if dry_run else ""))
+    print("=" * 60)
+    print(f"✅ Migrated: {migrated}")
+    print(f"⚠️  Skipped:  {skipped}")
+    print(f"❌ Errors:   {errors}")
+
+
+if __name__ == "__main__":
+    main()